@@ -0,0 +1,17 @@
+#!/bin/bash
+
+echo "[INFO] --- Preparing to query outputs index ---"
+
+echo "- Find script path"
+set -e
+SCRIPTPATH="$( cd -- "$(dirname "$0")" >/dev/null 2>&1 ; pwd -P )"
+
+echo "- pwd=$PWD"
+
+echo "- Activate environment"
+. $SCRIPTPATH/activate.sh
+
+echo "[INFO] --- Preparing done! ---"
+echo "       Run: python $SCRIPTPATH/src/outputs.py $@"
+
+python $SCRIPTPATH/src/outputs.py $@
@@ -0,0 +1,128 @@
+import argparse
+import os
+import sys
+import time
+
+from core.state import State
+from core.archive import (
+    ArchiveBuilder,
+    COMPRESSIONS,
+    FORMATS,
+    archive_name,
+    export_legacy,
+    find_unfinished,
+    remove_outputs,
+)
+from core.container import list_outputs
+from core.outputindex import OutputIndex, FILTERS
+from outputs import add_filters
+
+"""
+Outputs archive CLI
+
+    python daemon/src/archive.py create [path] [--format zip] [--compression zstd] [--remove]
+    python daemon/src/archive.py create --before <name> --model sd15
+    python daemon/src/archive.py export <dir> [--workers 8]
+
+create archives outputs (all, or those matching filters of the outputs
+index) into archives_root/out-<time>.tar.gz, or path. An unfinished archive
+of the same format (interrupted create) is resumed. With --remove, archived
+outputs are removed from outputs_root and the index.
+
+export writes legacy (.a) outputs as plain image and json files.
+
+Run from the directory which has default_config.json and config.json.
+"""
+
+
+def select_outputs(state, args):
+    "Names of outputs to archive, oldest first"
+    names = list_outputs(state.outputs_root)
+    filters = {key: getattr(args, key, None) for key in FILTERS}
+    if all(value is None for value in filters.values()):
+        return names
+    index = OutputIndex(f"{state.state_root}/outputs.db")
+    rows = index.query(limit=-1, oldest_first=True, **filters)
+    index.close()
+    matched = set(row["name"] for row in rows)
+    return [name for name in names if name in matched]
+
+
+def create(state, args):
+    conf = state.archive_conf
+    fmt = args.format or conf.get("format", "tar")
+    compression = args.compression or conf.get("compression", "gzip")
+    os.makedirs(state.archives_root, exist_ok=True)
+    path = args.path
+    if path is None:
+        path = find_unfinished(state.archives_root, fmt, compression)
+    if path is None:
+        path = f"{state.archives_root}/{archive_name(fmt, compression)}"
+    builder = ArchiveBuilder.from_config(
+        path,
+        state.mask,
+        conf,
+        fmt=fmt,
+        compression=compression,
+        level=args.level,
+        workers=args.workers,
+        export_legacy=args.export_legacy or None,
+    )
+    names = select_outputs(state, args)
+    if len(names) == 0 and not os.path.exists(f"{path}.manifest"):
+        print("[INFO] No outputs to archive")
+        return
+
+    def progress(done, total):
+        print(f"[INFO] Archived {done}/{total} outputs")
+
+    start = time.perf_counter()
+    archived = builder.build(state.outputs_root, names, progress)
+    print(
+        f"[INFO] Archived {len(archived)} outputs to {path} "
+        f"in {time.perf_counter() - start:.1f}s"
+    )
+    if args.remove:
+        removed = remove_outputs(state.outputs_root, archived)
+        index = OutputIndex.from_config(state.state_root, state.output_index_conf)
+        if index is not None:
+            index.remove(archived)
+            index.close()
+        print(f"[INFO] Removed {removed} files of archived outputs")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive aroma outputs")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("create", help="Archive outputs")
+    p.add_argument("path", nargs="?", help="Archive path (default: in archives_root)")
+    p.add_argument("--format", choices=FORMATS)
+    p.add_argument("--compression", choices=COMPRESSIONS)
+    p.add_argument("--level", type=int)
+    p.add_argument("--workers", type=int)
+    p.add_argument(
+        "--export-legacy", action="store_true", help="Archive .a outputs as plain files"
+    )
+    p.add_argument("--remove", action="store_true", help="Remove archived outputs")
+    add_filters(p)
+    p = sub.add_parser("export", help="Export legacy outputs as plain files")
+    p.add_argument("dir")
+    p.add_argument("--workers", type=int)
+    add_filters(p)
+    args = parser.parse_args()
+
+    state = State.init_from_config_files(["default_config.json", "config.json"])
+    if args.command == "create":
+        create(state, args)
+    elif args.command == "export":
+        names = select_outputs(state, args)
+        exported, failed = export_legacy(
+            state.outputs_root, names, args.dir, state.mask, args.workers
+        )
+        print(f"[INFO] Exported {exported} outputs to {args.dir}, failed {failed}")
+        if failed > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
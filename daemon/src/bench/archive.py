@@ -0,0 +1,146 @@
+import base64
+import json
+import os
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+import zipfile
+
+from core.archive import ArchiveBuilder, archive_suffix, output_files
+from core.codec import aroma_encode
+from core.container import encode_container, list_outputs
+from core.preview import THUMBS_DIR
+from core.state import generate_mask
+
+"""
+Benchmark of archives of outputs: `tar -czf` of outputs_root (what the UI
+ran before) against ArchiveBuilder with one and all cpus, in each format,
+with legacy outputs exported, and resuming an archive interrupted at half.
+Archives are checked to have every file of every output.
+
+    python -m bench.archive [outputs] [image kb] [legacy every n]
+"""
+
+
+class Interrupted(Exception):
+    pass
+
+
+def make_outputs(root, mask, n, image_kb, legacy_every):
+    "Outputs with random (incompressible) images and thumbnails"
+    os.makedirs(f"{root}/{THUMBS_DIR}")
+    for i in range(n):
+        name = f"230101-{i // 3600:02d}{i // 60 % 60:02d}{i % 60:02d}-{i:06d}"
+        job = {
+            "start_time": "2023-01-01T00:00:00Z",
+            "values": {"params": {"prompt": f"high quality, cat {i}", "seed": str(i)}},
+        }
+        # webp header, so exported images get an extension
+        image = b"RIFF\0\0\0\0WEBP" + os.urandom(image_kb * 1024)
+        if legacy_every > 0 and i % legacy_every == 0:
+            legacy = {**job, "image": base64.b64encode(image).decode("utf-8")}
+            with open(f"{root}/{name}.a", "w") as f:
+                f.write(aroma_encode(mask, json.dumps(legacy)))
+        else:
+            with open(f"{root}/{name}.ab", "wb") as f:
+                f.write(encode_container(mask, job, image))
+        with open(f"{root}/{THUMBS_DIR}/{name}.ab", "wb") as f:
+            f.write(encode_container(mask, job, os.urandom(4096)))
+
+
+def archived_files(path):
+    if path.endswith(".zip"):
+        with zipfile.ZipFile(path) as z:
+            assert z.testzip() is None
+            return sorted(z.namelist())
+    if path.endswith(".zst"):
+        tar = subprocess.run(
+            f"zstd -dc '{path}' | tar -tf -", shell=True, capture_output=True, check=True
+        )
+        return sorted(tar.stdout.decode("utf-8").split())
+    with tarfile.open(path) as tar:
+        return sorted(tar.getnames())
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    image_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    legacy_every = int(sys.argv[3]) if len(sys.argv) > 3 else 10
+    mask = generate_mask("bench")
+    try:
+        import zstandard
+
+        compressions = ["gzip", "zstd"]
+    except ImportError:
+        print("[WARN] zstandard is not installed, skip zstd")
+        compressions = ["gzip"]
+    with tempfile.TemporaryDirectory() as root:
+        outputs = f"{root}/outputs"
+        make_outputs(outputs, mask, n, image_kb, legacy_every)
+        names = list_outputs(outputs)
+        expected = sorted(
+            arcname for files in output_files(outputs, names).values() for arcname, _ in files
+        )
+        size = sum(os.path.getsize(p) for f in output_files(outputs, names).values() for _, p in f)
+        print(
+            f"{n} outputs ({len(expected)} files, {size / 2**20:.0f}MB), "
+            f"image {image_kb}KB, legacy 1/{legacy_every}, {os.cpu_count()} cpus"
+        )
+
+        def report(label, path, elapsed):
+            print(
+                f"{label:<34} {elapsed:8.2f}s  {os.path.getsize(path) / 2**20:8.1f}MB  "
+                f"{size / 2**20 / elapsed:7.1f}MB/s"
+            )
+
+        start = time.perf_counter()
+        subprocess.run(["tar", "-czf", f"{root}/old.tar.gz", "-C", outputs, "."], check=True)
+        report("tar -czf (before)", f"{root}/old.tar.gz", time.perf_counter() - start)
+
+        cases = [("tar", c, w) for c in compressions for w in [1, None]]
+        cases += [("tar", "none", None), ("zip", "gzip", None)]
+        for fmt, compression, workers in cases:
+            path = f"{root}/out.{archive_suffix(fmt, compression)}"
+            builder = ArchiveBuilder(
+                path, mask, fmt=fmt, compression=compression, workers=workers
+            )
+            start = time.perf_counter()
+            archived = builder.build(outputs, names)
+            elapsed = time.perf_counter() - start
+            assert len(archived) == n
+            assert archived_files(path) == expected
+            report(f"{fmt} {compression} workers={workers or os.cpu_count()}", path, elapsed)
+            os.remove(path)
+
+        builder = ArchiveBuilder(f"{root}/legacy.tar.gz", mask, export_legacy=True)
+        start = time.perf_counter()
+        builder.build(outputs, names)
+        elapsed = time.perf_counter() - start
+        files = archived_files(builder.path)
+        exported = sum(1 for f in files if f.endswith(".webp"))
+        assert exported == len([f for f in expected if f.endswith(".a")])
+        report(f"tar gzip export legacy ({exported})", builder.path, elapsed)
+
+        # Interrupt at half, then resume
+        def interrupt(done, total):
+            if done >= total // 2:
+                raise Interrupted()
+
+        path = f"{root}/resume.tar.gz"
+        start = time.perf_counter()
+        try:
+            ArchiveBuilder(path, mask).build(outputs, names, interrupt)
+        except Interrupted:
+            pass
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        ArchiveBuilder(path, mask).build(outputs, names)
+        resumed = time.perf_counter() - start
+        assert archived_files(path) == expected
+        print(f"interrupted at half {first:8.2f}s, resumed {resumed:8.2f}s")
+
+
+if __name__ == "__main__":
+    main()
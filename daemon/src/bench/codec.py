@@ -0,0 +1,124 @@
+import base64
+import gzip
+import json
+import os
+import time
+
+from core.codec import *
+from core.state import generate_mask
+
+"""
+Benchmark and verification of aroma codec
+
+Run from daemon/src:
+    python -m bench.codec [<payload_mb>]
+"""
+
+
+def make_payload(size):
+    # Output-like json: metadata and a base64 image (incompressible)
+    image = base64.b64encode(os.urandom(size * 3 // 4)).decode("utf-8")
+    return json.dumps({"values": {"prompt": "high quality, cat"}, "image": image})
+
+
+def timeit(fn, *args):
+    start = time.perf_counter()
+    r = fn(*args)
+    return r, time.perf_counter() - start
+
+
+def xor_scan_slow(mask, b):
+    b = bytearray(b)
+    l = len(mask)
+    last = 0
+    for i in range(len(b)):
+        b[i] ^= mask[i % l]
+        b[i] ^= last
+        last = b[i]
+    return bytes(b)
+
+
+def aroma_encode_slow(mask, s):
+    "Reference implementation (byte loop)"
+    if mask is None:
+        mask = b"\x00"
+    b = bytearray(gzip.compress(bytearray(s, "utf-8")))[2:]
+    l = len(mask)
+    last = 0
+    for i in range(len(b)):
+        b[i] ^= mask[i % l]
+        b[i] ^= last
+        last = b[i]
+    return base64.b64encode(b).decode("utf-8")
+
+
+def aroma_decode_slow(mask, s):
+    "Reference implementation (byte loop)"
+    if mask is None:
+        mask = b"\x00"
+    s = bytearray(base64.b64decode(s))
+    last = 0
+    l = len(mask)
+    for i in range(len(s)):
+        t = s[i]
+        s[i] ^= last
+        s[i] ^= mask[i % l]
+        last = t
+    return gzip.decompress(bytearray(GZIP_MAGIC) + s).decode("utf-8")
+
+
+def check(mask, s):
+    "Check the codec is compatible with the reference implementation"
+    encoded = aroma_encode(mask, s)
+    assert aroma_decode_slow(mask, encoded) == s
+    assert aroma_decode(mask, aroma_encode_slow(mask, s)) == s
+    # Chunked streaming must produce the same bytes for any split
+    for chunk in [1, 7, 4096]:
+        e = AromaEncoder(mask)
+        parts = [e.update(s[i : i + chunk]) for i in range(0, len(s), chunk)]
+        assert (b"".join(parts) + e.finish()).decode("ascii") == encoded
+        d = AromaDecoder(mask)
+        parts = [d.update(encoded[i : i + chunk]) for i in range(0, len(encoded), chunk)]
+        assert (b"".join(parts) + d.finish()).decode("utf-8") == s
+
+
+def run(payload_mb=5):
+    mask = generate_mask("bench")
+    # Small payloads for exhaustive checks
+    for n in [0, 1, 2, 3, 63, 64, 65, 1000]:
+        check(mask, make_payload(n))
+        check(None, make_payload(n))
+    print("[INFO] codec is compatible with reference implementation")
+
+    s = make_payload(payload_mb * 1024 * 1024)
+    encoded, t_enc = timeit(aroma_encode, mask, s)
+    encoded_slow, t_enc_slow = timeit(aroma_encode_slow, mask, s)
+    decoded, t_dec = timeit(aroma_decode, mask, encoded_slow)
+    decoded_slow, t_dec_slow = timeit(aroma_decode_slow, mask, encoded)
+    assert decoded == s and decoded_slow == s
+    # Masking only, without gzip and base64
+    raw = base64.b64decode(encoded)
+    masked, t_mask = timeit(xor_scan, mask_array(mask), raw)
+    masked_slow, t_mask_slow = timeit(xor_scan_slow, mask, raw)
+    assert masked[0] == masked_slow
+
+    result = {
+        "payload_bytes": len(s),
+        "encode_sec": t_enc,
+        "encode_slow_sec": t_enc_slow,
+        "decode_sec": t_dec,
+        "decode_slow_sec": t_dec_slow,
+        "encode_speedup": t_enc_slow / t_enc,
+        "decode_speedup": t_dec_slow / t_dec,
+        "mask_sec": t_mask,
+        "mask_slow_sec": t_mask_slow,
+        "mask_speedup": t_mask_slow / t_mask,
+    }
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 5)
@@ -0,0 +1,73 @@
+import sys
+import tempfile
+import time
+
+import torch
+
+from core.prompt import Prompt
+from bench.tiny import build_tiny_model_dir, build_tiny_text_encoder
+
+"""
+Benchmark of prompt encoding modes: text encoder forward passes, encoded
+77-token sequences, time per prompt and output length, for blend and token
+modes, on prompts with few or many distinct weights and long prompts.
+
+    python -m bench.encode [repeat] [text encoder hidden size]
+"""
+
+PROMPTS = {
+    "plain": "a photo of a cat sitting on a table, best quality",
+    "weights 2": "a photo of a (cat:1.3) sitting on a table, best quality",
+    "weights 8": "(a:1.1) [photo] ((of)) (a:0.7) (cat:1.3) [[sitting]] (on:1.5) "
+    "(a:0.9) table, (best:1.2) quality",
+    "long": ", ".join(f"(tag{i}:1.{i % 5})" for i in range(24)),
+}
+
+
+class Counter:
+    "Count forward passes and sequences of the text encoder"
+
+    def __init__(self, text_encoder):
+        self.calls = 0
+        self.sequences = 0
+        forward = text_encoder.forward
+
+        def counted(input_ids, *args, **kwargs):
+            self.calls += 1
+            self.sequences += input_ids.shape[0]
+            return forward(input_ids, *args, **kwargs)
+
+        text_encoder.forward = counted
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    hidden = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    from diffusers import StableDiffusionPipeline
+
+    with tempfile.TemporaryDirectory() as root:
+        build_tiny_model_dir(f"{root}/tiny")
+        pipe = StableDiffusionPipeline.from_pretrained(f"{root}/tiny", local_files_only=True)
+    pipe.text_encoder = build_tiny_text_encoder(hidden, len(pipe.tokenizer))
+    counter = Counter(pipe.text_encoder)
+    print(f"text encoder hidden={hidden} repeat={repeat} (char-level tokenizer)")
+    with torch.inference_mode():
+        for name, text in PROMPTS.items():
+            for mode in ["blend", "token"]:
+                prompt = Prompt(".")
+                counter.calls = counter.sequences = 0
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    # No cache, encode every time
+                    prompt.key = None
+                    prompt.update_embed(text, pipe, mode=mode)
+                elapsed = (time.perf_counter() - start) / repeat
+                print(
+                    f"{name:10} {mode:6} forward {counter.calls / repeat:4.1f}  "
+                    f"sequences {counter.sequences / repeat:5.1f}  "
+                    f"{elapsed * 1000:7.2f}ms  tokens {prompt.embeds.shape[1]}"
+                )
+
+
+if __name__ == "__main__":
+    main()
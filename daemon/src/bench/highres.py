@@ -0,0 +1,74 @@
+import sys
+import tempfile
+import time
+
+import torch
+
+from core.pipes import SDPipes
+from core.util import torch_device
+from bench.tiny import build_tiny_model_dir, make_state
+
+"""
+Benchmark of highres fix modes: run jobs with two highres passes in pixel
+and latent mode on a tiny model, and print time per job and stage totals.
+
+    python -m bench.highres [jobs] [size]
+"""
+
+
+def run(root, mode, jobs, size):
+    passes = [
+        {"scale": 1.5, "strength": 0.5, "mode": mode},
+        {"scale": 1.25, "strength": 0.5, "mode": mode},
+    ]
+    state = make_state(
+        root,
+        {
+            # Run stages in line, so decode time is on the critical path
+            "overlap": {"enabled": False},
+            "init_values": {
+                "model": {"path": "tiny"},
+                "params": {
+                    "width": size,
+                    "height": size,
+                    "sampling_steps": 4,
+                    "seed": "1",
+                    "prompt": "a b c",
+                    "highres_fix": passes,
+                },
+            },
+        },
+    )
+    pipes = SDPipes()
+    # Warm up: load model
+    state.start_job()
+    for img, info in pipes.text_to_image(state):
+        state.end_job(img, info)
+    state.writer.flush()
+    state.stage_times.reset()
+    start = time.perf_counter()
+    for _ in range(jobs):
+        state.start_job()
+        for img, info in pipes.text_to_image(state):
+            state.end_job(img, info)
+    pipes.close()
+    state.close()
+    return time.perf_counter() - start, state.stage_times.stats()
+
+
+def main():
+    jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 4
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    print(f"jobs={jobs} size={size} device={torch_device()} threads={torch.get_num_threads()}")
+    with tempfile.TemporaryDirectory() as root:
+        build_tiny_model_dir(f"{root}/models/tiny")
+        for mode in ["pixel", "latent"]:
+            wall, stats = run(root, mode, jobs, size)
+            stages = {
+                k: (round(v["total"], 3), v["count"]) for k, v in stats["stages"].items()
+            }
+            print(f"{mode:6}  {wall / jobs:7.3f}s/job  (total, count): {stages}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import json
+import sys
+import tempfile
+import threading
+import time
+
+from core.codec import aroma_encode
+from core.state import read_and_truncate_as
+from core.inbox import ValuesInbox, drop_values
+from bench.tiny import make_state
+
+"""
+Benchmark of values ingestion: cost of an idle check (nothing arrived) and
+updates lost while writers race with the daemon, for the legacy
+read-and-truncate of values.as and the values inbox (inotify and polling).
+
+    python -m bench.inbox [updates per writer] [writers]
+"""
+
+
+def idle_cost(f, n=2000):
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter() - start) / n
+
+
+def run_writers(writers, n, write):
+    threads = [
+        threading.Thread(target=lambda k=k: [write(k, i) for i in range(n)])
+        for k in range(writers)
+    ]
+    for t in threads:
+        t.start()
+    return threads
+
+
+def legacy(root, writers, n):
+    path = f"{root}/values.as"
+    with open(path, "w"):
+        pass
+    lock = threading.Lock()
+
+    def write(k, i):
+        # Appends of the UI
+        with lock, open(path, "a") as f:
+            f.write(json.dumps({f"w{k}": i}) + "\n")
+
+    idle = idle_cost(lambda: read_and_truncate_as(path, ""))
+    received = 0
+    threads = run_writers(writers, n, write)
+    while any(t.is_alive() for t in threads):
+        received += len(read_and_truncate_as(path, "").split("\n")) - 1
+    received += len(read_and_truncate_as(path, "").split("\n")) - 1
+    return idle, received
+
+
+def inbox(root, writers, n, inotify):
+    box = ValuesInbox(f"{root}/values.d", inotify=inotify)
+    box.take()
+    idle = idle_cost(box.take)
+
+    def write(k, i):
+        drop_values(f"{root}/values.d", json.dumps({f"w{k}": i}))
+
+    received = 0
+    threads = run_writers(writers, n, write)
+    while any(t.is_alive() for t in threads):
+        received += len(box.take())
+    # Poll watch needs a changed (or recent) mtime, wait for the last ones
+    time.sleep(0.01)
+    received += len(box.take())
+    box.close()
+    return idle, received
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    writers = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    total = n * writers
+    print(f"writers={writers} updates={total}")
+    with tempfile.TemporaryDirectory() as root:
+        idle, received = legacy(root, writers, n)
+        print(f"legacy truncate  idle {idle * 1e6:7.1f}us  lost {total - received}")
+        for inotify in [True, False]:
+            with tempfile.TemporaryDirectory() as root:
+                idle, received = inbox(root, writers, n, inotify)
+                name = "inotify" if inotify else "poll"
+                print(f"inbox {name:10} idle {idle * 1e6:7.1f}us  lost {total - received}")
+
+        # Daemon merge, with encoded values like the UI sends
+        state = make_state(root, {})
+        drop_values(
+            f"{state.state_root}/values.d",
+            aroma_encode(state.mask, json.dumps({"params": {"prompt": "cat"}})),
+            ".as",
+        )
+        merged = state.merge_values()
+        print(f"merge_values: merged {merged}, prompt {state.values['params']['prompt']!r}")
+        idle = idle_cost(state.merge_values)
+        print(f"merge_values idle {idle * 1e6:7.1f}us")
+        state.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+import os
+import sys
+import tempfile
+import time
+
+import safetensors.torch
+import torch
+
+from core.pipes import SDPipes
+from core.util import torch_device
+from bench.tiny import build_tiny_model_dir, make_lora_file, make_state
+
+"""
+Benchmark of model loading phases on a tiny local model: build (configs,
+modules), disk read, transfer to the device, textual inversion and LoRA,
+with fast_load on and off, and clip_skip 0 and 2.
+
+    python -m bench.load [repeat] [unet channels, e.g. 320,640]
+"""
+
+PHASES = ["load_pretrained", "load_build", "load_read", "load_transfer", "load_ti", "load_lora"]
+
+
+def load_once(root, fast_load, clip_skip):
+    state = make_state(
+        root,
+        {
+            "fast_load": fast_load,
+            "init_values": {
+                "model": {
+                    "path": "tiny",
+                    "clip_skip": clip_skip,
+                    "lora_path": "lora.safetensors",
+                    "lora_alpha": 0.5,
+                },
+                "params": {"prompt": "a tok0 b", "negative_prompt": "c"},
+            },
+        },
+    )
+    values = state.values
+    pipes = SDPipes()
+    start = time.perf_counter()
+    pipes._load_model(
+        state,
+        f"{root}/models/tiny",
+        clip_skip=clip_skip,
+        lora_path=f"{root}/models/lora.safetensors",
+        lora_alpha=0.5,
+    )
+    pipes.ti_manifest.refresh(force=True)
+    with state.stage_times.measure("load_ti"):
+        pipes.ti_manifest.load_for(
+            pipes.txt2img,
+            pipes.entry.textual_inversions,
+            [values["params"]["prompt"], values["params"]["negative_prompt"]],
+        )
+    total = time.perf_counter() - start
+    stages = state.stage_times.stats()["stages"]
+    pipes.close()
+    state.close()
+    return total, {name: stages[name]["total"] for name in PHASES if name in stages}
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    channels = [int(c) for c in sys.argv[2].split(",")] if len(sys.argv) > 2 else [32, 64]
+    print(f"device={torch_device()} repeat={repeat} unet channels={channels}")
+    with tempfile.TemporaryDirectory() as root:
+        models = f"{root}/models"
+        build_tiny_model_dir(f"{models}/tiny", channels)
+        os.makedirs(f"{models}/textual_inversion")
+        for i in range(50):
+            safetensors.torch.save_file(
+                {"emb_params": torch.randn(1, 32)},
+                f"{models}/textual_inversion/tok{i}.safetensors",
+            )
+        pipes = SDPipes()
+        state = make_state(root, {"init_values": {"model": {"path": "tiny"}}})
+        pipes._load_model(state, f"{models}/tiny")
+        make_lora_file(f"{models}/lora.safetensors", pipes.txt2img.unet, pipes.txt2img.text_encoder)
+        pipes.close()
+        state.close()
+
+        for fast_load in [False, True]:
+            for clip_skip in [0, 2]:
+                results = [load_once(root, fast_load, clip_skip) for _ in range(repeat)]
+                # Fastest run, with its phases
+                total, phases = min(results, key=lambda r: r[0])
+                phases = " ".join(f"{k[5:]}={v * 1000:.1f}ms" for k, v in phases.items())
+                print(
+                    f"fast_load={str(fast_load):5} clip_skip={clip_skip}  "
+                    f"total {total * 1000:8.1f}ms  {phases}"
+                )
+
+
+if __name__ == "__main__":
+    main()
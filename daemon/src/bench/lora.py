@@ -0,0 +1,95 @@
+import json
+import os
+import tempfile
+import time
+import types
+
+import safetensors.torch
+import torch
+
+from core.lora import _find_layer, load_lora_deltas, LoraWeights
+from core.util import torch_device
+from .tiny import build_tiny_unet, build_tiny_text_encoder, make_lora_file
+
+"""
+Benchmark of LoRA loading on tiny local components
+
+Run from daemon/src:
+    python -m bench.lora [<repeat>]
+"""
+
+
+def load_lora_deltas_slow(pipeline, checkpoint_path):
+    "Previous implementation: attribute walk per key, list visited, mm per layer"
+    state_dict = safetensors.torch.load_file(checkpoint_path)
+    visited = []
+    deltas = []
+    for key in state_dict:
+        if ".alpha" in key or key in visited:
+            continue
+        layer = _find_layer(pipeline, key, "lora_unet", "lora_te")
+        if "lora_down" in key:
+            pair_keys = [key.replace("lora_down", "lora_up"), key]
+        else:
+            pair_keys = [key, key.replace("lora_up", "lora_down")]
+        up = state_dict[pair_keys[0]]
+        down = state_dict[pair_keys[1]]
+        if len(up.shape) == 4:
+            up = up.squeeze(3).squeeze(2)
+            down = down.squeeze(3).squeeze(2)
+        delta = torch.mm(up.to(torch.float32), down.to(torch.float32))
+        deltas.append((layer, delta.reshape(layer.weight.shape)))
+        visited.extend(pair_keys)
+    return deltas
+
+
+def timeit(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def run(repeat=3, device=None):
+    device = device or torch_device()
+    pipeline = types.SimpleNamespace(
+        unet=build_tiny_unet().to(device),
+        text_encoder=build_tiny_text_encoder().to(device),
+    )
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "lora.safetensors")
+        num_keys = make_lora_file(path, pipeline.unet, pipeline.text_encoder)
+
+        # Results must match the previous implementation
+        new = {id(m): d for m, d in load_lora_deltas(pipeline, path)}
+        old = {id(m): d for m, d in load_lora_deltas_slow(pipeline, path)}
+        assert new.keys() == old.keys()
+        for k in new:
+            assert torch.allclose(new[k].float().cpu(), old[k].cpu(), atol=1e-6)
+
+        lora = LoraWeights(pipeline)
+        alphas = [0.5, 0.75, 1.0]
+        lora.apply([(path, 0.25)])
+
+        def apply_alpha():
+            lora.apply([(path, alphas.pop(0) if alphas else 0.1)])
+
+        result = {
+            "device": device,
+            "lora_keys": num_keys,
+            "lora_layers": len(new),
+            "load_sec": timeit(lambda: load_lora_deltas(pipeline, path), repeat),
+            "load_slow_sec": timeit(lambda: load_lora_deltas_slow(pipeline, path), repeat),
+            "change_alpha_sec": timeit(apply_alpha, repeat),
+        }
+    result["load_speedup"] = result["load_slow_sec"] / result["load_sec"]
+    print(json.dumps(result, indent=2))
+    return result
+
+
+if __name__ == "__main__":
+    import sys
+
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 3)
@@ -0,0 +1,106 @@
+import os
+import sys
+import tempfile
+import time
+
+from core.container import encode_container, list_outputs, find_output, read_metadata
+from core.outputindex import OutputIndex
+from core.state import generate_mask
+
+"""
+Benchmark of the outputs index: listing a page of outputs filtered by
+prompt by reading every file (what a listing had to do without the index)
+against a query of the index, and rebuilding the index from disk with one
+and with all cpus.
+
+    python -m bench.outputindex [outputs] [image kb]
+"""
+
+MODELS = ["sd15", "anything", "tiny"]
+
+
+def make_outputs(root, mask, n, image_kb):
+    image = os.urandom(image_kb * 1024)
+    for i in range(n):
+        name = f"230101-{i // 3600:02d}{i // 60 % 60:02d}{i % 60:02d}-{i:06d}"
+        job = {
+            "start_time": "2023-01-01T00:00:00Z",
+            "end_time": "2023-01-01T00:00:05Z",
+            "elapsed": 5.0,
+            "values": {
+                "model": {"path": MODELS[i % len(MODELS)], "lora_path": "", "lora_alpha": 0},
+                "params": {
+                    "prompt": f"high quality, {'cat' if i % 10 == 0 else 'dog'} {i}",
+                    "negative_prompt": "low quality",
+                    "width": 512,
+                    "height": 768,
+                    "seed": str(i),
+                    "sampling_method": "Default",
+                    "sampling_steps": 25,
+                    "cfg_scale": 8,
+                },
+            },
+        }
+        with open(f"{root}/{name}.ab", "wb") as f:
+            f.write(encode_container(mask, job, image))
+
+
+def list_by_reading(root, mask, prompt, limit):
+    "Newest outputs whose prompt contains text, by reading every file"
+    rows = []
+    for name in reversed(list_outputs(root)):
+        job = read_metadata(find_output(root, name), mask)
+        if prompt in job["values"]["params"]["prompt"]:
+            rows.append(name)
+            if len(rows) >= limit:
+                break
+    return rows
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    image_kb = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    mask = generate_mask("bench")
+    with tempfile.TemporaryDirectory() as root:
+        os.makedirs(f"{root}/outputs")
+        make_outputs(f"{root}/outputs", mask, n, image_kb)
+        print(f"{n} outputs, image {image_kb}KB, {os.cpu_count()} cpus")
+
+        for workers in [1, None]:
+            if os.path.exists(f"{root}/outputs.db"):
+                os.remove(f"{root}/outputs.db")
+            index = OutputIndex(f"{root}/outputs.db")
+            start = time.perf_counter()
+            added, _, _ = index.sync(f"{root}/outputs", mask, workers=workers)
+            print(
+                f"rebuild workers={workers or os.cpu_count():<3} {added} rows "
+                f"{time.perf_counter() - start:8.2f}s"
+            )
+            index.close()
+
+        index = OutputIndex(f"{root}/outputs.db")
+        start = time.perf_counter()
+        index.sync(f"{root}/outputs", mask)
+        print(f"sync (no change)       {(time.perf_counter() - start) * 1000:8.2f}ms")
+
+        # The last matching page is the worst case of reading files
+        for limit in [100, n]:
+            start = time.perf_counter()
+            expected = list_by_reading(f"{root}/outputs", mask, "cat", limit)
+            read = time.perf_counter() - start
+            start = time.perf_counter()
+            rows = index.query(limit=limit, prompt="cat")
+            query = time.perf_counter() - start
+            assert [row["name"] for row in rows] == expected
+            print(
+                f"page of {len(rows):5} 'cat'  read files {read * 1000:9.2f}ms  "
+                f"index {query * 1000:7.2f}ms"
+            )
+        start = time.perf_counter()
+        page = index.query(limit=100, before=rows[len(rows) // 2]["name"], model="tiny")
+        print(f"keyset page by model   {(time.perf_counter() - start) * 1000:8.2f}ms ({len(page)} rows)")
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
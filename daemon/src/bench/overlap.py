@@ -0,0 +1,71 @@
+import sys
+import tempfile
+import time
+
+import torch
+
+from core.pipes import SDPipes
+from core.util import torch_device
+from bench.tiny import build_tiny_model_dir, make_state
+
+"""
+Benchmark of stage overlap: run jobs on a tiny model with the overlap
+enabled and disabled, and print wall time and UNet busy share.
+
+    python -m bench.overlap [jobs] [size]
+"""
+
+
+def run(root, enabled, jobs, size):
+    state = make_state(
+        root,
+        {
+            "overlap": {"enabled": enabled},
+            "init_values": {
+                "model": {"path": "tiny"},
+                "params": {
+                    "width": size,
+                    "height": size,
+                    "sampling_steps": 4,
+                    "prompt": "a {b; c; d} e",
+                    "highres_fix": [],
+                },
+            },
+        },
+    )
+    pipes = SDPipes()
+    # Warm up: load model
+    state.start_job()
+    for img, info in pipes.text_to_image(state):
+        state.end_job(img, info)
+    state.writer.flush()
+    state.stage_times.reset()
+    start = time.perf_counter()
+    for _ in range(jobs):
+        state.start_job()
+        for img, info in pipes.text_to_image(state):
+            state.end_job(img, info)
+    pipes.close()
+    state.close()
+    wall = time.perf_counter() - start
+    stats = state.stage_times.stats()
+    return wall, stats
+
+
+def main():
+    jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 8
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    print(f"jobs={jobs} size={size} device={torch_device()} threads={torch.get_num_threads()}")
+    with tempfile.TemporaryDirectory() as root:
+        build_tiny_model_dir(f"{root}/models/tiny")
+        for enabled in [False, True]:
+            wall, stats = run(root, enabled, jobs, size)
+            stages = {k: round(v["total"], 3) for k, v in stats["stages"].items()}
+            print(
+                f"overlap={str(enabled):5}  wall {wall:7.3f}s  "
+                f"{jobs / wall:6.2f} jobs/s  unet_busy {stats['unet_busy']:.2f}  {stages}"
+            )
+
+
+if __name__ == "__main__":
+    main()
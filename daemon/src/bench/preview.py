@@ -0,0 +1,71 @@
+import sys
+import tempfile
+import time
+
+import PIL.Image
+import torch
+
+from core.preview import PreviewChannel, encode_image, make_thumbnail
+from core.state import generate_mask
+from bench.tiny import build_tiny_model_dir
+
+"""
+Benchmark of latent previews and thumbnails: time spent in the step
+callback per preview (linear projection queued on the device) against a
+VAE decode and image encode of the same latents, and size of thumbnails
+against full images.
+
+    python -m bench.preview [width] [height] [repeat]
+"""
+
+
+def timed(f, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    width = int(sys.argv[1]) if len(sys.argv) > 1 else 512
+    height = int(sys.argv[2]) if len(sys.argv) > 2 else 768
+    n = int(sys.argv[3]) if len(sys.argv) > 3 else 20
+    from diffusers import AutoencoderKL
+
+    with tempfile.TemporaryDirectory() as root:
+        build_tiny_model_dir(f"{root}/tiny")
+        vae = AutoencoderKL.from_pretrained(f"{root}/tiny", subfolder="vae")
+        channel = PreviewChannel(f"{root}/preview.ab", generate_mask(""), every=1, interval=0)
+        latents = torch.randn(1, 4, height // 8, width // 8)
+
+        with torch.inference_mode():
+            submit = timed(lambda: channel.submit(latents, {"step": 0}), n)
+
+            def decode_and_encode():
+                image = vae.decode(latents / vae.config.scaling_factor).sample
+                image = (image / 2 + 0.5).clamp(0, 1)
+                image = image[0].permute(1, 2, 0).float().numpy()
+                img = PIL.Image.fromarray((image * 255).round().astype("uint8"))
+                return encode_image(img, "webp", 90)
+
+            full = timed(decode_and_encode, max(1, n // 4))
+        channel.close()
+        print(
+            f"latents {width}x{height}  preview in callback {submit * 1000:7.3f}ms  "
+            f"(tiny) VAE decode + encode {full * 1000:8.2f}ms"
+        )
+
+        # Photo-like full image: smooth gradients and detail
+        img = PIL.Image.radial_gradient("L").resize((width, height)).convert("RGB")
+        img = PIL.Image.blend(img, PIL.Image.effect_noise((width, height), 32).convert("RGB"), 0.3)
+        full_bytes = encode_image(img, "webp", 90)
+        thumb_time = timed(lambda: encode_image(make_thumbnail(img, 256), "webp", 80), n)
+        thumb_bytes = encode_image(make_thumbnail(img, 256), "webp", 80)
+        print(
+            f"image {width}x{height}  full {len(full_bytes) / 1024:8.1f}KB  "
+            f"thumbnail {len(thumb_bytes) / 1024:6.1f}KB  ({thumb_time * 1000:.2f}ms)"
+        )
+
+
+if __name__ == "__main__":
+    main()
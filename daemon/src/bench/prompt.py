@@ -0,0 +1,137 @@
+import random
+import sys
+import time
+
+import numpy as np
+
+from core.prompt import (
+    compile_template,
+    sample_template,
+    text_to_weighted_list,
+    _weighted_list,
+)
+
+"""
+Benchmark of prompt templates: expansion by the previous parser (parse the
+string for every expansion) against compiled templates (parse once, then
+sample the tree), for large wildcard lists and deep nesting. Also weighted
+list parsing of long emphasis prompts.
+
+    python -m bench.prompt [expansions]
+"""
+
+
+def legacy_process_random_prompts(text):
+    "Previous implementation, for comparison"
+    p_stack = [""]
+    stack = [[("", 1)]]
+    i = 0
+    while i < len(text):
+        c = text[i]
+        is_choice = p_stack[-1] == "}"
+        if c == "{":
+            p_stack.append("}")
+            stack.append([("", 1)])
+        elif is_choice and c == ";":
+            stack[-1].append(("", 1))
+        elif is_choice and c == ":":
+            j = i + 1
+            num = ""
+            c = text[j]
+            while j < len(text):
+                if c == "." or c.isdigit():
+                    num += c
+                elif c > " ":
+                    break
+                j += 1
+                c = text[j]
+            i = j - 1
+            stack[-1][-1] = (stack[-1][-1][0], float(num))
+        elif is_choice and c == "}" and len(stack) > 1:
+            p_stack.pop()
+            last = stack.pop()
+            p = [max(0.0, e[1]) for e in last]
+            p = np.array(p) / np.sum(p)
+            idx = np.random.choice(len(last), p=p)
+            stack[-1][-1] = (stack[-1][-1][0] + last[idx][0], stack[-1][-1][1])
+        else:
+            last = stack[-1][-1]
+            stack[-1][-1] = (last[0] + c, last[1])
+            if c == "(":
+                p_stack.append(")")
+            elif c == "[":
+                p_stack.append("]")
+            elif p_stack[-1] == c:
+                p_stack.pop()
+        i += 1
+    return stack[0][0][0]
+
+
+def make_templates():
+    rng = random.Random(0)
+
+    def wildcard(n):
+        return (
+            "{"
+            + "; ".join(
+                f"option {i} (detail {i}:1.{i % 10})" + (f": {rng.randint(1, 5)}" if i % 3 == 0 else "")
+                for i in range(n)
+            )
+            + "}"
+        )
+
+    def nested(depth):
+        text = "leaf"
+        for d in range(depth):
+            text = f"{{level {d} {text}; other {d}: 0.5}}"
+        return text
+
+    return {
+        "wildcards 3x5000": "a photo of " + ", ".join(wildcard(5000) for _ in range(3)),
+        "groups 2000x4": " ".join(f"{{a{i}; b{i}; c{i}; d{i}}}" for i in range(2000)),
+        "nested 300": nested(300),
+    }
+
+
+def timed(f, n):
+    start = time.perf_counter()
+    for _ in range(n):
+        f()
+    return (time.perf_counter() - start) / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    np.random.seed(0)
+    for name, template in make_templates().items():
+        legacy = timed(lambda: legacy_process_random_prompts(template), n)
+        compile_template.cache_clear()
+        start = time.perf_counter()
+        compile_template(template)
+        cold = time.perf_counter() - start
+        rng = random.Random(0)
+        cached = timed(lambda: sample_template(compile_template(template), rng), n * 50)
+        # Same seed, same expansion
+        a = sample_template(compile_template(template), random.Random(1))
+        b = sample_template(compile_template(template), random.Random(1))
+        print(
+            f"{name:18} len {len(template):7}  legacy {legacy * 1000:9.2f}ms  "
+            f"compile {cold * 1000:8.2f}ms  sample {cached * 1000:7.3f}ms  "
+            f"x{legacy / cached:7.1f}  reproducible {a == b}"
+        )
+
+    # Emphasis of a long expanded prompt
+    text = ", ".join(f"((word {i}:1.{i % 10})), [other {i}]" for i in range(500))
+    _weighted_list.cache_clear()
+    start = time.perf_counter()
+    text_to_weighted_list(text)
+    cold = time.perf_counter() - start
+    cached = timed(lambda: text_to_weighted_list(text), n * 50)
+    print(
+        f"{'weighted list':18} len {len(text):7}  parse {cold * 1000:9.2f}ms  "
+        f"cached {cached * 1000:7.3f}ms"
+    )
+
+
+if __name__ == "__main__":
+    main()
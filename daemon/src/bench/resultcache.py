@@ -0,0 +1,74 @@
+import sys
+import tempfile
+import time
+
+from core.pipes import SDPipes
+from bench.tiny import build_tiny_model_dir, make_state
+
+"""
+Benchmark of the result cache: time per seeded job when it is new (UNet
+runs), when the same job was run before (cached outputs are written), and
+when only the highres chain changed (the first pass is reused).
+
+    python -m bench.resultcache [jobs] [size]
+"""
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    size = int(sys.argv[2]) if len(sys.argv) > 2 else 64
+    with tempfile.TemporaryDirectory() as root:
+        build_tiny_model_dir(f"{root}/models/tiny")
+        state = make_state(
+            root,
+            {
+                "result_cache": {"enabled": True},
+                "output_writer": {"workers": 0},
+                "init_values": {
+                    "model": {"path": "tiny"},
+                    "params": {
+                        "width": size,
+                        "height": size,
+                        "sampling_steps": 8,
+                        "prompt": "a {red; blue} cat",
+                        "highres_fix": [{"scale": 1.5, "strength": 0.5}],
+                    },
+                },
+            },
+        )
+        pipes = SDPipes()
+
+        def job(seed, strength):
+            # Queued jobs are never skipped as repeats
+            values = {
+                "params": {
+                    "seed": str(seed),
+                    "prompt_seed": str(seed),
+                    "highres_fix": [{"scale": 1.5, "strength": strength}],
+                }
+            }
+            state.start_job({"id": 0, "values": values, "done": 0, "repeat": 1})
+            start = time.perf_counter()
+            for img, info in pipes.text_to_image(state):
+                state.end_job(img, info)
+            elapsed = time.perf_counter() - start
+            state.values = state.base_values
+            state.queued = None
+            return elapsed
+
+        job(0, 0.5)  # warm up
+        cases = [
+            ("new", lambda i: job(100 + i, 0.5)),
+            ("cached", lambda i: job(100 + i, 0.5)),
+            ("highres changed", lambda i: job(100 + i, 0.3)),
+        ]
+        for name, f in cases:
+            elapsed = sum(f(i) for i in range(n)) / n
+            print(f"{name:16} {elapsed * 1000:9.2f}ms / job")
+        print(f"stats {state.get_result_cache().stats()}")
+        pipes.close()
+        state.close()
+
+
+if __name__ == "__main__":
+    main()
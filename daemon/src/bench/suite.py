@@ -0,0 +1,348 @@
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import types
+
+import torch
+
+from core.codec import aroma_encode, aroma_decode
+from core.lora import load_safetensors_lora
+from core.pipes import SDPipes
+from core.prompt import (
+    Prompt,
+    compile_template,
+    process_random_prompts,
+    text_to_weighted_list,
+    weighted_chunks,
+    _weighted_list,
+)
+from core.state import generate_mask
+from core.util import torch_device
+from bench.codec import make_payload
+from bench.prompt import make_templates
+from bench.tiny import (
+    build_tiny_model_dir,
+    build_tiny_text_encoder,
+    build_tiny_unet,
+    make_lora_file,
+    make_state,
+)
+
+"""
+Offline benchmark suite of the daemon hot paths
+
+Builds a tiny random-weight model (UNet, VAE, CLIP text encoder and
+tokenizer) in a temporary directory, so it needs no network and runs on a
+cpu-only box. Each case is timed `repeat` times (each sample runs the case
+`number` times), and results are written as JSON to compare across commits:
+
+    python -m bench.suite run --out results.json [--repeat 5] [--only a,b]
+    python -m bench.suite compare baseline.json results.json [--threshold 0.25]
+
+compare exits with 1 if the best time of any case is slower than the
+baseline by more than the threshold (a ratio, 0.25 = 25%).
+"""
+
+RESULTS_VERSION = 1
+
+
+def measure(fn, repeat, number=1):
+    "Return seconds per call of each sample"
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            fn()
+        samples.append((time.perf_counter() - start) / number)
+    return samples
+
+
+class Suite:
+    def __init__(self, root, repeat):
+        self.root = root
+        self.repeat = repeat
+        self.cases = {}
+        self.model_path = f"{root}/models/tiny"
+
+    def case(self, name, number=1):
+        "Register setup function of a case, which returns the function to time"
+
+        def register(setup):
+            self.cases[name] = (setup, number)
+            return setup
+
+        return register
+
+    def run(self, only=None):
+        results = {}
+        for name, (setup, number) in self.cases.items():
+            if only is not None and name not in only:
+                continue
+            fn, teardown = setup(self)
+            try:
+                # Warm up: caches, lazy imports and allocations
+                fn()
+                samples = measure(fn, self.repeat, number)
+            finally:
+                if teardown is not None:
+                    teardown()
+            results[name] = {
+                "min": min(samples),
+                "median": statistics.median(samples),
+                "repeat": self.repeat,
+                "number": number,
+            }
+            print(
+                f"{name:24} min {results[name]['min'] * 1000:10.3f}ms  "
+                f"median {results[name]['median'] * 1000:10.3f}ms",
+                flush=True,
+            )
+        return results
+
+
+def job_state(suite, params):
+    state = make_state(
+        tempfile.mkdtemp(dir=suite.root),
+        {
+            "models_root": f"{suite.root}/models",
+            "init_values": {
+                "model": {"path": "tiny"},
+                "params": {
+                    "width": 64,
+                    "height": 64,
+                    "sampling_steps": 4,
+                    "seed": "1",
+                    "prompt": "a {red; blue} (cat:1.2), [dog]",
+                    **params,
+                },
+            },
+        },
+    )
+    return state
+
+
+def text_to_image_case(params):
+    def setup(suite):
+        state = job_state(suite, params)
+        pipes = SDPipes()
+
+        def run():
+            state.merge_values()
+            state.start_job()
+            for img, info in pipes.text_to_image(state):
+                state.end_job(img, info)
+            state.finish_job()
+            # Wait for outputs, they are part of a job
+            state.writer.flush()
+
+        def teardown():
+            pipes.close()
+            state.close()
+
+        return run, teardown
+
+    return setup
+
+
+def register_cases(suite):
+    suite.case("text_to_image")(text_to_image_case({"highres_fix": []}))
+    suite.case("text_to_image_highres")(
+        text_to_image_case({"highres_fix": [{"scale": 1.5, "strength": 0.5}]})
+    )
+
+    @suite.case("load_model")
+    def load_model(suite):
+        state = job_state(suite, {})
+
+        def run():
+            # New pipes, so the pipeline cache does not hit
+            pipes = SDPipes()
+            pipes._load_model(state, suite.model_path)
+            pipes.close()
+
+        return run, state.close
+
+    @suite.case("load_safetensors_lora")
+    def lora(suite):
+        pipeline = types.SimpleNamespace(
+            unet=build_tiny_unet(), text_encoder=build_tiny_text_encoder()
+        )
+        path = f"{suite.root}/lora.safetensors"
+        make_lora_file(path, pipeline.unet, pipeline.text_encoder)
+        return lambda: load_safetensors_lora(pipeline, path, alpha=0.01), None
+
+    def update_embed_case(mode):
+        def setup(suite):
+            from diffusers import StableDiffusionPipeline
+
+            pipe = StableDiffusionPipeline.from_pretrained(
+                suite.model_path, local_files_only=True
+            )
+            prompt = Prompt(".")
+            text = "(masterpiece:1.2), a [photo] of a ((cat)), " + ", ".join(
+                f"tag{i}" for i in range(10)
+            )
+
+            def run():
+                # No cache: encode every time
+                prompt.key = None
+                with torch.inference_mode():
+                    prompt.update_embed(text, pipe, rng=random.Random(0), mode=mode)
+
+            return run, None
+
+        return setup
+
+    suite.case("update_embed_token", number=10)(update_embed_case("token"))
+    suite.case("update_embed_blend", number=10)(update_embed_case("blend"))
+
+    templates = make_templates()
+    wildcards = templates["wildcards 3x5000"]
+    nested = templates["nested 300"]
+
+    @suite.case("random_prompts_compile", number=3)
+    def random_compile(suite):
+        def run():
+            compile_template.cache_clear()
+            process_random_prompts(wildcards, random.Random(0))
+            process_random_prompts(nested, random.Random(0))
+
+        return run, None
+
+    @suite.case("random_prompts_sample", number=1000)
+    def random_sample(suite):
+        rng = random.Random(0)
+
+        def run():
+            process_random_prompts(wildcards, rng)
+            process_random_prompts(nested, rng)
+
+        return run, None
+
+    @suite.case("text_to_weighted_list", number=20)
+    def weighted(suite):
+        text = ", ".join(f"((word {i}:1.{i % 10})), [other {i}]" for i in range(500))
+
+        def run():
+            weighted_chunks.cache_clear()
+            _weighted_list.cache_clear()
+            text_to_weighted_list(text)
+
+        return run, None
+
+    mask = generate_mask("bench")
+    payload = make_payload(1024 * 1024)
+    encoded = aroma_encode(mask, payload)
+    suite.case("aroma_encode_1mb", number=5)(lambda suite: (lambda: aroma_encode(mask, payload), None))
+    suite.case("aroma_decode_1mb", number=5)(lambda suite: (lambda: aroma_decode(mask, encoded), None))
+
+    @suite.case("end_job", number=5)
+    def end_job(suite):
+        import PIL.Image
+
+        state = job_state(suite, {})
+        # Write synchronously, to time encode and write of the output
+        state.writer.close()
+        state.writer = None
+        state.start_job()
+        img = PIL.Image.effect_noise((512, 512), 64).convert("RGB")
+        return lambda: state.end_job(img, {"seed": 1}), state.close
+
+
+def environment():
+    commit = None
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(__file__),
+        ).stdout.strip() or None
+    except OSError:
+        pass
+    return {
+        "commit": commit,
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": platform.python_version(),
+        "torch": torch.__version__,
+        "device": torch_device(),
+        "threads": torch.get_num_threads(),
+        "machine": platform.machine(),
+        "processor": platform.processor(),
+    }
+
+
+def run_suite(out, repeat, only):
+    with tempfile.TemporaryDirectory() as root:
+        build_tiny_model_dir(f"{root}/models/tiny")
+        suite = Suite(root, repeat)
+        register_cases(suite)
+        results = suite.run(only)
+    data = {"version": RESULTS_VERSION, "environment": environment(), "results": results}
+    if out is not None:
+        with open(out, "w") as f:
+            json.dump(data, f, indent=2)
+        print(f"[INFO] Results are written to {out}")
+    return data
+
+
+def compare(baseline, current, threshold):
+    "Print ratios of current to baseline. Return names of regressed cases"
+    regressions = []
+    base = baseline["results"]
+    for name, r in current["results"].items():
+        if name not in base:
+            print(f"{name:24} new")
+            continue
+        ratio = r["min"] / base[name]["min"]
+        status = "ok"
+        if ratio > 1 + threshold:
+            status = "REGRESSION"
+            regressions.append(name)
+        elif ratio < 1 / (1 + threshold):
+            status = "faster"
+        print(
+            f"{name:24} {base[name]['min'] * 1000:10.3f}ms -> {r['min'] * 1000:10.3f}ms  "
+            f"x{ratio:5.2f}  {status}"
+        )
+    if baseline["environment"].get("device") != current["environment"].get("device"):
+        print("[WARN] Results are from different devices")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Offline benchmark suite")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("run")
+    p.add_argument("--out", default=None)
+    p.add_argument("--repeat", type=int, default=5)
+    p.add_argument("--only", default=None, help="comma separated case names")
+    p = sub.add_parser("compare")
+    p.add_argument("baseline")
+    p.add_argument("current")
+    p.add_argument("--threshold", type=float, default=0.25)
+    args = parser.parse_args()
+
+    if args.command == "run":
+        only = None if args.only is None else args.only.split(",")
+        run_suite(args.out, args.repeat, only)
+    else:
+        with open(args.baseline, "r") as f:
+            baseline = json.load(f)
+        with open(args.current, "r") as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.threshold)
+        if len(regressions) > 0:
+            print(f"[ERROR] {len(regressions)} regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
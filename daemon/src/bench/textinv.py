@@ -0,0 +1,77 @@
+import os
+import sys
+import tempfile
+import time
+
+import safetensors.torch
+import torch
+
+from core.textinv import TIManifest
+from bench.tiny import build_tiny_model_dir
+
+"""
+Benchmark of textual inversion loading: eager loading of every embedding
+(as model loads did before the manifest) against manifest refresh and
+lazy loading of the embeddings a prompt uses, for collections of N files.
+
+    python -m bench.textinv [n ...]
+"""
+
+
+def make_embeddings(root, n, dim=32):
+    ti_root = f"{root}/textual_inversion"
+    os.makedirs(ti_root, exist_ok=True)
+    torch.manual_seed(0)
+    for i in range(n):
+        safetensors.torch.save_file(
+            {"emb_params": torch.randn(2, dim)}, f"{ti_root}/tok{i}.safetensors"
+        )
+    return ti_root
+
+
+def load_pipeline(path):
+    from diffusers import StableDiffusionPipeline
+
+    return StableDiffusionPipeline.from_pretrained(path, local_files_only=True)
+
+
+def main():
+    sizes = [int(n) for n in sys.argv[1:]] or [10, 100, 400]
+    with tempfile.TemporaryDirectory() as tiny:
+        build_tiny_model_dir(f"{tiny}/tiny")
+        for n in sizes:
+            with tempfile.TemporaryDirectory() as root:
+                ti_root = make_embeddings(root, n)
+                names = sorted(os.listdir(ti_root))
+
+                # Eager: load every embedding into the pipeline
+                pipe = load_pipeline(f"{tiny}/tiny")
+                start = time.perf_counter()
+                for name in names:
+                    pipe.load_textual_inversion(
+                        f"{ti_root}/{name}", token=os.path.splitext(name)[0]
+                    )
+                eager = time.perf_counter() - start
+
+                # Manifest: cold build, warm refresh, and lazy load of one token
+                manifest_path = f"{root}/ti_manifest.json"
+                start = time.perf_counter()
+                TIManifest(root, manifest_path).refresh(force=True)
+                cold = time.perf_counter() - start
+
+                pipe = load_pipeline(f"{tiny}/tiny")
+                start = time.perf_counter()
+                manifest = TIManifest(root, manifest_path)
+                manifest.refresh(force=True)
+                loaded = {}
+                manifest.load_for(pipe, loaded, ["a photo of tok1, best quality"])
+                lazy = time.perf_counter() - start
+
+                print(
+                    f"n={n:5}  eager {eager:8.3f}s  manifest cold {cold:7.3f}s  "
+                    f"warm refresh + lazy load {lazy:7.3f}s  loaded {len(loaded)}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,183 @@
+import torch
+
+"""
+Tiny random-weight components for offline benchmarks.
+Nothing is downloaded; shapes are small enough to run on cpu.
+"""
+
+
+def build_tiny_unet(cross_attention_dim=32, block_out_channels=(32, 64)):
+    from diffusers import UNet2DConditionModel
+
+    torch.manual_seed(0)
+    return UNet2DConditionModel(
+        sample_size=16,
+        in_channels=4,
+        out_channels=4,
+        layers_per_block=2,
+        block_out_channels=tuple(block_out_channels),
+        down_block_types=("CrossAttnDownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=cross_attention_dim,
+        attention_head_dim=8,
+    )
+
+
+def build_tiny_text_encoder(hidden_size=32, vocab_size=1000):
+    from transformers import CLIPTextConfig, CLIPTextModel
+
+    torch.manual_seed(0)
+    config = CLIPTextConfig(
+        bos_token_id=0,
+        eos_token_id=2,
+        pad_token_id=1,
+        vocab_size=vocab_size,
+        hidden_size=hidden_size,
+        intermediate_size=37,
+        num_hidden_layers=4,
+        num_attention_heads=4,
+        max_position_embeddings=77,
+        layer_norm_eps=1e-05,
+    )
+    return CLIPTextModel(config)
+
+
+def lora_targets(unet, text_encoder):
+    "Return list of (lora key base, module) as kohya style LoRA names them"
+    targets = []
+    for prefix, root, scope in [
+        ("lora_unet", unet, "attentions"),
+        ("lora_te", text_encoder, "encoder.layers"),
+    ]:
+        for name, module in root.named_modules():
+            if scope not in name:
+                continue
+            is_linear = isinstance(module, torch.nn.Linear)
+            is_conv1x1 = (
+                isinstance(module, torch.nn.Conv2d) and module.kernel_size == (1, 1)
+            )
+            if is_linear or is_conv1x1:
+                targets.append((prefix + "_" + name.replace(".", "_"), module))
+    return targets
+
+
+def make_lora_file(path, unet, text_encoder, rank=4):
+    "Write a synthetic LoRA .safetensors for the components. Return key count"
+    import safetensors.torch
+
+    torch.manual_seed(1)
+    state_dict = {}
+    for base, module in lora_targets(unet, text_encoder):
+        w = module.weight
+        out_dim, in_dim = w.shape[0], w.shape[1]
+        extra = tuple(w.shape[2:])
+        state_dict[f"{base}.lora_down.weight"] = torch.randn((rank, in_dim) + extra) * 0.01
+        state_dict[f"{base}.lora_up.weight"] = torch.randn((out_dim, rank) + extra) * 0.01
+        state_dict[f"{base}.alpha"] = torch.tensor(float(rank))
+    safetensors.torch.save_file(state_dict, path)
+    return len(state_dict)
+
+
+def _byte_chars():
+    # Printable characters of the byte-level BPE of CLIP tokenizer
+    bs = (
+        list(range(ord("!"), ord("~") + 1))
+        + list(range(ord("¡"), ord("¬") + 1))
+        + list(range(ord("®"), ord("ÿ") + 1))
+    )
+    cs = bs[:]
+    n = 0
+    for b in range(2**8):
+        if b not in bs:
+            bs.append(b)
+            cs.append(2**8 + n)
+            n += 1
+    return [chr(c) for c in cs]
+
+
+def build_tiny_model_dir(path, block_out_channels=(32, 64)):
+    """
+    Save a tiny random-weight StableDiffusionPipeline to path (diffusers
+    layout), loadable by the daemon as a model. The tokenizer is char-level.
+    Wider block_out_channels make a larger UNet. Return path.
+    """
+    import json
+    import os
+    import tempfile
+
+    from diffusers import AutoencoderKL, DDIMScheduler, StableDiffusionPipeline
+    from transformers import CLIPTokenizer
+
+    vocab = {"<|startoftext|>": 0, "!": 1, "<|endoftext|>": 2}
+    for c in _byte_chars():
+        for token in [c, c + "</w>"]:
+            if token not in vocab:
+                vocab[token] = len(vocab)
+    with tempfile.TemporaryDirectory() as tmp:
+        with open(os.path.join(tmp, "vocab.json"), "w") as f:
+            json.dump(vocab, f)
+        with open(os.path.join(tmp, "merges.txt"), "w") as f:
+            f.write("#version: 0.2\n")
+        tokenizer = CLIPTokenizer(
+            os.path.join(tmp, "vocab.json"),
+            os.path.join(tmp, "merges.txt"),
+            pad_token="!",
+            model_max_length=77,
+        )
+        torch.manual_seed(0)
+        vae = AutoencoderKL(
+            in_channels=3,
+            out_channels=3,
+            block_out_channels=[32, 64],
+            down_block_types=["DownEncoderBlock2D", "DownEncoderBlock2D"],
+            up_block_types=["UpDecoderBlock2D", "UpDecoderBlock2D"],
+            latent_channels=4,
+        )
+        pipe = StableDiffusionPipeline(
+            vae=vae,
+            text_encoder=build_tiny_text_encoder(vocab_size=len(vocab)),
+            tokenizer=tokenizer,
+            unet=build_tiny_unet(block_out_channels=block_out_channels),
+            scheduler=DDIMScheduler(
+                beta_start=0.00085,
+                beta_end=0.012,
+                beta_schedule="scaled_linear",
+                clip_sample=False,
+                set_alpha_to_one=False,
+            ),
+            safety_checker=None,
+            feature_extractor=None,
+            requires_safety_checker=False,
+        )
+        pipe.save_pretrained(path, safe_serialization=True)
+    return path
+
+
+def make_state(root, overrides):
+    "State with default_config.json, roots under root, and overrides merged"
+    import json
+    import os
+
+    from core.state import State, merge_dict
+
+    config = os.path.join(os.path.dirname(__file__), "..", "..", "..", "default_config.json")
+    with open(config, "r") as f:
+        d = json.load(f)
+    for name in ["state", "outputs"]:
+        os.makedirs(f"{root}/{name}", exist_ok=True)
+    d.update(
+        models_root=f"{root}/models",
+        state_root=f"{root}/state",
+        outputs_root=f"{root}/outputs",
+    )
+    # Benchmarks time generation: repeated seeded jobs must run
+    d["result_cache"] = {"enabled": False}
+    merge_dict(d, overrides)
+    return State(d)
+
+
+if __name__ == "__main__":
+    # python -m bench.tiny <path>: write a tiny model for testing the daemon
+    import sys
+
+    print(build_tiny_model_dir(sys.argv[1] if len(sys.argv) > 1 else "models/tiny"))
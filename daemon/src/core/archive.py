@@ -0,0 +1,558 @@
+import json
+import os
+import struct
+import tarfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from .container import read_output, LEGACY_EXT
+from .preview import THUMBS_DIR
+
+"""
+Archives of outputs
+
+Selected outputs (all files of an output name, with its thumbnail) are
+streamed into a tar or zip file. The stream is cut into segments of about
+`segment_mb` at output boundaries; worker threads read and compress
+segments in parallel (zlib and zstd release the GIL) and the main thread
+appends them in order.
+
+- tar: each segment is one or more gzip members / zstd frames, so the file
+  is a plain .tar.gz / .tar.zst (readers concatenate members / frames).
+- zip: each file is an entry, compressed with deflate or zstd (method 93).
+
+Payloads which are already compressed (.ab containers, whose masked bytes
+look random, and raw images) are stored: as stored zip entries, and in tar
+streams as gzip level 0 / raw zstd blocks.
+
+The archive is written to <path>.part. After each segment, the end offset
+and the outputs in it are appended to <path>.manifest (json lines), so an
+interrupted archive resumes from its last segment instead of starting over.
+The .part file is renamed and the manifest removed when the archive ends.
+
+With export_legacy, legacy .a outputs are decoded in a process pool and
+archived as plain image and json files.
+"""
+
+FORMATS = ["tar", "zip"]
+COMPRESSIONS = ["gzip", "zstd", "none"]
+DEFAULT_LEVELS = {"gzip": 6, "zstd": 3, "none": 0}
+MANIFEST_VERSION = 1
+
+# Already compressed (or masked) payloads, stored without recompression
+STORED_EXTS = {".ab", ".webp", ".png", ".jpg", ".jpeg"}
+
+ZIP_STORED = 0
+ZIP_DEFLATED = 8
+ZIP_ZSTD = 93
+ZIP_UTF8 = 0x800
+ZIP_LIMIT = 0xFFFFFFFF
+ZIP_COUNT_LIMIT = 0xFFFF
+ZIP_LOCAL = struct.Struct("<IHHHHHIIIHH")
+ZIP_CENTRAL = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP_END64 = struct.Struct("<IQHHIIQQQQ")
+ZIP_LOCATOR64 = struct.Struct("<IIQI")
+ZIP_END = struct.Struct("<IHHHHIIH")
+
+# zstd frame of raw blocks (RFC 8878): magic, descriptor (window
+# descriptor present, no content size), window 128KB
+ZSTD_MAGIC = struct.pack("<I", 0xFD2FB528)
+ZSTD_RAW_HEADER = ZSTD_MAGIC + bytes([0x00, 7 << 3])
+ZSTD_BLOCK_MAX = 128 * 1024
+
+
+def archive_suffix(fmt, compression):
+    if fmt == "zip":
+        return "zip"
+    return {"gzip": "tar.gz", "zstd": "tar.zst", "none": "tar"}[compression]
+
+
+def archive_name(fmt, compression, now=None):
+    "File name of a new archive, e.g. out-230101-120000.tar.gz"
+    stamp = time.strftime("%y%m%d-%H%M%S", time.localtime(now))
+    return f"out-{stamp}.{archive_suffix(fmt, compression)}"
+
+
+def find_unfinished(archives_root, fmt, compression):
+    "Return path of the newest unfinished archive of the format, or None"
+    suffix = f".{archive_suffix(fmt, compression)}.part"
+    paths = []
+    for entry in os.scandir(archives_root):
+        if entry.name.endswith(suffix):
+            path = entry.path[: -len(".part")]
+            if os.path.exists(f"{path}.manifest"):
+                paths.append(path)
+    return max(paths) if len(paths) > 0 else None
+
+
+def output_files(outputs_root, names):
+    "Return {name: [(arcname, path)]} of all files of each output name"
+    names = set(names)
+    files = {name: [] for name in names}
+    for root, prefix in [(outputs_root, ""), (f"{outputs_root}/{THUMBS_DIR}", f"{THUMBS_DIR}/")]:
+        if not os.path.isdir(root):
+            continue
+        for entry in os.scandir(root):
+            name = os.path.splitext(entry.name)[0]
+            if name in names and entry.is_file():
+                files[name].append((prefix + entry.name, entry.path))
+    for name in files:
+        files[name].sort()
+    return files
+
+
+def remove_outputs(outputs_root, names):
+    "Remove all files of the output names. Return number of removed files"
+    removed = 0
+    for files in output_files(outputs_root, names).values():
+        for _, path in files:
+            try:
+                os.remove(path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def _file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _image_ext(data):
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp"
+    if data[:8] == b"\x89PNG\r\n\x1a\n":
+        return "png"
+    if data[:2] == b"\xff\xd8":
+        return "jpg"
+    return "bin"
+
+
+def decode_legacy(args):
+    """
+    Decode a legacy output to plain files. Run in a worker process.
+    Return (name, [(file name, bytes)], error)
+    """
+    path, mask = args
+    name = os.path.splitext(os.path.basename(path))[0]
+    try:
+        job, image = read_output(path, mask)
+    except Exception as e:
+        return name, None, f"{path}: {e}"
+    files = [(f"{name}.json", json.dumps(job).encode("utf-8"))]
+    if image is not None:
+        files.append((f"{name}.{_image_ext(image)}", image))
+    return name, files, None
+
+
+def export_legacy(outputs_root, names, out_dir, mask, workers=None):
+    """
+    Write legacy outputs of names as plain image and json files to out_dir,
+    decoding in parallel processes. Return (exported, failed)
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = [f"{outputs_root}/{name}.{LEGACY_EXT}" for name in names]
+    paths = [path for path in paths if os.path.exists(path)]
+    exported, failed = 0, 0
+    if len(paths) == 0:
+        return exported, failed
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, min(64, len(paths) // (4 * workers)))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for _, files, error in pool.map(
+            decode_legacy, [(path, mask) for path in paths], chunksize=chunksize
+        ):
+            if files is None:
+                print(f"[WARN] Cannot export output {error}")
+                failed += 1
+                continue
+            for file_name, data in files:
+                with open(f"{out_dir}/{file_name}", "wb") as f:
+                    f.write(data)
+            exported += 1
+    return exported, failed
+
+
+def _zstd_raw(data):
+    "zstd frame which stores data in raw blocks"
+    parts = [ZSTD_RAW_HEADER]
+    view = memoryview(data)
+    n = len(view)
+    pos = 0
+    while True:
+        size = min(ZSTD_BLOCK_MAX, n - pos)
+        last = 1 if pos + size >= n else 0
+        parts.append((last | (size << 3)).to_bytes(3, "little"))
+        parts.append(view[pos : pos + size])
+        pos += size
+        if last:
+            return b"".join(parts)
+
+
+def _dos_time(mtime):
+    t = time.localtime(mtime)
+    if t.tm_year < 1980:
+        return 0, (1 << 5) | 1
+    return (
+        (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2),
+        ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday,
+    )
+
+
+def _tar_header(arcname, size, mtime):
+    info = tarfile.TarInfo(arcname)
+    info.size = size
+    info.mtime = int(mtime)
+    info.mode = 0o644
+    return info.tobuf(tarfile.PAX_FORMAT, "utf-8", "surrogateescape")
+
+
+def _tar_padding(size):
+    return b"\0" * (-size % tarfile.BLOCKSIZE)
+
+
+class ArchiveBuilder:
+    def __init__(
+        self,
+        path,
+        mask,
+        fmt="tar",
+        compression="gzip",
+        level=None,
+        workers=None,
+        segment_mb=16,
+        export_legacy=False,
+    ):
+        if fmt not in FORMATS:
+            raise Exception(f"Unknown archive format {fmt}")
+        if compression not in COMPRESSIONS:
+            raise Exception(f"Unknown archive compression {compression}")
+        self.path = path
+        self.mask = mask
+        self.fmt = fmt
+        self.compression = compression
+        self.level = DEFAULT_LEVELS[compression] if level is None else int(level)
+        self.workers = workers or os.cpu_count() or 1
+        self.segment_bytes = max(1, int(segment_mb * 1024 * 1024))
+        self.export_legacy = export_legacy
+        self.zstd = None
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise Exception("zstd compression needs the zstandard package")
+            self.zstd = zstandard
+        self.part_path = f"{path}.part"
+        self.manifest_path = f"{path}.manifest"
+        self.options = {
+            "version": MANIFEST_VERSION,
+            "format": fmt,
+            "compression": compression,
+            "export_legacy": export_legacy,
+        }
+
+    @classmethod
+    def from_config(cls, path, mask, d, **overrides):
+        "ArchiveBuilder with options of the archive config, then overrides"
+        options = {
+            "fmt": d.get("format", "tar"),
+            "compression": d.get("compression", "gzip"),
+            "level": d.get("level"),
+            "workers": d.get("workers") or None,
+            "segment_mb": d.get("segment_mb", 16),
+            "export_legacy": d.get("export_legacy", False),
+        }
+        options.update({k: v for k, v in overrides.items() if v is not None})
+        return cls(path, mask, **options)
+
+    # Compression
+
+    def _compress(self, data, stored):
+        "Compress a run of the tar stream as one gzip member / zstd frame"
+        if self.compression == "gzip":
+            return zlib.compress(data, 0 if stored else self.level, wbits=31)
+        if self.compression == "zstd":
+            if stored:
+                return _zstd_raw(data)
+            return self.zstd.ZstdCompressor(level=self.level).compress(data)
+        return data
+
+    def _compress_entry(self, data, stored):
+        "Return (zip method, compressed bytes) of a zip entry"
+        if stored or self.compression == "none":
+            return ZIP_STORED, data
+        if self.compression == "gzip":
+            c = zlib.compressobj(self.level, zlib.DEFLATED, -15)
+            return ZIP_DEFLATED, c.compress(data) + c.flush()
+        return ZIP_ZSTD, self.zstd.ZstdCompressor(level=self.level).compress(data)
+
+    # Segments
+
+    def _segments(self, files):
+        "Split outputs into segments of about segment_bytes, at output boundaries"
+        segment, size = [], 0
+        for name in sorted(files):
+            segment.append((name, files[name]))
+            size += sum(_file_size(path) for _, path in files[name])
+            if size >= self.segment_bytes:
+                yield segment
+                segment, size = [], 0
+        if len(segment) > 0:
+            yield segment
+
+    def _read_files(self, name, files, pool):
+        "Return [(arcname, bytes, mtime, stored)] of an output"
+        items, exported_items = [], []
+        for arcname, path in files:
+            try:
+                mtime = os.stat(path).st_mtime
+                if self.export_legacy and arcname == f"{name}.{LEGACY_EXT}":
+                    _, exported, error = pool.submit(decode_legacy, (path, self.mask)).result()
+                    if exported is None:
+                        print(f"[WARN] Cannot export output {error}, archived as is")
+                    else:
+                        for file_name, data in exported:
+                            stored = os.path.splitext(file_name)[1] in STORED_EXTS
+                            exported_items.append((file_name, data, mtime, stored))
+                        continue
+                with open(path, "rb") as f:
+                    data = f.read()
+            except FileNotFoundError:
+                # Removed since listed
+                continue
+            stored = os.path.splitext(arcname)[1] in STORED_EXTS
+            items.append((arcname, data, mtime, stored))
+        # Raw files of the output (save_raw) are kept over exported ones
+        names = set(item[0] for item in items)
+        return items + [item for item in exported_items if item[0] not in names]
+
+    def _build_segment(self, segment, pool):
+        """
+        Read and compress a segment. Return (bytes, names, entries), where
+        entries are zip central directory entries with offsets relative to
+        the segment
+        """
+        parts, entries = [], []
+        if self.fmt == "tar":
+            # Runs of stored and compressed bytes, each compressed at once.
+            # Headers and padding of stored files are compressed
+            run, run_stored = [], False
+
+            def add(data, stored):
+                nonlocal run, run_stored
+                if stored != run_stored and len(run) > 0:
+                    parts.append(self._compress(b"".join(run), run_stored))
+                    run = []
+                run_stored = stored
+                run.append(data)
+
+            for name, files in segment:
+                for arcname, data, mtime, stored in self._read_files(name, files, pool):
+                    add(_tar_header(arcname, len(data), mtime), False)
+                    add(data, stored)
+                    add(_tar_padding(len(data)), False)
+            if len(run) > 0:
+                parts.append(self._compress(b"".join(run), run_stored))
+        else:
+            offset = 0
+            for name, files in segment:
+                for arcname, data, mtime, stored in self._read_files(name, files, pool):
+                    method, cdata = self._compress_entry(data, stored)
+                    if len(data) >= ZIP_LIMIT or len(cdata) >= ZIP_LIMIT:
+                        raise Exception(f"{arcname} is too large for a zip entry")
+                    dos_time, dos_date = _dos_time(mtime)
+                    entry = [
+                        arcname,
+                        method,
+                        zlib.crc32(data),
+                        len(cdata),
+                        len(data),
+                        offset,
+                        dos_time,
+                        dos_date,
+                    ]
+                    header = self._zip_local_header(entry)
+                    parts += [header, cdata]
+                    offset += len(header) + len(cdata)
+                    entries.append(entry)
+        return b"".join(parts), [name for name, _ in segment], entries
+
+    # Zip records
+
+    def _zip_version(self, method, zip64=False):
+        return 63 if method == ZIP_ZSTD else 45 if zip64 else 20
+
+    def _zip_local_header(self, entry):
+        arcname, method, crc, csize, usize, _, dos_time, dos_date = entry
+        name = arcname.encode("utf-8")
+        header = ZIP_LOCAL.pack(
+            0x04034B50,
+            self._zip_version(method),
+            ZIP_UTF8,
+            method,
+            dos_time,
+            dos_date,
+            crc,
+            csize,
+            usize,
+            len(name),
+            0,
+        )
+        return header + name
+
+    def _zip_central_directory(self, entries, cd_offset):
+        "Central directory and end records of entries (absolute offsets)"
+        parts = []
+        for arcname, method, crc, csize, usize, offset, dos_time, dos_date in entries:
+            name = arcname.encode("utf-8")
+            zip64 = offset >= ZIP_LIMIT
+            extra = struct.pack("<HHQ", 0x0001, 8, offset) if zip64 else b""
+            version = self._zip_version(method, zip64)
+            parts.append(
+                ZIP_CENTRAL.pack(
+                    0x02014B50,
+                    (3 << 8) | version,
+                    version,
+                    ZIP_UTF8,
+                    method,
+                    dos_time,
+                    dos_date,
+                    crc,
+                    csize,
+                    usize,
+                    len(name),
+                    len(extra),
+                    0,
+                    0,
+                    0,
+                    0o100644 << 16,
+                    ZIP_LIMIT if zip64 else offset,
+                )
+            )
+            parts += [name, extra]
+        cd = b"".join(parts)
+        count = len(entries)
+        end = b""
+        if count >= ZIP_COUNT_LIMIT or len(cd) >= ZIP_LIMIT or cd_offset >= ZIP_LIMIT:
+            end64_offset = cd_offset + len(cd)
+            end = ZIP_END64.pack(
+                0x06064B50, ZIP_END64.size - 12, 45, 45, 0, 0, count, count, len(cd), cd_offset
+            ) + ZIP_LOCATOR64.pack(0x07064B50, 0, end64_offset, 1)
+        end += ZIP_END.pack(
+            0x06054B50,
+            0,
+            0,
+            min(count, ZIP_COUNT_LIMIT),
+            min(count, ZIP_COUNT_LIMIT),
+            min(len(cd), ZIP_LIMIT),
+            min(cd_offset, ZIP_LIMIT),
+            0,
+        )
+        return cd + end
+
+    def _tail(self, offset, entries):
+        "Bytes which end the archive"
+        if self.fmt == "zip":
+            return self._zip_central_directory(entries, offset)
+        return self._compress(b"\0" * (2 * tarfile.BLOCKSIZE), False)
+
+    # Manifest
+
+    def _load_manifest(self):
+        """
+        Return (offset, done names, zip entries) of an unfinished archive,
+        or None if there is nothing to resume
+        """
+        if not (os.path.exists(self.part_path) and os.path.exists(self.manifest_path)):
+            return None
+        offset, done, entries = 0, set(), []
+        with open(self.manifest_path, "r") as f:
+            lines = f.read().split("\n")
+        try:
+            if json.loads(lines[0]) != self.options:
+                print(f"[WARN] Options of {self.path} changed, archive it again")
+                return None
+        except ValueError:
+            return None
+        for line in lines[1:]:
+            try:
+                seg = json.loads(line)
+            except ValueError:
+                # Partial last line of an interrupted write
+                break
+            offset = seg["offset"]
+            done.update(seg["names"])
+            entries += seg["entries"]
+        if os.path.getsize(self.part_path) < offset:
+            print(f"[WARN] {self.part_path} is shorter than its manifest, archive it again")
+            return None
+        return offset, done, entries
+
+    def build(self, outputs_root, names, progress=None):
+        """
+        Archive outputs of names, resuming an unfinished archive of the same
+        path. progress(done, total) is called after each segment. Return
+        names of archived outputs (with those archived before resuming)
+        """
+        resumed = self._load_manifest()
+        if resumed is None:
+            offset, done, entries = 0, set(), []
+            with open(self.manifest_path, "w") as f:
+                f.write(json.dumps(self.options) + "\n")
+            mode = "wb"
+        else:
+            offset, done, entries = resumed
+            print(f"[INFO] Resume {self.path}: {len(done)} outputs archived")
+            mode = "r+b"
+        files = output_files(outputs_root, [name for name in names if name not in done])
+        files = {name: f for name, f in files.items() if len(f) > 0}
+        total = len(done) + len(files)
+        archived = list(done)
+
+        with open(self.part_path, mode) as out, open(self.manifest_path, "a") as manifest:
+            out.truncate(offset)
+            out.seek(offset)
+
+            def commit(future):
+                nonlocal offset
+                data, seg_names, seg_entries = future.result()
+                for entry in seg_entries:
+                    entry[5] += offset
+                out.write(data)
+                out.flush()
+                os.fsync(out.fileno())
+                offset += len(data)
+                entries.extend(seg_entries)
+                archived.extend(seg_names)
+                line = {"offset": offset, "names": seg_names, "entries": seg_entries}
+                manifest.write(json.dumps(line) + "\n")
+                manifest.flush()
+                if progress is not None:
+                    progress(len(archived), total)
+
+            decode_pool = None
+            if self.export_legacy:
+                decode_pool = ProcessPoolExecutor(max_workers=self.workers)
+            try:
+                with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                    # Segments are written in order; at most 2 per worker in memory
+                    pending = deque()
+                    for segment in self._segments(files):
+                        if len(pending) >= 2 * self.workers:
+                            commit(pending.popleft())
+                        pending.append(pool.submit(self._build_segment, segment, decode_pool))
+                    while len(pending) > 0:
+                        commit(pending.popleft())
+            finally:
+                if decode_pool is not None:
+                    decode_pool.shutdown()
+            out.write(self._tail(offset, entries))
+            out.truncate()
+        os.replace(self.part_path, self.path)
+        os.remove(self.manifest_path)
+        return archived
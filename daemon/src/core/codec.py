@@ -0,0 +1,148 @@
+import base64
+import zlib
+
+import numpy as np
+
+"""
+Aroma codec
+
+aroma_encode(mask, s) = base64(scan(mask, gzip(s)[2:]))
+where scan is a cumulative XOR: b[i] = p[i] ^ mask[i % len(mask)] ^ b[i - 1].
+Decoding is the elementwise inverse: p[i] = b[i] ^ b[i - 1] ^ mask[i % len(mask)].
+
+Both are done with numpy over whole chunks. Streaming encoder/decoder keep
+the mask position and the last byte, so a payload can be processed in any
+number of chunks and produce exactly the same bytes.
+"""
+
+# gzip magic number, which is not stored in encoded data
+GZIP_MAGIC = b"\x1f\x8b"
+
+
+def mask_array(mask):
+    # If mask is not provided, use 0x00
+    if mask is None or len(mask) == 0:
+        mask = b"\x00"
+    return np.frombuffer(bytes(mask), dtype=np.uint8)
+
+
+def tiled_mask(mask, pos, n):
+    "Return mask[(pos + i) % len(mask)] for i in range(n)"
+    l = len(mask)
+    return np.resize(np.roll(mask, -(pos % l)), n)
+
+
+def xor_scan(mask, data, pos=0, last=0):
+    "Mask data for encoding. Return (masked bytes, new last byte)"
+    if len(data) == 0:
+        return b"", last
+    x = np.frombuffer(data, dtype=np.uint8) ^ tiled_mask(mask, pos, len(data))
+    x[0] ^= last
+    x = np.bitwise_xor.accumulate(x)
+    return x.tobytes(), int(x[-1])
+
+
+def xor_unscan(mask, data, pos=0, last=0):
+    "Unmask encoded data. Return (plain bytes, new last byte)"
+    if len(data) == 0:
+        return b"", last
+    b = np.frombuffer(data, dtype=np.uint8)
+    x = b ^ tiled_mask(mask, pos, len(data))
+    x[0] ^= last
+    x[1:] ^= b[:-1]
+    return x.tobytes(), int(b[-1])
+
+
+class AromaEncoder:
+    """
+    Streaming aroma encoder.
+    update/finish return base64 (ascii bytes); the concatenation of all
+    returned chunks is the encoded string.
+    """
+
+    def __init__(self, mask=None, level=9):
+        self.mask = mask_array(mask)
+        # wbits=31: gzip container with mtime 0, so output is deterministic
+        self.z = zlib.compressobj(level, zlib.DEFLATED, 31)
+        self.skip = len(GZIP_MAGIC)
+        self.pos = 0
+        self.last = 0
+        self.rest = b""
+
+    def _emit(self, c, final=False):
+        # Remove magic number 1f 8b
+        if self.skip > 0:
+            n = min(self.skip, len(c))
+            c = c[n:]
+            self.skip -= n
+        masked, self.last = xor_scan(self.mask, c, self.pos, self.last)
+        self.pos += len(c)
+        # base64 works on 3 bytes groups, keep the remainder for next chunk
+        buf = self.rest + masked
+        n = len(buf) if final else len(buf) - len(buf) % 3
+        self.rest = buf[n:]
+        return base64.b64encode(buf[:n])
+
+    def update(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        return self._emit(self.z.compress(data))
+
+    def finish(self):
+        return self._emit(self.z.flush(), final=True)
+
+
+class AromaDecoder:
+    """
+    Streaming aroma decoder.
+    update accepts base64 chunks (str or bytes) split at any position and
+    returns decompressed bytes available so far.
+    """
+
+    def __init__(self, mask=None):
+        self.mask = mask_array(mask)
+        self.z = zlib.decompressobj(31)
+        self.pos = 0
+        self.last = 0
+        self.rest = b""
+        # Add magic number 1f 8b (header is never complete here, so no output)
+        self.z.decompress(GZIP_MAGIC)
+
+    def _feed(self, raw):
+        plain, self.last = xor_unscan(self.mask, raw, self.pos, self.last)
+        self.pos += len(raw)
+        return self.z.decompress(plain)
+
+    def update(self, data):
+        if isinstance(data, str):
+            data = data.encode("ascii")
+        # Ignore whitespaces and padding, and keep 4 chars groups
+        buf = self.rest + data.translate(None, b" \t\r\n=")
+        n = len(buf) - len(buf) % 4
+        self.rest = buf[n:]
+        return self._feed(base64.b64decode(buf[:n]))
+
+    def finish(self):
+        out = b""
+        if len(self.rest) > 0:
+            # Restore padding of the last group
+            rest = self.rest + b"=" * (-len(self.rest) % 4)
+            self.rest = b""
+            out = self._feed(base64.b64decode(rest))
+        out += self.z.flush()
+        if not self.z.eof:
+            raise Exception("Truncated aroma data")
+        return out
+
+
+def aroma_encode(mask, s):
+    e = AromaEncoder(mask)
+    return (e.update(s) + e.finish()).decode("ascii")
+
+
+def aroma_decode(mask, s):
+    d = AromaDecoder(mask)
+    b = d.update(s) + d.finish()
+    # Convert bytes to string
+    return b.decode("utf-8")
+
@@ -0,0 +1,148 @@
+import base64
+import json
+import mmap
+import os
+import struct
+
+from .codec import aroma_decode, mask_array, xor_scan, xor_unscan
+
+"""
+Aroma binary output container (.ab)
+
+    offset  size  field
+    0       4     magic b"ARMB"
+    4       1     version (1)
+    5       1     flags (bit 0: masked)
+    6       2     reserved (0)
+    8       4     metadata length (little endian)
+    12      8     image length (little endian)
+    20      -     metadata (utf-8 json, masked)
+    -       -     image bytes as encoded by PIL (masked)
+
+Metadata and image are masked separately with the aroma XOR scan, each
+starting from position 0, so the metadata can be read without touching
+the image. Image bytes are not compressed again (webp/png/jpeg already are).
+
+Legacy outputs (.a) are base64(aroma(json with base64 image)).
+"""
+
+MAGIC = b"ARMB"
+VERSION = 1
+FLAG_MASKED = 0x01
+HEADER = struct.Struct("<4sBBHIQ")
+
+BINARY_EXT = "ab"
+LEGACY_EXT = "a"
+
+
+def encode_container(mask, meta, image_bytes):
+    "Return container bytes for metadata dict and image bytes"
+    m = mask_array(mask)
+    meta_bytes = json.dumps(meta).encode("utf-8")
+    meta_bytes, _ = xor_scan(m, meta_bytes)
+    image_bytes, _ = xor_scan(m, image_bytes)
+    header = HEADER.pack(
+        MAGIC, VERSION, FLAG_MASKED, 0, len(meta_bytes), len(image_bytes)
+    )
+    return b"".join([header, meta_bytes, image_bytes])
+
+
+def write_bytes(path, data):
+    # Write to temporary file and rename, so readers never see partial file
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def write_container(path, mask, meta, image_bytes):
+    write_bytes(path, encode_container(mask, meta, image_bytes))
+
+
+def parse_header(buf):
+    "Return (flags, meta_offset, meta_len, image_offset, image_len)"
+    if len(buf) < HEADER.size:
+        raise Exception("Invalid aroma container: too short")
+    magic, version, flags, _, meta_len, image_len = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise Exception("Invalid aroma container: bad magic")
+    if version > VERSION:
+        raise Exception(f"Unsupported aroma container version {version}")
+    meta_offset = HEADER.size
+    image_offset = meta_offset + meta_len
+    if len(buf) < image_offset + image_len:
+        raise Exception("Invalid aroma container: truncated")
+    return flags, meta_offset, meta_len, image_offset, image_len
+
+
+def _unmask(mask, flags, view):
+    if flags & FLAG_MASKED:
+        return xor_unscan(mask_array(mask), view)[0]
+    return bytes(view)
+
+
+def _read_container(path, mask, with_meta=True, with_image=True):
+    meta, image = None, None
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            with memoryview(m) as view:
+                flags, mo, ml, io, il = parse_header(view)
+                if with_meta:
+                    meta = json.loads(_unmask(mask, flags, view[mo : mo + ml]))
+                if with_image:
+                    image = _unmask(mask, flags, view[io : io + il])
+    return meta, image
+
+
+def is_container(path):
+    with open(path, "rb") as f:
+        return f.read(len(MAGIC)) == MAGIC
+
+
+def _read_legacy(path, mask):
+    with open(path, "r") as f:
+        job = json.loads(aroma_decode(mask, f.read()))
+    image = job.pop("image", None)
+    if image is not None:
+        image = base64.b64decode(image)
+    return job, image
+
+
+def read_metadata(path, mask):
+    "Read only metadata of output file (binary or legacy)"
+    if is_container(path):
+        return _read_container(path, mask, with_image=False)[0]
+    return _read_legacy(path, mask)[0]
+
+
+def read_image(path, mask):
+    "Read only image bytes of output file (binary or legacy)"
+    if is_container(path):
+        return _read_container(path, mask, with_meta=False)[1]
+    return _read_legacy(path, mask)[1]
+
+
+def read_output(path, mask):
+    "Read (metadata, image bytes) of output file (binary or legacy)"
+    if is_container(path):
+        return _read_container(path, mask)
+    return _read_legacy(path, mask)
+
+
+def find_output(outputs_root, file_prefix):
+    "Return path of output file for the prefix, preferring binary container"
+    for ext in [BINARY_EXT, LEGACY_EXT]:
+        path = f"{outputs_root}/{file_prefix}.{ext}"
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def list_outputs(outputs_root):
+    "Return sorted file prefixes of all outputs in the directory"
+    prefixes = set()
+    for name in os.listdir(outputs_root):
+        prefix, ext = os.path.splitext(name)
+        if ext in [f".{BINARY_EXT}", f".{LEGACY_EXT}"]:
+            prefixes.add(prefix)
+    return sorted(prefixes)
@@ -0,0 +1,181 @@
+import importlib
+import json
+import os
+import time
+from contextlib import contextmanager
+
+import safetensors
+import torch
+from diffusers import DiffusionPipeline, ModelMixin
+
+"""
+Fast model loading
+
+Components with weights are created without allocating or initializing
+parameters (on the meta device), then each tensor is read from the
+memory-mapped weights file (.safetensors, or .bin with torch.load mmap)
+and materialized directly on the target device and dtype, one at a time.
+Nothing is loaded twice: clip_skip builds the text encoder with fewer
+layers, and skips the weights of the removed layers.
+
+Other components (tokenizer, scheduler, ...) are loaded by
+DiffusionPipeline.from_pretrained as usual. If a model cannot be loaded
+this way (e.g. renamed keys of old checkpoints), fast_load_pipeline raises,
+and the caller falls back to from_pretrained.
+"""
+
+# Weight files in order of preference
+WEIGHT_FILES = [
+    "diffusion_pytorch_model.safetensors",
+    "model.safetensors",
+    "diffusion_pytorch_model.bin",
+    "pytorch_model.bin",
+]
+
+# Components which are never used by the daemon
+SKIP_COMPONENTS = ["safety_checker"]
+
+
+@contextmanager
+def empty_weights():
+    "Create parameters on the meta device: no memory and no init"
+    register_parameter = torch.nn.Module.register_parameter
+
+    def register_meta_parameter(module, name, param):
+        register_parameter(module, name, param)
+        if param is not None:
+            module._parameters[name] = torch.nn.Parameter(
+                param.to("meta"), requires_grad=param.requires_grad
+            )
+
+    torch.nn.Module.register_parameter = register_meta_parameter
+    try:
+        yield
+    finally:
+        torch.nn.Module.register_parameter = register_parameter
+
+
+def _set_tensor(module, key, tensor):
+    *path, leaf = key.split(".")
+    for name in path:
+        module = getattr(module, name)
+    if leaf in module._parameters:
+        module._parameters[leaf] = torch.nn.Parameter(tensor, requires_grad=False)
+    else:
+        module._buffers[leaf] = tensor
+
+
+@contextmanager
+def open_weights(path):
+    "Yield dict-like of key -> tensor, read on access from the mapped file"
+    if path.endswith(".safetensors"):
+        with safetensors.safe_open(path, framework="pt", device="cpu") as f:
+            yield f
+    else:
+        yield _MappedStateDict(torch.load(path, map_location="cpu", mmap=True, weights_only=True))
+
+
+class _MappedStateDict:
+    def __init__(self, state_dict):
+        self.state_dict = state_dict
+
+    def keys(self):
+        return self.state_dict.keys()
+
+    def get_tensor(self, key):
+        # Copy out of the mapping, like safe_open
+        return self.state_dict[key].clone()
+
+
+def truncate_text_encoder(text_encoder, clip_skip):
+    "Drop the last clip_skip layers of a loaded CLIP text encoder"
+    layers = text_encoder.text_model.encoder.layers
+    n = max(1, len(layers) - clip_skip)
+    text_encoder.text_model.encoder.layers = layers[:n]
+    text_encoder.config.num_hidden_layers = n
+    return text_encoder
+
+
+def load_component(folder, cls, dtype, device, times, config_overrides=None):
+    "Create a model of cls from the config in folder, and load its weights"
+    weights = None
+    for name in WEIGHT_FILES:
+        if os.path.exists(os.path.join(folder, name)):
+            weights = os.path.join(folder, name)
+            break
+    if weights is None:
+        raise Exception(f"No weights in {folder}")
+
+    with times.measure("load_build"):
+        if issubclass(cls, ModelMixin):
+            config = cls.load_config(folder)
+            with empty_weights():
+                model = cls.from_config(config)
+        else:
+            config = cls.config_class.from_pretrained(folder, **(config_overrides or {}))
+            with empty_weights():
+                model = cls(config)
+        expected = set(model.state_dict().keys())
+
+    # Times of tensors are summed, and added once per component
+    read = 0.0
+    transfer = 0.0
+    with open_weights(weights) as f:
+        for key in f.keys():
+            # Unused weights, e.g. layers removed by clip_skip
+            if key not in expected:
+                continue
+            start = time.monotonic()
+            tensor = f.get_tensor(key)
+            loaded = time.monotonic()
+            if tensor.is_floating_point():
+                tensor = tensor.to(device=device, dtype=dtype)
+            else:
+                tensor = tensor.to(device=device)
+            read += loaded - start
+            transfer += time.monotonic() - loaded
+            _set_tensor(model, key, tensor)
+    times.add("load_read", read)
+    times.add("load_transfer", transfer)
+
+    missing = [
+        name for name, p in model.named_parameters() if p.device.type == "meta"
+    ]
+    if len(missing) > 0:
+        raise Exception(f"{len(missing)} weights are missing in {weights}, e.g. {missing[0]}")
+    # Buffers which are not in the weights file
+    model.to(device=device, dtype=dtype)
+    model.eval()
+    return model
+
+
+def fast_load_pipeline(path, dtype, device, times, clip_skip=0):
+    "Load the diffusers pipeline in path, with weights on device"
+    with open(os.path.join(path, "model_index.json"), "r") as f:
+        index = json.load(f)
+    components = {}
+    for name, spec in index.items():
+        if name.startswith("_") or not isinstance(spec, list) or spec[0] is None:
+            continue
+        if name in SKIP_COMPONENTS:
+            components[name] = None
+            continue
+        library, class_name = spec
+        cls = getattr(importlib.import_module(library), class_name, None)
+        if cls is None or not issubclass(cls, torch.nn.Module):
+            continue
+        overrides = {}
+        if name == "text_encoder" and clip_skip > 0:
+            config = cls.config_class.from_pretrained(os.path.join(path, name))
+            overrides["num_hidden_layers"] = max(1, config.num_hidden_layers - clip_skip)
+        components[name] = load_component(
+            os.path.join(path, name), cls, dtype, device, times, overrides
+        )
+    # Load the other components, with the loaded ones passed in
+    with times.measure("load_build"):
+        return DiffusionPipeline.from_pretrained(
+            path,
+            torch_dtype=dtype,
+            local_files_only=True,
+            **components,
+        )
@@ -0,0 +1,187 @@
+import ctypes
+import ctypes.util
+import os
+import struct
+import threading
+import time
+
+"""
+Values inbox
+
+Writers (the UI, jobs.py, ...) change daemon values by dropping files into
+state/values.d. A file is written under a temporary name (starting with
+'.'), then renamed to its unique final name, so the daemon never sees a
+partial file:
+
+    <time in ms, 15 digits>-<pid>-<counter, 6 digits>.json   json of values
+    <time in ms, 15 digits>-<pid>-<counter, 6 digits>.as     aroma_encode-d lines
+
+The daemon claims each file by renaming it into values.d/.claimed, then
+parses, merges and removes it, in name (arrival) order. Nothing is
+truncated, so no update is lost.
+
+Arrival is detected with inotify on Linux, or by the mtime of the directory
+otherwise. When nothing arrived, a check is a non-blocking read (or a
+stat), and no file is opened or parsed.
+"""
+
+EXTENSIONS = [".json", ".as"]
+CLAIMED_DIR = ".claimed"
+
+# inotify flags
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT = struct.Struct("iIII")
+
+_counter = 0
+_counter_lock = threading.Lock()
+
+
+def unique_name(ext):
+    "Unique file name, sorted by time of creation"
+    global _counter
+    with _counter_lock:
+        _counter = (_counter + 1) % 1000000
+        n = _counter
+    return f"{int(time.time() * 1000):015d}-{os.getpid()}-{n:06d}{ext}"
+
+
+def drop_values(path, data, ext=".json"):
+    "Write data into the inbox directory path atomically. Return the file path"
+    os.makedirs(path, exist_ok=True)
+    name = unique_name(ext)
+    tmp = os.path.join(path, f".{name}.tmp")
+    with open(tmp, "w") as f:
+        f.write(data)
+    final = os.path.join(path, name)
+    os.rename(tmp, final)
+    return final
+
+
+class InotifyWatch:
+    "Non-blocking inotify watch of new files in a directory"
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(
+            self.fd, os.fsencode(path), IN_CLOSE_WRITE | IN_MOVED_TO
+        )
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, "inotify_add_watch failed")
+
+    def changed(self):
+        "Return True if any file was written or moved in since the last call"
+        changed = False
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            offset = 0
+            while offset + EVENT.size <= len(data):
+                _, mask, _, name_len = EVENT.unpack_from(data, offset)
+                name = data[offset + EVENT.size : offset + EVENT.size + name_len]
+                offset += EVENT.size + name_len
+                # Temporary files (.*) are ignored until renamed.
+                # Overflow means events are lost: scan
+                if mask & IN_Q_OVERFLOW or not name.startswith(b"."):
+                    changed = True
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class PollWatch:
+    "Detect new files by the mtime of the directory"
+
+    # mtime resolution of some file systems is coarse. While the directory
+    # changed recently, keep scanning
+    RECENT = 2.0
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+
+    def changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime_ns
+        except OSError:
+            return False
+        recent = time.time() - mtime / 1e9 < self.RECENT
+        if mtime == self.mtime and not recent:
+            return False
+        self.mtime = mtime
+        return True
+
+    def close(self):
+        pass
+
+
+class ValuesInbox:
+    def __init__(self, path, inotify=True):
+        self.path = path
+        self.claimed = os.path.join(path, CLAIMED_DIR)
+        os.makedirs(self.claimed, exist_ok=True)
+        self.watch = None
+        if inotify:
+            try:
+                self.watch = InotifyWatch(path)
+            except (OSError, AttributeError, TypeError) as e:
+                # Not linux, or no more watches
+                print(f"[INFO] inotify is not available, poll values inbox: {e}")
+        if self.watch is None:
+            self.watch = PollWatch(path)
+        # Files claimed before a restart are merged first
+        self.pending = True
+
+    @classmethod
+    def from_config(cls, state_root, d):
+        return cls(f"{state_root}/values.d", inotify=d.get("inotify", True))
+
+    def _claim(self):
+        "Move arrived files into the claimed directory, return their paths"
+        for name in sorted(os.listdir(self.path)):
+            if name.startswith(".") or os.path.splitext(name)[1] not in EXTENSIONS:
+                continue
+            try:
+                os.rename(
+                    os.path.join(self.path, name), os.path.join(self.claimed, name)
+                )
+            except FileNotFoundError:
+                # Claimed by another reader
+                continue
+        return [os.path.join(self.claimed, name) for name in sorted(os.listdir(self.claimed))]
+
+    def take(self):
+        """
+        Return [(ext, contents)] of arrived files in order, and remove them.
+        Return [] without touching files if nothing arrived.
+        """
+        if not self.watch.changed() and not self.pending:
+            return []
+        self.pending = False
+        taken = []
+        for path in self._claim():
+            try:
+                with open(path, "r") as f:
+                    taken.append((os.path.splitext(path)[1], f.read()))
+            except OSError as e:
+                print(f"[WARN] Failed to read {path}, skip: {e}")
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        return taken
+
+    def close(self):
+        self.watch.close()
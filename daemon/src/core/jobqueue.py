@@ -0,0 +1,151 @@
+import datetime
+import json
+import sqlite3
+
+"""
+Persistent job queue (state/jobs.db)
+
+Each job has values (merged over the daemon values when it runs), a
+priority (higher first, then FIFO), and a repeat count. The daemon runs
+a job `repeat` times, then marks it done. Jobs can be cancelled at any time.
+
+Several workers may share the queue. next() claims a run atomically
+(`running` counts claimed runs), so a job is never run more than `repeat`
+times, and runs of a repeated job are spread over idle workers.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at TEXT NOT NULL,
+    priority INTEGER NOT NULL DEFAULT 0,
+    values_json TEXT NOT NULL,
+    repeat INTEGER NOT NULL DEFAULT 1,
+    done INTEGER NOT NULL DEFAULT 0,
+    status TEXT NOT NULL DEFAULT 'queued',
+    running INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS jobs_pending ON jobs (status, priority DESC, id);
+"""
+
+# Status of jobs which are not finished
+PENDING = ("queued", "running")
+
+
+def _now():
+    return datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def _row_to_job(row):
+    return {
+        "id": row[0],
+        "created_at": row[1],
+        "priority": row[2],
+        "values": json.loads(row[3]),
+        "repeat": row[4],
+        "done": row[5],
+        "status": row[6],
+        "running": row[7],
+    }
+
+
+COLUMNS = "id, created_at, priority, values_json, repeat, done, status, running"
+
+
+class JobQueue:
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        # Add columns missing in queues created by older versions
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(jobs)")]
+        if "running" not in columns:
+            self.db.execute(
+                "ALTER TABLE jobs ADD COLUMN running INTEGER NOT NULL DEFAULT 0"
+            )
+
+    def close(self):
+        self.db.close()
+
+    def enqueue(self, values, priority=0, repeat=1):
+        "Add job. Return job id"
+        if not isinstance(values, dict):
+            raise Exception("Invalid job values (expect dict)")
+        repeat = max(1, int(repeat))
+        cur = self.db.execute(
+            "INSERT INTO jobs (created_at, priority, values_json, repeat) VALUES (?, ?, ?, ?)",
+            (_now(), int(priority), json.dumps(values), repeat),
+        )
+        return cur.lastrowid
+
+    def cancel(self, job_id):
+        "Cancel job. Return True if the job was pending"
+        cur = self.db.execute(
+            "UPDATE jobs SET status = 'cancelled' WHERE id = ? AND status IN (?, ?)",
+            (int(job_id),) + PENDING,
+        )
+        return cur.rowcount > 0
+
+    def next(self):
+        "Claim a run of the next job, mark it running and return it, or None"
+        # Select and claim in one write transaction, so workers never race
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute(
+                f"SELECT {COLUMNS} FROM jobs WHERE status IN (?, ?) "
+                "AND done + running < repeat "
+                "ORDER BY priority DESC, id ASC LIMIT 1",
+                PENDING,
+            ).fetchone()
+            if row is not None:
+                self.db.execute(
+                    "UPDATE jobs SET status = 'running', running = running + 1 "
+                    "WHERE id = ?",
+                    (row[0],),
+                )
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return None if row is None else _row_to_job(row)
+
+    def complete(self, job_id, count=1):
+        "Record count finished runs of the job"
+        self.db.execute(
+            "UPDATE jobs SET done = done + ?, running = MAX(running - ?, 0), "
+            "status = CASE WHEN done + ? >= repeat THEN 'done' ELSE status END "
+            "WHERE id = ? AND status IN (?, ?)",
+            (count, count, count, int(job_id)) + PENDING,
+        )
+
+    def reset_running(self):
+        "Release runs claimed by workers which are gone (on daemon start)"
+        self.db.execute("UPDATE jobs SET running = 0 WHERE running > 0")
+        self.db.execute(
+            "UPDATE jobs SET status = 'queued' WHERE status = 'running' AND done = 0"
+        )
+
+    def get(self, job_id):
+        row = self.db.execute(
+            f"SELECT {COLUMNS} FROM jobs WHERE id = ?", (int(job_id),)
+        ).fetchone()
+        return None if row is None else _row_to_job(row)
+
+    def list(self, pending_only=True, limit=100):
+        if pending_only:
+            rows = self.db.execute(
+                f"SELECT {COLUMNS} FROM jobs WHERE status IN (?, ?) "
+                "ORDER BY priority DESC, id ASC LIMIT ?",
+                PENDING + (int(limit),),
+            )
+        else:
+            rows = self.db.execute(
+                f"SELECT {COLUMNS} FROM jobs ORDER BY id DESC LIMIT ?", (int(limit),)
+            )
+        return [_row_to_job(row) for row in rows]
+
+    def num_pending(self):
+        return self.db.execute(
+            "SELECT COUNT(*) FROM jobs WHERE status IN (?, ?)", PENDING
+        ).fetchone()[0]
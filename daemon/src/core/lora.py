@@ -0,0 +1,209 @@
+import weakref
+
+import safetensors.torch
+import torch
+
+"""
+LoRA support
+
+LoRA weights are kept as cached deltas (alpha * up @ down per layer)
+instead of being merged irreversibly. LoraWeights remembers the original
+weights of touched layers, so applying, removing or re-scaling LoRAs only
+rewrites the affected layers, and never needs a model reload.
+"""
+
+
+def _find_layer(pipeline, key, prefix_unet, prefix_text_encoder):
+    if "text" in key:
+        layer_infos = key.split(".")[0].split(prefix_text_encoder + "_")[-1].split("_")
+        curr_layer = pipeline.text_encoder
+    else:
+        layer_infos = key.split(".")[0].split(prefix_unet + "_")[-1].split("_")
+        curr_layer = pipeline.unet
+
+    # find the target layer
+    temp_name = layer_infos.pop(0)
+    while len(layer_infos) > -1:
+        try:
+            curr_layer = curr_layer.__getattr__(temp_name)
+            if len(layer_infos) > 0:
+                temp_name = layer_infos.pop(0)
+            elif len(layer_infos) == 0:
+                break
+        except Exception:
+            if len(temp_name) > 0:
+                temp_name += "_" + layer_infos.pop(0)
+            else:
+                temp_name = layer_infos.pop(0)
+    return curr_layer
+
+
+# Module name index per component (unet, text_encoder), built once
+_index_cache = weakref.WeakKeyDictionary()
+
+
+def _module_index(root, prefix):
+    "Map LoRA style names (prefix_a_b_0_c) to modules"
+    indices = _index_cache.setdefault(root, {})
+    if prefix not in indices:
+        index = {}
+        for name, module in root.named_modules():
+            if hasattr(module, "weight"):
+                index[prefix + "_" + name.replace(".", "_")] = module
+        indices[prefix] = index
+    return indices[prefix]
+
+
+def load_lora_deltas(
+    pipeline,
+    checkpoint_path,
+    LORA_PREFIX_UNET="lora_unet",
+    LORA_PREFIX_TEXT_ENCODER="lora_te",
+    out_device="cpu",
+):
+    """
+    Load LoRA from .safetensors and return list of (module, up @ down).
+    Products are computed in float32 on the device of the target weights,
+    batched by shape, and returned in the weight dtype on out_device
+    (None: keep on the weight device).
+    """
+    state_dict = safetensors.torch.load_file(checkpoint_path)
+    unet_index = _module_index(pipeline.unet, LORA_PREFIX_UNET)
+    te_index = _module_index(pipeline.text_encoder, LORA_PREFIX_TEXT_ENCODER)
+
+    # Group (module, up, down) by target device, dtype and shapes
+    groups = {}
+    skipped = 0
+    for key in state_dict:
+        # it is suggested to print out the key, it usually will be something like below
+        # "lora_te_text_model_encoder_layers_0_self_attn_k_proj.lora_down.weight"
+        # as we have set the alpha beforehand, alpha and lora_up keys are skipped.
+        if "lora_down" not in key:
+            continue
+        up_key = key.replace("lora_down", "lora_up")
+        if up_key not in state_dict:
+            print(f"[WARN] Lora: no lora_up for {key}, ignore it")
+            continue
+        base = key.split(".")[0]
+        index = te_index if "text" in key else unet_index
+        module = index.get(base)
+        if module is None:
+            # Fallback for irregular key names
+            try:
+                module = _find_layer(pipeline, key, LORA_PREFIX_UNET, LORA_PREFIX_TEXT_ENCODER)
+            except (AttributeError, IndexError):
+                # e.g. text encoder layers removed by clip_skip
+                skipped += 1
+                continue
+
+        up = state_dict[up_key]
+        down = state_dict[key]
+        if len(up.shape) == 4:
+            up = up.squeeze(3).squeeze(2)
+            down = down.squeeze(3).squeeze(2)
+        w = module.weight
+        group_key = (w.device, w.dtype, tuple(up.shape), tuple(down.shape))
+        if group_key not in groups:
+            groups[group_key] = []
+        groups[group_key].append((module, up, down))
+
+    if skipped > 0:
+        print(f"[WARN] Lora: {skipped} layers are not in the model, ignore them")
+
+    deltas = []
+    for (device, dtype, _, _), items in groups.items():
+        # Run merges on the gpu if weights are there
+        ups = torch.stack([up for _, up, _ in items]).to(device, torch.float32)
+        downs = torch.stack([down for _, _, down in items]).to(device, torch.float32)
+        products = torch.bmm(ups, downs).to(dtype)
+        if out_device is not None:
+            products = products.to(out_device)
+        for (module, _, _), delta in zip(items, products):
+            deltas.append((module, delta.reshape(module.weight.shape)))
+    return deltas
+
+
+def load_safetensors_lora(pipeline, checkpoint_path, LORA_PREFIX_UNET="lora_unet", LORA_PREFIX_TEXT_ENCODER="lora_te", alpha=0.75):
+    "Merge LoRA into the pipeline weights (irreversible)"
+    deltas = load_lora_deltas(
+        pipeline, checkpoint_path, LORA_PREFIX_UNET, LORA_PREFIX_TEXT_ENCODER, out_device=None
+    )
+    for layer, delta in deltas:
+        layer.weight.data += alpha * delta
+    return pipeline
+
+
+class LoraWeights:
+    """
+    LoRA state of one pipeline.
+    Deltas of each LoRA file are computed once, and original weights of
+    touched layers are kept in host memory.
+    """
+
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        # path -> list of (module, delta)
+        self.deltas = {}
+        # module -> original weight (cpu)
+        self.origins = {}
+        # path -> alpha, currently merged into weights
+        self.applied = {}
+
+    def _deltas(self, path):
+        if path not in self.deltas:
+            print(f"[INFO] Loading Lora from {path}")
+            self.deltas[path] = load_lora_deltas(self.pipeline, path)
+        return self.deltas[path]
+
+    def apply(self, loras):
+        """
+        Set applied LoRAs to loras, list of (path, alpha).
+        Return True if any weight is changed.
+        """
+        target = {path: float(alpha) for path, alpha in loras if path != ""}
+        if target == self.applied:
+            return False
+        # Collect deltas of touched layers: previous and new LoRAs
+        for path in target:
+            self._deltas(path)
+        layers = {}
+        for path in set(self.applied) | set(target):
+            alpha = target.get(path, 0.0)
+            for module, delta in self.deltas[path]:
+                if module not in layers:
+                    layers[module] = []
+                if alpha != 0.0:
+                    layers[module].append((alpha, delta))
+        # Rewrite touched layers from original weights
+        with torch.no_grad():
+            for module, items in layers.items():
+                w = module.weight
+                if module not in self.origins:
+                    self.origins[module] = w.detach().to("cpu", copy=True)
+                orig = self.origins[module]
+                if len(items) == 0:
+                    w.data.copy_(orig)
+                    continue
+                merged = orig.to(device=w.device, dtype=torch.float32, copy=True)
+                for alpha, delta in items:
+                    merged += alpha * delta.to(w.device)
+                w.data.copy_(merged)
+        print(f"[INFO] Lora applied: {target}, touched {len(layers)} layers")
+        self.applied = target
+        self.clear_cache()
+        return True
+
+    def clear_cache(self):
+        "Drop cached deltas of LoRAs which are not applied"
+        for path in list(self.deltas.keys()):
+            if path not in self.applied:
+                del self.deltas[path]
+
+    def nbytes(self):
+        total = 0
+        for deltas in self.deltas.values():
+            for _, delta in deltas:
+                total += delta.numel() * delta.element_size()
+        for orig in self.origins.values():
+            total += orig.numel() * orig.element_size()
+        return total
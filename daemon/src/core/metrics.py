@@ -0,0 +1,221 @@
+import json
+import os
+import resource
+import time
+from collections import deque
+
+import torch
+
+from .progress import atomic_write
+from .util import torch_device, torch_device_type
+
+"""
+Metrics export
+
+Metrics writes state/metrics.prom (metrics-w<id>.prom for workers) in the
+Prometheus text format, at most every `interval` seconds and atomically,
+so node_exporter's textfile collector (or anything else) can read it:
+
+- aroma_stage_seconds: summary per stage. Quantiles are over the recent
+  samples of the stage (see timing.py), sum and count since start.
+- aroma_images_total, aroma_images_per_hour (over the last hour)
+- aroma_unet_busy_ratio, aroma_uptime_seconds
+- aroma_cache_*: every dict in state.stats with hits and misses
+- aroma_device_memory_bytes: allocated, reserved and peak on cuda, and
+  peak rss of the process
+
+With `trace`, each job appends a line to state/trace.jsonl (trace-w<id>)
+with the stage events recorded while it ran. The file is rotated to
+.1 when it exceeds trace_max_mb.
+"""
+
+QUANTILES = [0.5, 0.9, 0.99]
+HOUR = 3600.0
+
+
+def _labels(d):
+    if len(d) == 0:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in d.items()) + "}"
+
+
+def _device_memory():
+    "Return {kind: bytes} of the device and the process"
+    memory = {}
+    if torch_device_type() == "cuda":
+        device = torch.device(torch_device())
+        memory["allocated"] = torch.cuda.memory_allocated(device)
+        memory["reserved"] = torch.cuda.memory_reserved(device)
+        memory["peak_allocated"] = torch.cuda.max_memory_allocated(device)
+    # ru_maxrss is in KiB on Linux
+    memory["peak_rss"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return memory
+
+
+class Metrics:
+    def __init__(
+        self,
+        path,
+        interval=10.0,
+        trace_path=None,
+        trace_max_mb=64,
+        labels=None,
+    ):
+        self.path = path
+        self.interval = float(interval)
+        self.trace_path = trace_path
+        self.trace_max_bytes = int(trace_max_mb * 1024 * 1024)
+        self.labels = labels or {}
+        self.start = time.monotonic()
+        self.last_write = None
+        self.images_total = 0
+        # Finish times of images in the last hour
+        self.image_times = deque()
+
+    @classmethod
+    def from_config(cls, state_root, worker_id, d):
+        suffix = "" if worker_id is None else f"-w{worker_id}"
+        trace_path = None
+        if d.get("trace", False):
+            trace_path = f"{state_root}/trace{suffix}.jsonl"
+        return cls(
+            f"{state_root}/metrics{suffix}.prom",
+            interval=d.get("interval", 10.0),
+            trace_path=trace_path,
+            trace_max_mb=d.get("trace_max_mb", 64),
+            labels={} if worker_id is None else {"worker": worker_id},
+        )
+
+    def image_done(self):
+        now = time.monotonic()
+        self.images_total += 1
+        self.image_times.append(now)
+        while self.image_times[0] < now - HOUR:
+            self.image_times.popleft()
+
+    def images_per_hour(self):
+        now = time.monotonic()
+        while len(self.image_times) > 0 and self.image_times[0] < now - HOUR:
+            self.image_times.popleft()
+        # Until the daemon ran for an hour, scale by its uptime
+        span = min(HOUR, now - self.start)
+        return len(self.image_times) * HOUR / span if span > 0 else 0.0
+
+    def render(self, stage_times, stats):
+        "Return metrics in the Prometheus text format"
+        base = self.labels
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for suffix, labels, value in samples:
+                lines.append(f"{name}{suffix}{_labels({**base, **labels})} {float(value)}")
+
+        times = stage_times.stats()
+        quantiles = stage_times.quantiles(QUANTILES)
+        samples = []
+        for stage, s in sorted(times["stages"].items()):
+            for q, v in zip(QUANTILES, quantiles.get(stage, [])):
+                samples.append(("", {"stage": stage, "quantile": q}, v))
+            samples.append(("_sum", {"stage": stage}, s["total"]))
+            samples.append(("_count", {"stage": stage}, s["count"]))
+        metric("aroma_stage_seconds", "summary", "Wall time of daemon stages", samples)
+        metric(
+            "aroma_images_total", "counter", "Images generated", [("", {}, self.images_total)]
+        )
+        metric(
+            "aroma_images_per_hour",
+            "gauge",
+            "Images generated in the last hour",
+            [("", {}, self.images_per_hour())],
+        )
+        metric(
+            "aroma_unet_busy_ratio",
+            "gauge",
+            "Share of wall time spent in the UNet",
+            [("", {}, times["unet_busy"])],
+        )
+        metric(
+            "aroma_uptime_seconds",
+            "gauge",
+            "Seconds since the daemon started",
+            [("", {}, time.monotonic() - self.start)],
+        )
+
+        caches = {
+            name: s
+            for name, s in sorted(stats.items())
+            if isinstance(s, dict) and "hits" in s and "misses" in s
+        }
+        for field, kind in [("hits", "counter"), ("misses", "counter"), ("entries", "gauge")]:
+            metric(
+                f"aroma_cache_{field}" + ("_total" if kind == "counter" else ""),
+                kind,
+                f"Cache {field}",
+                [("", {"cache": name}, s[field]) for name, s in caches.items() if field in s],
+            )
+        metric(
+            "aroma_cache_hit_ratio",
+            "gauge",
+            "Cache hit ratio since start",
+            [
+                ("", {"cache": name}, s["hits"] / max(1, s["hits"] + s["misses"]))
+                for name, s in caches.items()
+            ],
+        )
+
+        metric(
+            "aroma_device_memory_bytes",
+            "gauge",
+            "Memory of the device and the process",
+            [
+                ("", {"device": torch_device(), "kind": kind}, v)
+                for kind, v in _device_memory().items()
+            ],
+        )
+        return "\n".join(lines) + "\n"
+
+    def maybe_write(self, stage_times, stats, force=False):
+        "Write the metrics file if interval passed since the last write"
+        now = time.monotonic()
+        if not force and self.last_write is not None and now - self.last_write < self.interval:
+            return False
+        self.last_write = now
+        try:
+            atomic_write(self.path, self.render(stage_times, stats))
+        except Exception as e:
+            print(f"[WARN] Cannot write metrics: {e}")
+        return True
+
+    def write_trace(self, job, events):
+        "Append events of job as a line of the trace file"
+        if self.trace_path is None:
+            return
+        origin = min((start for _, start, _, _ in events), default=0.0)
+        line = {
+            "start_time": job.get("start_time"),
+            "end_time": job.get("end_time"),
+            "filename": job.get("filename"),
+            "queue_id": job.get("queue_id"),
+            **self.labels,
+            "events": [
+                {
+                    "stage": name,
+                    "start": round(start - origin, 6),
+                    "seconds": round(seconds, 6),
+                    "thread": thread,
+                }
+                for name, start, seconds, thread in events
+            ],
+        }
+        try:
+            if (
+                os.path.exists(self.trace_path)
+                and os.path.getsize(self.trace_path) > self.trace_max_bytes
+            ):
+                os.replace(self.trace_path, f"{self.trace_path}.1")
+            with open(self.trace_path, "a") as f:
+                f.write(json.dumps(line) + "\n")
+        except Exception as e:
+            print(f"[WARN] Cannot write trace: {e}")
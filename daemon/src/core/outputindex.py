@@ -0,0 +1,350 @@
+import json
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+
+from .container import read_metadata, BINARY_EXT, LEGACY_EXT
+from .progress import atomic_write
+
+"""
+Outputs index (state/outputs.db)
+
+The daemon adds a row for each output it writes (see State._write_output),
+so outputs can be listed and filtered without reading outputs_root. Rows
+are built only from the metadata stored in the output file, so the index
+can be rebuilt from disk (sync), e.g. after files are deleted or copied:
+files are read in parallel processes, and only new or changed files are
+read unless `full` is given.
+
+Output names (file prefixes) sort by time, so pages are ordered by name,
+newest first, and `before` (the last name of the previous page) gives the
+next page without OFFSET scans.
+
+For the UI gallery, which does not read sqlite, the index also keeps a
+paged listing in state/output_pages: <yymmdd-HH>.json is a json array of
+output names of that hour, oldest first. Pages of changed names are
+rewritten in the same transaction, so workers never write a stale page.
+The daemon syncs the index at startup, which writes every page.
+"""
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS outputs (
+    name TEXT PRIMARY KEY,
+    ext TEXT NOT NULL,
+    start_time TEXT,
+    end_time TEXT,
+    elapsed REAL,
+    prompt TEXT,
+    negative_prompt TEXT,
+    model TEXT,
+    lora TEXT,
+    lora_alpha REAL,
+    width INTEGER,
+    height INTEGER,
+    seed INTEGER,
+    sampler TEXT,
+    steps INTEGER,
+    cfg_scale REAL,
+    queue_id INTEGER,
+    result_key TEXT,
+    file_size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outputs_model ON outputs (model, name);
+CREATE INDEX IF NOT EXISTS outputs_seed ON outputs (seed);
+"""
+
+COLUMNS = [
+    "name",
+    "ext",
+    "start_time",
+    "end_time",
+    "elapsed",
+    "prompt",
+    "negative_prompt",
+    "model",
+    "lora",
+    "lora_alpha",
+    "width",
+    "height",
+    "seed",
+    "sampler",
+    "steps",
+    "cfg_scale",
+    "queue_id",
+    "result_key",
+    "file_size",
+    "mtime_ns",
+]
+
+# Filters of query(): name -> SQL condition
+FILTERS = {
+    "prompt": "instr(prompt, ?) > 0",
+    "negative_prompt": "instr(negative_prompt, ?) > 0",
+    "model": "model = ?",
+    "lora": "lora = ?",
+    "seed": "seed = ?",
+    "sampler": "sampler = ?",
+    "width": "width = ?",
+    "height": "height = ?",
+    "queue_id": "queue_id = ?",
+    "since": "end_time >= ?",
+    "until": "end_time < ?",
+    "before": "name < ?",
+    "after": "name > ?",
+}
+
+OUTPUT_EXTS = [f".{BINARY_EXT}", f".{LEGACY_EXT}"]
+
+PAGES_DIR = "output_pages"
+
+
+def page_key(name):
+    "Outputs of an hour share a page: names start with yymmdd-HH"
+    return name[:9]
+
+
+def _int_or_none(v):
+    try:
+        return int(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def _float_or_none(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return None
+
+
+def output_row(name, ext, job, file_size, mtime_ns):
+    "Row of an output from its job metadata"
+    values = job.get("values", {})
+    params = values.get("params", {})
+    model = values.get("model", {})
+    prompts = values.get("choosed_prompt", {})
+    size = values.get("fixed_size", {})
+    seed = values.get("seed", params.get("seed"))
+    return {
+        "name": name,
+        "ext": ext,
+        "start_time": job.get("start_time"),
+        "end_time": job.get("end_time"),
+        "elapsed": _float_or_none(job.get("elapsed")),
+        "prompt": prompts.get("positive", params.get("prompt")),
+        "negative_prompt": prompts.get("negative", params.get("negative_prompt")),
+        "model": model.get("path"),
+        "lora": model.get("lora_path"),
+        "lora_alpha": _float_or_none(model.get("lora_alpha")),
+        "width": _int_or_none(size.get("w", params.get("width"))),
+        "height": _int_or_none(size.get("h", params.get("height"))),
+        "seed": _int_or_none(seed),
+        "sampler": params.get("sampling_method"),
+        "steps": _int_or_none(params.get("sampling_steps")),
+        "cfg_scale": _float_or_none(params.get("cfg_scale")),
+        "queue_id": _int_or_none(job.get("queue_id")),
+        "result_key": values.get("result_key"),
+        "file_size": file_size,
+        "mtime_ns": mtime_ns,
+    }
+
+
+def _scan_file(args):
+    "Read row of an output file. Run in a worker process"
+    path, mask = args
+    name, ext = os.path.splitext(os.path.basename(path))
+    try:
+        st = os.stat(path)
+        job = read_metadata(path, mask)
+    except Exception as e:
+        return None, f"{path}: {e}"
+    return output_row(name, ext[1:], job, st.st_size, st.st_mtime_ns), None
+
+
+class OutputIndex:
+    def __init__(self, path, pages_root=None):
+        self.path = path
+        self.pages_root = pages_root
+        # Rows are added by output writer threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            path, timeout=30, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, state_root, d):
+        "Return an OutputIndex, or None if it is disabled"
+        if not d.get("enabled", True):
+            return None
+        return cls(f"{state_root}/outputs.db", f"{state_root}/{PAGES_DIR}")
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+    def add(self, row):
+        self.add_many([row])
+
+    def add_many(self, rows, pages=True):
+        sql = (
+            f"INSERT OR REPLACE INTO outputs ({', '.join(COLUMNS)}) "
+            f"VALUES ({', '.join('?' for _ in COLUMNS)})"
+        )
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany(sql, [[row[c] for c in COLUMNS] for row in rows])
+                if pages:
+                    self._write_pages(set(page_key(row["name"]) for row in rows))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def remove(self, names, pages=True):
+        "Remove rows of names, e.g. deleted outputs"
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany(
+                    "DELETE FROM outputs WHERE name = ?", [(name,) for name in names]
+                )
+                if pages:
+                    self._write_pages(set(page_key(name) for name in names))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _write_pages(self, keys):
+        "Rewrite pages of keys from rows. Called in a transaction"
+        if self.pages_root is None or not os.path.isdir(self.pages_root):
+            return
+        for key in keys:
+            # Names of the page are in [key, key~), as names are [0-9a-z-]
+            names = [
+                name
+                for (name,) in self.db.execute(
+                    "SELECT name FROM outputs WHERE name >= ? AND name < ? ORDER BY name",
+                    (key, f"{key}~"),
+                )
+            ]
+            path = f"{self.pages_root}/{key}.json"
+            if len(names) > 0:
+                atomic_write(path, json.dumps(names))
+            elif os.path.exists(path):
+                os.remove(path)
+
+    def write_pages(self):
+        "Write every page of the listing, and remove pages without outputs"
+        if self.pages_root is None:
+            return
+        os.makedirs(self.pages_root, exist_ok=True)
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                keys = set(
+                    page_key(name) for (name,) in self.db.execute("SELECT name FROM outputs")
+                )
+                for file in os.listdir(self.pages_root):
+                    key, ext = os.path.splitext(file)
+                    if ext == ".json" and key not in keys:
+                        keys.add(key)
+                self._write_pages(keys)
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def _where(self, filters):
+        conditions, args = [], []
+        for key, value in filters.items():
+            if value is None:
+                continue
+            if key not in FILTERS:
+                raise Exception(f"Unknown output filter {key}")
+            conditions.append(FILTERS[key])
+            args.append(value)
+        if len(conditions) == 0:
+            return "", args
+        return "WHERE " + " AND ".join(conditions), args
+
+    def query(self, limit=100, offset=0, oldest_first=False, **filters):
+        """
+        Return rows (dicts) matching filters, newest first. Filters are
+        prompt / negative_prompt (substring), model, lora, seed, sampler,
+        width, height, queue_id, since / until (end_time, ISO 8601), and
+        before / after (names, for pagination)
+        """
+        where, args = self._where(filters)
+        order = "ASC" if oldest_first else "DESC"
+        with self.lock:
+            rows = self.db.execute(
+                f"SELECT {', '.join(COLUMNS)} FROM outputs {where} "
+                f"ORDER BY name {order} LIMIT ? OFFSET ?",
+                args + [int(limit), int(offset)],
+            ).fetchall()
+        return [dict(zip(COLUMNS, row)) for row in rows]
+
+    def count(self, **filters):
+        where, args = self._where(filters)
+        with self.lock:
+            return self.db.execute(
+                f"SELECT COUNT(*) FROM outputs {where}", args
+            ).fetchone()[0]
+
+    def sync(self, outputs_root, mask, workers=None, full=False):
+        """
+        Make the index match output files on disk: read new or changed files
+        (all files if full) in parallel processes, and remove rows of missing
+        files. Return (added, removed, failed)
+        """
+        files = {}
+        for entry in os.scandir(outputs_root):
+            name, ext = os.path.splitext(entry.name)
+            if ext not in OUTPUT_EXTS or not entry.is_file():
+                continue
+            # A binary container is preferred to a legacy file of the same name
+            if name in files and ext != f".{BINARY_EXT}":
+                continue
+            files[name] = (entry.path, ext[1:], entry.stat().st_mtime_ns)
+        with self.lock:
+            indexed = {
+                name: (ext, mtime_ns)
+                for name, ext, mtime_ns in self.db.execute(
+                    "SELECT name, ext, mtime_ns FROM outputs"
+                )
+            }
+        removed = [name for name in indexed if name not in files]
+        self.remove(removed, pages=False)
+        scan = [
+            path
+            for name, (path, ext, mtime_ns) in files.items()
+            if full or indexed.get(name) != (ext, mtime_ns)
+        ]
+        added, failed = 0, 0
+        if len(scan) > 0:
+            workers = workers or os.cpu_count() or 1
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                rows = []
+                chunksize = max(1, min(256, len(scan) // (4 * workers)))
+                for row, error in pool.map(
+                    _scan_file, [(path, mask) for path in scan], chunksize=chunksize
+                ):
+                    if row is None:
+                        print(f"[WARN] Cannot index output {error}")
+                        failed += 1
+                        continue
+                    rows.append(row)
+                    if len(rows) >= 1000:
+                        self.add_many(rows, pages=False)
+                        added += len(rows)
+                        rows = []
+                self.add_many(rows, pages=False)
+                added += len(rows)
+        self.write_pages()
+        return added, len(removed), failed
@@ -0,0 +1,95 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+
+from .util import torch_device_type
+
+"""
+Stage overlap
+
+The UNet dominates the cost of a job, so other stages run on a stage
+thread while it denoises:
+
+- prompt expansion and text encoding of the next job (prefetch), and
+- VAE decode and conversion to PIL images of the previous job.
+
+On cuda, the stage thread issues its work on its own stream, ordered after
+the work queued so far on the current stream. When disabled, stages run
+immediately on the calling thread.
+"""
+
+
+def _done(fn, args):
+    future = Future()
+    try:
+        future.set_result(fn(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+class StageRunner:
+    def __init__(self, enabled=True):
+        self.enabled = bool(enabled)
+        self.executor = None
+        self.stream = None
+        if self.enabled:
+            # One thread: stages run in submission order
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="aroma-stage"
+            )
+            if torch_device_type() == "cuda":
+                self.stream = torch.cuda.Stream()
+
+    @classmethod
+    def from_config(cls, d):
+        return cls(enabled=d.get("enabled", True))
+
+    def submit(self, fn, *args):
+        "Run fn(*args) on the stage thread. Return Future"
+        if not self.enabled:
+            with torch.inference_mode():
+                return _done(fn, args)
+        event = None
+        if self.stream is not None:
+            event = torch.cuda.Event()
+            event.record()
+            for arg in args:
+                # Keep memory of inputs until the stage stream is done with them
+                if isinstance(arg, torch.Tensor) and arg.is_cuda:
+                    arg.record_stream(self.stream)
+        return self.executor.submit(self._run, event, fn, args)
+
+    def _run(self, event, fn, args):
+        # Inference mode is thread local
+        with torch.inference_mode():
+            if self.stream is None:
+                return fn(*args)
+            self.stream.wait_event(event)
+            with torch.cuda.stream(self.stream):
+                result = fn(*args)
+            # Results are used on other streams and threads
+            self.stream.synchronize()
+            return result
+
+    def drain(self):
+        "Wait until all submitted stages are finished"
+        if self.enabled:
+            self.executor.submit(lambda: None).result()
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+            self.enabled = False
+
+
+class Deferred:
+    "An image of a batch which may still be being decoded"
+
+    def __init__(self, future, index):
+        self.future = future
+        self.index = index
+
+    def result(self):
+        return self.future.result()[self.index]
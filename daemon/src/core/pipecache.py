@@ -0,0 +1,193 @@
+import gc
+import itertools
+from collections import OrderedDict
+
+import torch
+
+from .util import torch_device, torch_device_type
+from .lora import LoraWeights
+
+"""
+Pipeline cache
+
+Keeps recently used pipelines (keyed by model path and clip_skip; LoRAs
+are applied in place, see lora.py), so switching between a few models does not
+reload them from disk. The active pipeline lives on the device; others
+stay on the device while gpu_budget_mb allows, then are parked in (pinned)
+host memory while cpu_budget_mb allows, and are evicted in LRU order.
+"""
+
+MB = 1024 * 1024
+
+# Unique id of each loaded pipeline, never reused
+_serials = itertools.count()
+
+# Components which hold weights
+COMPONENTS = ["unet", "vae", "text_encoder"]
+
+
+def pipeline_bytes(pipe):
+    "Size of weights of the pipeline in bytes"
+    total = 0
+    for name in COMPONENTS:
+        m = getattr(pipe, name, None)
+        if m is None:
+            continue
+        for t in m.parameters():
+            total += t.numel() * t.element_size()
+        for t in m.buffers():
+            total += t.numel() * t.element_size()
+    return total
+
+
+def _pin_module(m):
+    for sub in m.modules():
+        for t in sub._parameters.values():
+            if t is not None and not t.data.is_pinned():
+                t.data = t.data.pin_memory()
+        for k, t in sub._buffers.items():
+            if t is not None and not t.is_pinned():
+                sub._buffers[k] = t.pin_memory()
+
+
+class PipelineEntry:
+    def __init__(self, key, txt2img, img2img):
+        self.key = key
+        self.serial = next(_serials)
+        self.txt2img = txt2img
+        self.img2img = img2img
+        self.default_scheduler = txt2img.scheduler
+        # Sampler name of current schedulers of the pipelines
+        self.sampler_name = None
+        # LoRAs are applied on top of cached weights, and can be changed
+        self.lora = LoraWeights(txt2img)
+        # Textual inversion token -> path, loaded on demand (see textinv.py)
+        self.textual_inversions = {}
+        self.nbytes = pipeline_bytes(txt2img)
+        self.location = "device"
+
+
+class PipelineCache:
+    def __init__(self, gpu_budget_mb=0, cpu_budget_mb=0, max_entries=4):
+        self.device = torch_device()
+        self.device_type = torch_device_type()
+        # On cpu device, parking is meaningless: everything is host memory
+        self.offload = self.device_type != "cpu"
+        self.gpu_budget = int(float(gpu_budget_mb) * MB)
+        self.cpu_budget = int(float(cpu_budget_mb) * MB)
+        self.max_entries = max(1, int(max_entries))
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.parks = 0
+        # Called with the serial of each evicted pipeline
+        self.on_evict = None
+
+    @classmethod
+    def from_config(cls, d):
+        return cls(
+            gpu_budget_mb=d.get("gpu_budget_mb", 0),
+            cpu_budget_mb=d.get("cpu_budget_mb", 0),
+            max_entries=d.get("max_entries", 4),
+        )
+
+    def used_bytes(self, location):
+        if not self.offload:
+            location = "device"
+        return sum(e.nbytes for e in self.entries.values() if e.location == location)
+
+    def get(self, key):
+        "Return entry for key on the device, or None"
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        if entry.location != "device":
+            print(f"[INFO] PipelineCache: restore {key} to {self.device}")
+            entry.txt2img.to(self.device)
+            entry.location = "device"
+        self._enforce(entry)
+        return entry
+
+    def put(self, key, txt2img, img2img):
+        entry = PipelineEntry(key, txt2img, img2img)
+        self.entries[key] = entry
+        self.entries.move_to_end(key)
+        self._enforce(entry)
+        return entry
+
+    def make_room(self):
+        "Apply budgets to all entries, before loading a new pipeline"
+        self._enforce(None)
+
+    def _park(self, entry):
+        print(f"[INFO] PipelineCache: park {entry.key} in host memory")
+        entry.txt2img.to("cpu")
+        if self.device_type == "cuda":
+            for name in COMPONENTS:
+                m = getattr(entry.txt2img, name, None)
+                if m is not None:
+                    _pin_module(m)
+        entry.location = "host"
+        self.parks += 1
+
+    def _evict(self, entry):
+        print(f"[INFO] PipelineCache: evict {entry.key}")
+        del self.entries[entry.key]
+        entry.txt2img = None
+        entry.img2img = None
+        entry.default_scheduler = None
+        entry.lora = None
+        entry.textual_inversions = None
+        self.evictions += 1
+        if self.on_evict is not None:
+            self.on_evict(entry.serial)
+
+    def _enforce(self, active):
+        "Park or drop LRU entries other than active until budgets are met"
+        evictions = self.evictions
+        # Park LRU pipelines until device usage is within budget
+        if self.offload:
+            for entry in self._others(active):
+                if self.used_bytes("device") <= self.gpu_budget:
+                    break
+                if entry.location != "device":
+                    continue
+                if entry.nbytes <= self.cpu_budget:
+                    self._park(entry)
+                else:
+                    self._evict(entry)
+        # Evict LRU pipelines until host usage and count are within limits
+        for entry in self._others(active):
+            over_count = len(self.entries) > self.max_entries
+            if not over_count and self.used_bytes("host") <= self.cpu_budget:
+                break
+            if over_count or entry.location == "host" or not self.offload:
+                self._evict(entry)
+        if self.evictions > evictions:
+            gc.collect()
+            if self.device_type == "cuda":
+                torch.cuda.empty_cache()
+
+    def _others(self, active):
+        # Entries except active one, least recently used first
+        return [e for e in self.entries.values() if e is not active]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "parks": self.parks,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+            "device_mb": self.used_bytes("device") / MB,
+            "host_mb": self.used_bytes("host") / MB,
+            "lora_mb": sum(
+                e.lora.nbytes() for e in self.entries.values()
+            ) / MB,
+        }
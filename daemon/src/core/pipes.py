@@ -1,20 +1,47 @@
+import copy
 import datetime
-import re
+import io
 import json
 import os
-import pathlib
+import random
 from packaging.version import Version
 
 import numpy as np
 import torch
-from transformers import CLIPTextModel
 from diffusers import *
-import safetensors.torch
+from diffusers.utils import randn_tensor
 
 import PIL
 
-from .util import torch_device, is_torch_2_0
-from .prompt import Prompt
+from .util import torch_device, torch_device_type, is_torch_2_0
+from .prompt import Prompt, EmbeddingCache, ENCODING_MODES, has_choices, pad_embeds
+from .pipecache import PipelineCache
+from .lora import load_safetensors_lora
+from .schedulers import SchedulerCache
+from .overlap import StageRunner, Deferred
+from .timing import StepTimer
+from .textinv import TIManifest
+from .fastload import fast_load_pipeline, truncate_text_encoder
+from .preview import PreviewChannel
+from .resultcache import RESULT_CACHE_VERSION, CachedOutput, file_stamp, result_key
+
+
+def get_batch_size(params):
+    try:
+        return max(1, int(params.get("batch_size", 1)))
+    except:
+        print("[WARNING] Invalid batch size, use 1.")
+        return 1
+
+
+def get_seed(params, key="seed"):
+    "Return the seed in params, or None if it is missing, empty or invalid"
+    if params.get(key, "") == "":
+        return None
+    try:
+        return int(params[key])
+    except:
+        return None
 
 
 def filter_image_size(len):
@@ -25,66 +52,23 @@ def filter_image_size(len):
     return len
 
 
-def load_safetensors_lora(pipeline, checkpoint_path, LORA_PREFIX_UNET="lora_unet", LORA_PREFIX_TEXT_ENCODER="lora_te", alpha=0.75):
-    # load LoRA weight from .safetensors
-    state_dict = safetensors.torch.load_file(checkpoint_path)
+# Interpolation modes of latent highres fix
+LATENT_INTERPOLATIONS = ["nearest", "nearest-exact", "bilinear", "bicubic", "area"]
 
-    visited = []
 
-    # directly update weight in diffusers model
-    for key in state_dict:
-        # it is suggested to print out the key, it usually will be something like below
-        # "lora_te_text_model_encoder_layers_0_self_attn_k_proj.lora_down.weight"
-
-        # as we have set the alpha beforehand, so just skip
-        if ".alpha" in key or key in visited:
-            continue
-
-        if "text" in key:
-            layer_infos = key.split(".")[0].split(LORA_PREFIX_TEXT_ENCODER + "_")[-1].split("_")
-            curr_layer = pipeline.text_encoder
-        else:
-            layer_infos = key.split(".")[0].split(LORA_PREFIX_UNET + "_")[-1].split("_")
-            curr_layer = pipeline.unet
-
-        # find the target layer
-        temp_name = layer_infos.pop(0)
-        while len(layer_infos) > -1:
-            try:
-                curr_layer = curr_layer.__getattr__(temp_name)
-                if len(layer_infos) > 0:
-                    temp_name = layer_infos.pop(0)
-                elif len(layer_infos) == 0:
-                    break
-            except Exception:
-                if len(temp_name) > 0:
-                    temp_name += "_" + layer_infos.pop(0)
-                else:
-                    temp_name = layer_infos.pop(0)
-
-        pair_keys = []
-        if "lora_down" in key:
-            pair_keys.append(key.replace("lora_down", "lora_up"))
-            pair_keys.append(key)
-        else:
-            pair_keys.append(key)
-            pair_keys.append(key.replace("lora_up", "lora_down"))
-
-        # update weight
-        if len(state_dict[pair_keys[0]].shape) == 4:
-            weight_up = state_dict[pair_keys[0]].squeeze(3).squeeze(2).to(torch.float32)
-            weight_down = state_dict[pair_keys[1]].squeeze(3).squeeze(2).to(torch.float32)
-            curr_layer.weight.data += alpha * torch.mm(weight_up, weight_down).unsqueeze(2).unsqueeze(3)
-        else:
-            weight_up = state_dict[pair_keys[0]].to(torch.float32)
-            weight_down = state_dict[pair_keys[1]].to(torch.float32)
-            curr_layer.weight.data += alpha * torch.mm(weight_up, weight_down)
-
-        # update visited list
-        for item in pair_keys:
-            visited.append(item)
-
-    return pipeline
+def resize_latents(latents, width, height, interpolation="bilinear"):
+    "Resize latents to width x height (latent pixels)"
+    if interpolation not in LATENT_INTERPOLATIONS:
+        print(f"[WARNING] Invalid interpolation {interpolation}, use bilinear.")
+        interpolation = "bilinear"
+    kwargs = {}
+    if interpolation in ["bilinear", "bicubic"]:
+        kwargs["align_corners"] = False
+    # Interpolate in float32, half is not supported on every device
+    resized = torch.nn.functional.interpolate(
+        latents.float(), size=(height, width), mode=interpolation, **kwargs
+    )
+    return resized.to(latents.dtype)
 
 
 # Pipeline wrappers
@@ -96,10 +80,37 @@ class SDPipes:
         self.prompt = Prompt(".")
         self.negative_prompt = Prompt(".")
 
+        # Items of current batch: embeddings, seed and per output info
+        self.items = []
+
         # Real pipelines
         self.txt2img = None
         self.img2img = None
 
+        # Recently used pipelines, created by the first _load_model
+        self.cache = None
+        self.entry = None
+        # Prompt embeddings, shared by positive and negative prompts
+        self.embed_cache = None
+        # Prompt encoding mode and max chunks of long prompts
+        self.encoding_mode = "blend"
+        self.max_chunks = 3
+        # Scheduler prototypes per model config and sampler
+        self.schedulers = SchedulerCache()
+        # Stage thread for prefetch and decode, created with the caches
+        self.stages = None
+        # (key, future of items) of the next job, encoded in background
+        self.prefetch = None
+        # Available textual inversions, created with the caches
+        self.ti_manifest = None
+        # Result keys of the previous seeded job, to skip repeats of it
+        self.last_result_keys = None
+        # Values of the job skipped as a repeat, skipped again without
+        # starting a job until values change
+        self.repeat_values = None
+        # Latent previews during denoising, created with the caches
+        self.previews = None
+
     def _load_model(
         self,
         state,
@@ -109,42 +120,151 @@ class SDPipes:
         lora_path="",
         lora_alpha=0.75,
     ):
+        if self.cache is None:
+            self.cache = PipelineCache.from_config(state.pipeline_cache)
+            self.embed_cache = EmbeddingCache(
+                state.embedding_cache.get("max_entries", 64)
+            )
+            # Embeddings of an evicted pipeline are never used again
+            self.cache.on_evict = self.embed_cache.drop
+            self.encoding_mode = state.prompt_encoding.get("mode", "blend")
+            if self.encoding_mode not in ENCODING_MODES:
+                print(
+                    f"[WARN] Unknown prompt encoding mode {self.encoding_mode}, use blend"
+                )
+                self.encoding_mode = "blend"
+            self.max_chunks = max(1, int(state.prompt_encoding.get("max_chunks", 3)))
+            self.stages = StageRunner.from_config(state.overlap_conf)
+            self.ti_manifest = TIManifest.from_config(
+                state.models_root, state.state_root, state.textual_inversion
+            )
+            self.previews = PreviewChannel.from_config(
+                state.job_root, state.mask, state.previews_conf
+            )
+
+        # Background stages use the current pipeline
+        self._drain_stages()
+
+        # Drop references to the current pipeline, the cache owns it.
+        # model_path is reset so a failed load is retried next time
+        self.model_path = None
+        self.txt2img = None
+        self.img2img = None
+        self.entry = None
+
+        # LoRAs are not part of the key, they are applied in place
+        key = (path, clip_skip)
+        entry = self.cache.get(key)
+        if entry is None:
+            # Park or evict cached pipelines before loading a new one
+            self.cache.make_room()
+            txt2img, img2img = self._build_pipelines(state, path, dtype, clip_skip)
+            entry = self.cache.put(key, txt2img, img2img)
+        else:
+            print(f"[INFO] Use cached pipeline {key}")
+
+        # Done, update variables
+        self.model_path = path
+        self.clip_skip = clip_skip
+        self.entry = entry
+        self.txt2img = entry.txt2img
+        self.img2img = entry.img2img
+        self.default_scheduler = entry.default_scheduler
+        self.lora = entry.lora
+        self._update_lora(state, lora_path, lora_alpha)
+
+    def _is_deterministic(self, params):
+        "Check if seeded params give the same items every time"
+        try:
+            if float(params["size_range"]) > 0:
+                return False
+        except (KeyError, TypeError, ValueError):
+            pass
+        if get_seed(params, "prompt_seed") is not None:
+            # Choices are sampled from the given seed
+            return True
+        return not any(
+            has_choices(params[key]) for key in ["prompt", "negative_prompt"]
+        )
+
+    def is_repeat(self, values):
+        "Check if values are those of the last job skipped as a repeat"
+        return self.repeat_values is not None and self.repeat_values == json.dumps(
+            values, sort_keys=True
+        )
+
+    def _drain_stages(self):
+        "Wait for background stages, and drop the prefetched items"
+        self.prefetch = None
+        if self.stages is not None:
+            self.stages.drain()
+
+    def close(self):
+        if self.stages is not None:
+            self.stages.close()
+        if self.previews is not None:
+            self.previews.close()
+
+    def _preview(self, latents, step, meta):
+        "Queue a latent preview every few steps (see preview.py)"
+        if self.previews is not None and latents is not None and self.previews.wants(step):
+            self.previews.submit(latents, {"step": int(step), **meta})
+
+    def _update_lora(self, state, lora_path, lora_alpha):
+        # Text encoder weights are changed: wait for prefetch
+        self._drain_stages()
+        # Reset first, so a failed LoRA load is retried next time
+        self.lora_path = None
+        self.lora_alpha = None
+        with state.stage_times.measure("load_lora"):
+            self.lora.apply([(lora_path, lora_alpha)])
+        self.lora_path = lora_path
+        self.lora_alpha = lora_alpha
+        state.stats["pipeline_cache"] = self.cache.stats()
+
+    def _embed_model_key(self):
+        "Identity of the text encoder state, for prompt embedding cache"
+        return (
+            self.entry.serial,
+            self.clip_skip,
+            tuple(sorted(self.lora.applied.items())),
+            # Grows when textual inversion tokens are added
+            len(self.txt2img.tokenizer),
+        )
+
+    def _build_pipelines(self, state, path, dtype, clip_skip):
         # Create kwargs
         kwargs = {}
 
-        # Remove old model
-        if self.txt2img is not None:
-            del self.txt2img
-            # Clean cuda cache
-            if torch_device() == "cuda":
-                torch.cuda.empty_cache()
-
         # Create txt2img pipeline
         print(f"[INFO] Loading pipeline from {path}")
         print(f"       kwargs = {kwargs}")
-        try:
-            txt2img = DiffusionPipeline.from_pretrained(
-                path,
-                **kwargs,
-                torch_dtype=dtype,
-                local_files_only=True,
-            )
-        except Exception as e:
-            print(f"[ERROR] Cannot load model {path}: {e}")
-            raise Exception(f"Cannot load model {path}, please check selected model")
-
-        # Clip skip
-        print(f"[INFO] Clip skip {clip_skip}")
-        if clip_skip > 0:
-            txt2img.text_encoder = CLIPTextModel.from_pretrained(
-                path,
-                torch_dtype=dtype,
-                subfolder="text_encoder",
-                num_hidden_layers=(
-                    txt2img.text_encoder.config.num_hidden_layers - clip_skip
-                ),
-                local_files_only=True,
-            )
+        txt2img = None
+        if state.fast_load:
+            try:
+                txt2img = fast_load_pipeline(
+                    path, dtype, torch_device(), state.stage_times, clip_skip
+                )
+                print(f"[INFO] Fast loaded, clip skip {clip_skip}")
+            except Exception as e:
+                print(f"[WARN] Fast load failed, use from_pretrained: {e}")
+        if txt2img is None:
+            try:
+                with state.stage_times.measure("load_pretrained"):
+                    txt2img = DiffusionPipeline.from_pretrained(
+                        path,
+                        **kwargs,
+                        torch_dtype=dtype,
+                        local_files_only=True,
+                    )
+            except Exception as e:
+                print(f"[ERROR] Cannot load model {path}: {e}")
+                raise Exception(f"Cannot load model {path}, please check selected model")
+
+            # Clip skip: drop last layers of the loaded text encoder
+            print(f"[INFO] Clip skip {clip_skip}")
+            if clip_skip > 0:
+                truncate_text_encoder(txt2img.text_encoder, clip_skip)
         print(
             f"[INFO] CLIP num hidden layers = {txt2img.text_encoder.config.num_hidden_layers}"
         )
@@ -152,39 +272,11 @@ class SDPipes:
         # Disable safety checker for performance
         txt2img.safety_checker = None
 
-        # Load Lora
-        if lora_path != "":
-            print(f"[INFO] Loading Lora from {lora_path}")
-            load_safetensors_lora(txt2img, lora_path, alpha=lora_alpha)
-
-        # Load Textual Inversion
-        for root, dirs, files in os.walk(state.models_root):
-            # Check if root is textual inversion root
-            base = os.path.basename(root)
-            base.lower()
-            base = re.sub("[^a-z0-9]+", "", base)
-            if base == "textualinversion" or base == "textualinversions":
-                print(f"[INFO] Found textual inversion root {root}")
-                for f in files:
-                    ti_path = os.path.join(root, f)
-                    if ti_path.endswith(".pt") or ti_path.endswith(".safetensors"):
-                        token = pathlib.Path(ti_path).stem
-                        print(
-                            f"[INFO] Loading textual inversion from {path} as {token}"
-                        )
-                        try:
-                            txt2img.load_textual_inversion(
-                                ti_path,
-                                token=token,
-                            )
-                        except Exception as e:
-                            print(
-                                f"[WARNING] Cannot load textual inversion {ti_path}: {e}"
-                            )
-                            print(f"[WARINIG] just ignore {token}")
-
-        # Send to device
-        txt2img = txt2img.to(torch_device())
+        # Textual inversions are loaded on demand, by prompts
+
+        # Send to device (no-op after fast load)
+        with state.stage_times.measure("load_transfer"):
+            txt2img = txt2img.to(torch_device())
 
         txt2img.scheduler = DPMSolverMultistepScheduler.from_config(
             txt2img.scheduler.config
@@ -205,7 +297,7 @@ class SDPipes:
 
             txt2img.unet.set_attn_processor(AttnProcessor2_0())
 
-        if torch_device() == "cuda":
+        if torch_device_type() == "cuda":
             # txt2img.unet = torch.compile(txt2img.unet)
             try:
                 import xformers
@@ -228,27 +320,29 @@ class SDPipes:
             requires_safety_checker=False,
         ).to(torch_device())
 
-        # Done, update variables
-        self.model_path = path
-        self.clip_skip = clip_skip
-        self.lora_path = lora_path
-        self.lora_alpha = lora_alpha
-        self.txt2img = txt2img
-        self.img2img = img2img
-        self.default_scheduler = txt2img.scheduler
+        return txt2img, img2img
 
     def _txt2img_load_model(self, state):
         print("[INFO] SDPipes: load_model")
         state.write_state("load_model", {})
         values = state.values
         lora_path = "" if len(values['model']['lora_path']) == 0 else f"{state.models_root}/{values['model']['lora_path']}"
-        self._load_model(
-            state,
-            f"{state.models_root}/{values['model']['path']}",
-            clip_skip=values["model"]["clip_skip"],
-            lora_path=lora_path,
-            lora_alpha=values["model"]["lora_alpha"],
-        )
+        with state.stage_times.measure("load_model"):
+            self._load_model(
+                state,
+                f"{state.models_root}/{values['model']['path']}",
+                clip_skip=values["model"]["clip_skip"],
+                lora_path=lora_path,
+                lora_alpha=values["model"]["lora_alpha"],
+            )
+        return self._txt2img_update_prompt(state)
+
+    def _txt2img_update_lora(self, state):
+        print("[INFO] SDPipes: update_lora")
+        state.write_state("update_lora", {})
+        values = state.values
+        lora_path = "" if len(values['model']['lora_path']) == 0 else f"{state.models_root}/{values['model']['lora_path']}"
+        self._update_lora(state, lora_path, values["model"]["lora_alpha"])
         return self._txt2img_update_prompt(state)
 
     def _txt2img_update_prompt(self, state):
@@ -256,96 +350,144 @@ class SDPipes:
         state.write_state("update_prompt", {})
         values = state.values
         params = values["params"]
-        self.prompt.update_embed(params["prompt"], self.txt2img)
-        self.negative_prompt.update_embed(params["negative_prompt"], self.txt2img)
-        # Prompt may changed because of random choose. put the values in state
-        state.values["choosed_prompt"] = {
-            "positive": self.prompt.pp_text,
-            "negative": self.negative_prompt.pp_text,
-        }
+        with state.stage_times.measure("prompt"):
+            # Wait for prefetch first, it uses the tokenizer and text encoder
+            prefetched = self._wait_prefetch()
+            # Load textual inversions used by prompts
+            with state.stage_times.measure("load_ti"):
+                self.ti_manifest.load_for(
+                    self.txt2img,
+                    self.entry.textual_inversions,
+                    [params["prompt"], params["negative_prompt"]],
+                )
+            model_key = self._embed_model_key()
+            key = self._prefetch_key(params, model_key)
+            self.items = None
+            if prefetched is not None and prefetched[0] == key:
+                self.items = prefetched[1]
+            if self.items is None:
+                self.items = self._encode_items(params, model_key, state.stage_times)
+        state.job["embedding_cache"] = self.embed_cache.stats()
+        state.stats["embedding_cache"] = state.job["embedding_cache"]
         return self._txt2img_generate(state)
 
-    def _update_sampling_method(self, name):
-        print(f"[INFO] SDPipes: update_sampling_method to {name}")
-        new_scheduler = self.default_scheduler
-        if name == "Euler":
-            new_scheduler = EulerDiscreteScheduler.from_config(new_scheduler.config)
-        elif name == "Euler A":
-            new_scheduler = EulerAncestralDiscreteScheduler.from_config(
-                new_scheduler.config
-            )
-        elif name == "LMS":
-            new_scheduler = LMSDiscreteScheduler.from_config(new_scheduler.config)
-        elif name == "Heun":
-            new_scheduler = HeunDiscreteScheduler.from_config(new_scheduler.config)
-        elif name == "DDIM":
-            new_scheduler = DDIMScheduler.from_config(new_scheduler.config)
-        elif name == "DDIM Inverse":
-            new_scheduler = DDIMInverseScheduler.from_config(new_scheduler.config)
-        elif name == "DDPM":
-            new_scheduler = DDPMScheduler.from_config(new_scheduler.config)
-        elif name == "DPM++ 2S":
-            new_scheduler = DPMSolverSinglestepScheduler.from_config(
-                new_scheduler.config
-            )
-            new_scheduler.solver_order = 2
-            new_scheduler.algorithm_type = "dpmsolver++"
-        elif name == "DPM++ 2M":
-            new_scheduler = DPMSolverMultistepScheduler.from_config(
-                new_scheduler.config
-            )
-            new_scheduler.solver_order = 2
-            new_scheduler.algorithm_type = "dpmsolver++"
-            new_scheduler.use_karras_sigmas = False
-        elif name == "DPM++ 2M Karras":
-            new_scheduler = DPMSolverMultistepScheduler.from_config(
-                new_scheduler.config
-            )
-            new_scheduler.solver_order = 2
-            new_scheduler.algorithm_type = "dpmsolver++"
-            new_scheduler.use_karras_sigmas = True
-        elif name == "DPM++ 3S":
-            new_scheduler = DPMSolverSinglestepScheduler.from_config(
-                new_scheduler.config
-            )
-            new_scheduler.solver_order = 3
-            new_scheduler.algorithm_type = "dpmsolver++"
-        elif name == "DPM++ 3M":
-            new_scheduler = DPMSolverMultistepScheduler.from_config(
-                new_scheduler.config
+    def _encode_items(self, params, model_key, times=None):
+        """
+        Expand random prompts and encode them for each item of the batch.
+        Choices of item i are sampled from its prompt_seed: params
+        prompt_seed + i if it is given (to reproduce a recorded expansion),
+        otherwise random, so a fixed image seed still explores variants.
+        """
+        items = []
+        seed = get_seed(params, "prompt_seed")
+        for i in range(get_batch_size(params)):
+            if seed is not None:
+                prompt_seed = seed + i
+            else:
+                prompt_seed = random.getrandbits(32)
+            rng = random.Random(prompt_seed)
+            for prompt, text in [
+                (self.prompt, params["prompt"]),
+                (self.negative_prompt, params["negative_prompt"]),
+            ]:
+                prompt.update_embed(
+                    text,
+                    self.txt2img,
+                    self.embed_cache,
+                    model_key,
+                    rng,
+                    mode=self.encoding_mode,
+                    max_chunks=self.max_chunks,
+                    times=times,
+                )
+            items.append(
+                {
+                    "prompt_embeds": self.prompt.embeds,
+                    "negative_prompt_embeds": self.negative_prompt.embeds,
+                    # Prompt may changed because of random choose. put the values in job
+                    "info": {
+                        "choosed_prompt": {
+                            "positive": self.prompt.pp_text,
+                            "negative": self.negative_prompt.pp_text,
+                        },
+                        "prompt_seed": prompt_seed,
+                    },
+                }
             )
-            new_scheduler.solver_order = 3
-            new_scheduler.algorithm_type = "dpmsolver++"
-            new_scheduler.use_karras_sigmas = False
-        elif name == "DPM++ 3M Karras":
-            new_scheduler = DPMSolverMultistepScheduler.from_config(
-                new_scheduler.config
+        # Long prompts have more chunks. Embeddings of a batch, positive and
+        # negative, must have the same length: pad them with empty chunks
+        length = max(
+            max(item["prompt_embeds"].shape[1], item["negative_prompt_embeds"].shape[1])
+            for item in items
+        )
+        empty = self.prompt.empty_embeds
+        for item in items:
+            item["prompt_embeds"] = pad_embeds(item["prompt_embeds"], empty, length)
+            item["negative_prompt_embeds"] = pad_embeds(
+                item["negative_prompt_embeds"], empty, length
             )
-            new_scheduler.solver_order = 3
-            new_scheduler.algorithm_type = "dpmsolver++"
-            new_scheduler.use_karras_sigmas = True
-        elif name == "PNDM":
-            new_scheduler = PNDMScheduler.from_config(new_scheduler.config)
-        elif name == "IPNDM":
-            new_scheduler = IPNDMScheduler.from_config(new_scheduler.config)
-        else:
-            print(f"[ERROR] Unknown sampling method: {name}")
-        # Change scheduler
-        self.txt2img.scheduler = new_scheduler
-        self.img2img.scheduler = new_scheduler
-
-    def _txt2img_generate(self, state):
-        print("[INFO] SDPipes: generate")
-        values = state.values
-        params = values["params"]
+        return items
+
+    def _prefetch_key(self, params, model_key):
+        return (
+            model_key,
+            params["prompt"],
+            params["negative_prompt"],
+            get_batch_size(params),
+            get_seed(params, "prompt_seed"),
+        )
 
-        state.write_state("setup_params", {})
-        kwargs = {}
+    def _start_prefetch(self, state):
+        """
+        Encode prompts of the next job in background, assuming it has the
+        same values (the daemon repeats values unless they are changed)
+        """
+        if not self.stages.enabled:
+            return
+        params = copy.deepcopy(state.values["params"])
+        model_key = self._embed_model_key()
+
+        def prefetch():
+            with state.stage_times.measure("prefetch"):
+                return self._encode_items(params, model_key, state.stage_times)
+
+        self.prefetch = (
+            self._prefetch_key(params, model_key),
+            self.stages.submit(prefetch),
+        )
 
-        # Check params and generate
-        kwargs["num_inference_steps"] = params["sampling_steps"]
-        kwargs["guidance_scale"] = params["cfg_scale"]
+    def _wait_prefetch(self):
+        "Wait for prefetch and return (key, items), or None"
+        if self.prefetch is None:
+            return None
+        key, future = self.prefetch
+        self.prefetch = None
+        try:
+            return key, future.result()
+        except Exception as e:
+            print(f"[WARN] Prompt prefetch failed, encode again: {e}")
+            return None
+
+    def _decode_images(self, pipe, latents, stage_times):
+        "VAE decode latents, and convert them into PIL images"
+        with stage_times.measure("decode"):
+            image = pipe.vae.decode(latents / pipe.vae.config.scaling_factor).sample
+            image = (image / 2 + 0.5).clamp(0, 1)
+            image = image.cpu().permute(0, 2, 3, 1).float().numpy()
+            return pipe.numpy_to_pil(image)
+
+    def _update_sampling_method(self, state, name):
+        # Schedulers are kept while the sampling method is not changed
+        if self.entry.sampler_name == name:
+            return
+        print(f"[INFO] SDPipes: update_sampling_method to {name}")
+        # Change scheduler. Each pipeline has own one, they keep step states
+        with state.stage_times.measure("scheduler"):
+            self.txt2img.scheduler = self.schedulers.get(self.default_scheduler, name)
+            self.img2img.scheduler = self.schedulers.get(self.default_scheduler, name)
+        self.entry.sampler_name = name
 
+    def _item_size(self, params):
         # Put size
         w = int(params["width"])
         h = int(params["height"])
@@ -359,95 +501,322 @@ class SDPipes:
                 h = int(area / w)
         except:
             print("[WARNING] Invalid size range, ignore it.")
-        w = filter_image_size(w)
-        h = filter_image_size(h)
+        return filter_image_size(w), filter_image_size(h)
+
+    def _group_items(self, params):
+        """
+        Set size and seed of each item, and group items which can run in
+        a single batch (same size).
+        size_policy "shared": one random size for the whole batch.
+        size_policy "per_item": random size per item, grouped by size.
+        """
+        policy = params.get("size_policy", "shared")
+        size = self._item_size(params)
+        seed = get_seed(params)
+        if seed is None and params["seed"] != "":
+            print("[WARNING] Invalid seed ignore it.")
+        groups = {}
+        for i, item in enumerate(self.items):
+            if policy == "per_item" and i > 0:
+                size = self._item_size(params)
+            w, h = size
+            item["info"]["fixed_size"] = {
+                "w": w,
+                "h": h,
+            }
+            # Each item has own seed, so every output can be reproduced
+            item["seed"] = None
+            if seed is not None:
+                item["seed"] = seed + i
+                item["info"]["seed"] = seed + i
+            item["info"]["batch_index"] = i
+            if size not in groups:
+                groups[size] = []
+            groups[size].append(item)
+        return list(groups.items())
+
+    def _set_result_keys(self, state, params, groups):
+        """
+        Set canonical hashes of seeded items: info["result_key"] of the
+        output, and item["base_key"] of latents before highres fix.
+        Return keys of all outputs, or None if items are not seeded
+        """
+        job = {
+            "version": RESULT_CACHE_VERSION,
+            "device": torch_device_type(),
+            "model": [self.model_path, file_stamp(self.model_path)],
+            "clip_skip": self.clip_skip,
+            "lora": [self.lora_path, file_stamp(self.lora_path), self.lora_alpha],
+            "encoding": [self.encoding_mode, self.max_chunks],
+            "sampler": params["sampling_method"],
+            "steps": int(params["sampling_steps"]),
+            "cfg_scale": float(params["cfg_scale"]),
+        }
+        keys = []
+        for (w, h), items in groups:
+            for item in items:
+                item["base_key"] = None
+                if item["seed"] is None:
+                    keys.append(None)
+                    continue
+                prompts = item["info"]["choosed_prompt"]
+                textual_inversions = sorted(
+                    (token, path, file_stamp(path))
+                    for token, path in self.entry.textual_inversions.items()
+                    if token in prompts["positive"] or token in prompts["negative"]
+                )
+                item["base_key"] = result_key(
+                    {
+                        **job,
+                        "prompts": prompts,
+                        "textual_inversions": textual_inversions,
+                        # Embeddings of a batch are padded to the same length
+                        "tokens": item["prompt_embeds"].shape[1],
+                        "size": [w, h],
+                        "seed": item["seed"],
+                    }
+                )
+                item["info"]["result_key"] = result_key(
+                    {
+                        "base": item["base_key"],
+                        "highres_fix": params["highres_fix"],
+                        "image_format": state.image_format,
+                        "image_quality": state.image_quality,
+                    }
+                )
+                keys.append(item["info"]["result_key"])
+        if None in keys:
+            return None
+        return tuple(keys)
+
+    def _cached_latents(self, cache, items):
+        "Latents before highres fix of items from the result cache, or None"
+        loaded = []
+        for item in items:
+            hit = cache.get(item["base_key"])
+            if hit is None:
+                return None
+            loaded.append(
+                torch.load(io.BytesIO(hit[0]), map_location=torch_device(), weights_only=True)
+            )
+        return torch.cat(loaded)
 
-        kwargs["width"] = w
-        kwargs["height"] = h
+    def _cache_latents(self, state, cache, items, latents):
+        "Keep latents before highres fix of seeded items"
+        try:
+            with state.stage_times.measure("result_cache"):
+                for i, item in enumerate(items):
+                    if item["base_key"] is None:
+                        continue
+                    buffered = io.BytesIO()
+                    torch.save(latents[i : i + 1].cpu().clone(), buffered)
+                    cache.put(item["base_key"], buffered.getvalue(), ".pt")
+        except Exception as e:
+            print(f"[WARN] Cannot put latents into cache: {e}")
 
-        state.job["values"]["fixed_size"] = {
-            "w": w,
-            "h": h,
-        }
+    def _txt2img_generate(self, state):
+        print("[INFO] SDPipes: generate")
+        values = state.values
+        params = values["params"]
 
-        # If seed is given, use it
-        if params["seed"] != "":
-            try:
-                s = int(params["seed"])
-                kwargs["generator"] = [
-                    torch.Generator(device=torch_device()).manual_seed(s)
-                ]
-            except:
-                print("[WARNING] Invalid seed ignore it.")
+        state.write_state("setup_params", {})
+        groups = self._group_items(params)
+
+        cache = state.get_result_cache()
+        keys = None
+        if cache is not None:
+            keys = self._set_result_keys(state, params, groups)
+            # The daemon repeats its values. A deterministic job same as the
+            # previous one has the same outputs: do not write them again.
+            # Other jobs may expand differently next time, so a repeat of
+            # them is only a cache hit
+            if (
+                keys is not None
+                and keys == self.last_result_keys
+                and state.queued is None
+                and self._is_deterministic(params)
+            ):
+                print("[INFO] SDPipes: same seeded job as the previous one, skip")
+                self.repeat_values = json.dumps(state.values, sort_keys=True)
+                state.write_state("done", {})
+                return []
+        self.repeat_values = None
 
         # Change sampling method
         state.write_state("update_sampler", {})
-        self._update_sampling_method(params["sampling_method"])
+        self._update_sampling_method(state, params["sampling_method"])
+
+        # Encode prompts of the next job while the UNet runs
+        self._start_prefetch(state)
+
+        results = []
+        for g, ((w, h), items) in enumerate(groups):
+            # Outputs of cached items are used as is
+            outputs = [None] * len(items)
+            if cache is not None:
+                for i, item in enumerate(items):
+                    hit = cache.get(item["info"].get("result_key"))
+                    if hit is not None:
+                        item["info"]["result_cache"] = "hit"
+                        outputs[i] = (CachedOutput(*hit), item["info"])
+            run = [item for item, output in zip(items, outputs) if output is None]
+            if len(run) == 0:
+                print(f"[INFO] SDPipes: group {g} is cached")
+                results.extend(outputs)
+                continue
+
+            pipe, latents = self._txt2img_group(state, params, g, len(groups), run, w, h)
+
+            # Decode the last latents in background. Outputs are resolved
+            # by the writer, so the next job can start denoising
+            decoded = self.stages.submit(
+                self._decode_images, pipe, latents, state.stage_times
+            )
+            deferred = iter([Deferred(decoded, i) for i in range(len(run))])
+            results.extend(
+                output if output is not None else (next(deferred), item["info"])
+                for item, output in zip(items, outputs)
+            )
+
+        # Return images and info of each item
+        if cache is not None:
+            state.stats["result_cache"] = cache.stats()
+        self.last_result_keys = keys
+        state.stats["stage_times"] = state.stage_times.stats()
+        state.write_state("done", {})
+        return results
+
+    def _txt2img_group(self, state, params, g, total_groups, items, w, h):
+        "Denoise items of a group of the same size, and run highres fix"
+        highres_fix = params["highres_fix"]
+        cache = state.get_result_cache()
+        latents = None
+        if len(highres_fix) > 0 and cache is not None:
+            # Only the highres chain changed: reuse the first pass
+            latents = self._cached_latents(cache, items)
+            if latents is not None:
+                print(f"[INFO] SDPipes: group {g} uses cached latents before highres fix")
+        if latents is None:
+            latents = self._txt2img_denoise(state, params, g, total_groups, items, w, h)
+            if len(highres_fix) > 0 and cache is not None:
+                self._cache_latents(state, cache, items, latents)
+        if len(highres_fix) == 0:
+            return self.txt2img, latents
+        return self.img2img, self._txt2img_highres_fix(state, latents, items)
+
+    def _txt2img_denoise(self, state, params, g, total_groups, items, w, h):
+        "Run txt2img of items. Return latents"
+        kwargs = {}
+
+        # Check params and generate
+        kwargs["num_inference_steps"] = params["sampling_steps"]
+        kwargs["guidance_scale"] = params["cfg_scale"]
 
         # Generate
         state.write_state("start_generate", {})
         total_steps = int(params["sampling_steps"])
+        step_timer = StepTimer(state.stage_times, "unet_step")
 
         def callback(step, timestep, latents):
+            if latents is not None:
+                step_timer.step()
+            self._preview(latents, step, {"stage": "txt2img", "total_steps": total_steps})
             state.write_state(
                 "txt2img",
                 {
                     "step": int(step),
                     "total_steps": total_steps,
+                    "group": g,
+                    "total_groups": total_groups,
                 },
             )
 
-        result = self.txt2img(
-            # prompt=self.prompt.text,
-            # negative_prompt=self.negative_prompt.text,
-            prompt_embeds=self.prompt.embeds,
-            negative_prompt_embeds=self.negative_prompt.embeds,
-            num_images_per_prompt=1,
-            return_dict=True,
-            callback=callback,
-            **kwargs,
-        )
-        callback(total_steps, 0, None)
-
-        # If highres,
-        highres_fix = params["highres_fix"]
-        if len(highres_fix) > 0:
-            return self._txt2img_highres_fix(state, result.images[0])
-
-        # Return image
-        state.write_state("done", {})
-        return result.images[0]
+        # If seed is given, use it
+        kwargs["generator"] = self._item_generators(items)
 
-    def _txt2img_highres_fix(self, state, img):
+        with state.stage_times.measure("denoise"):
+            result = self.txt2img(
+                # prompt=self.prompt.text,
+                # negative_prompt=self.negative_prompt.text,
+                prompt_embeds=torch.cat([item["prompt_embeds"] for item in items]),
+                negative_prompt_embeds=torch.cat(
+                    [item["negative_prompt_embeds"] for item in items]
+                ),
+                num_images_per_prompt=1,
+                return_dict=True,
+                callback=callback,
+                width=w,
+                height=h,
+                output_type="latent",
+                **kwargs,
+            )
+        callback(total_steps, 0, None)
+        return result.images
+
+    def _item_generators(self, items):
+        "Generator of each seeded item, or None"
+        if items[0]["seed"] is None:
+            return None
+        return [
+            torch.Generator(device=torch_device()).manual_seed(item["seed"])
+            for item in items
+        ]
+
+    def _txt2img_highres_fix(self, state, latents, items):
+        """
+        Run highres fix passes on latents. Return latents of the last pass.
+        mode "pixel" (default): decode, resize with LANCZOS, and run img2img.
+        mode "latent": resize latents on the device with `interpolation`,
+        and run img2img from them without VAE decode/encode.
+        """
         values = state.values
         params = values["params"]
         highres_fix = params["highres_fix"]
+        prompt_embeds = torch.cat([item["prompt_embeds"] for item in items])
+        negative_prompt_embeds = torch.cat(
+            [item["negative_prompt_embeds"] for item in items]
+        )
 
+        # Output of the previous pass: latents, or images after decode
+        images = None
+        scale_factor = self.img2img.vae_scale_factor
         for c, hf in enumerate(highres_fix):
-            print(f"[INFO] SDPipes: highres_fix - {c}")
+            mode = hf.get("mode", "pixel")
+            print(f"[INFO] SDPipes: highres_fix - {c} ({mode})")
             state.write_state("setup_highres_params", {})
             # Get Size
+            if images is not None:
+                width, height = images[0].width, images[0].height
+            else:
+                width = latents.shape[3] * scale_factor
+                height = latents.shape[2] * scale_factor
             if "scale" in hf:
                 hf_scale = float(hf["scale"])
                 hf_scale = min(max(hf_scale, 0.1), 10.0)
-                hf_width = int(img.width * hf_scale)
-                hf_height = int(img.height * hf_scale)
+                hf_width = int(width * hf_scale)
+                hf_height = int(height * hf_scale)
             else:
                 hf_width = filter_image_size(hf["width"])
                 hf_height = filter_image_size(hf["height"])
-            # Resize
-            img = img.resize((hf_width, hf_height), PIL.Image.LANCZOS)
 
             kwargs = {}
             kwargs["num_inference_steps"] = params["sampling_steps"]
             kwargs["guidance_scale"] = params["cfg_scale"]
             kwargs["strength"] = hf["strength"]
+            # Seeded items get the same noise in each run
+            kwargs["generator"] = self._item_generators(items)
 
             # Generation
             state.write_state("start_highres_fix", {})
             total_steps = int(params["sampling_steps"] * hf["strength"])
+            step_timer = None
 
             def callback(step, timestep, latents):
+                if latents is not None:
+                    step_timer.step()
+                self._preview(
+                    latents, step, {"stage": f"highres_fix_{c}", "total_steps": total_steps}
+                )
                 state.write_state(
                     "highres_fix",
                     {
@@ -457,22 +826,102 @@ class SDPipes:
                     },
                 )
 
-            result = self.img2img(
-                image=img,
-                # prompt=self.prompt.text,
-                # negative_prompt=self.negative_prompt.text,
-                prompt_embeds=self.prompt.embeds,
-                negative_prompt_embeds=self.negative_prompt.embeds,
-                num_images_per_prompt=1,
-                callback=callback,
-                **kwargs,
-            )
+            if mode == "latent":
+                if latents is None:
+                    latents = self._encode_images(self.img2img, images)
+                latents = resize_latents(
+                    latents,
+                    filter_image_size(hf_width) // scale_factor,
+                    filter_image_size(hf_height) // scale_factor,
+                    hf.get("interpolation", "bilinear"),
+                )
+                step_timer = StepTimer(state.stage_times, "unet_step")
+                with state.stage_times.measure(f"highres_{c}"):
+                    latents = self._img2img_latents(
+                        latents, prompt_embeds, negative_prompt_embeds, callback, **kwargs
+                    )
+            else:
+                if images is None:
+                    images = self._decode_images(self.img2img, latents, state.stage_times)
+                # Resize
+                images = [
+                    img.resize((hf_width, hf_height), PIL.Image.LANCZOS)
+                    for img in images
+                ]
+                step_timer = StepTimer(state.stage_times, "unet_step")
+                with state.stage_times.measure(f"highres_{c}"):
+                    result = self.img2img(
+                        image=images,
+                        # prompt=self.prompt.text,
+                        # negative_prompt=self.negative_prompt.text,
+                        prompt_embeds=prompt_embeds,
+                        negative_prompt_embeds=negative_prompt_embeds,
+                        num_images_per_prompt=1,
+                        callback=callback,
+                        output_type="latent",
+                        **kwargs,
+                    )
+                latents = result.images
+            images = None
             callback(total_steps, 0, None)
-            img = result.images[0]
-        state.write_state("done", {})
-        return img
+        return latents
+
+    def _encode_images(self, pipe, images):
+        "VAE encode PIL images into latents"
+        x = np.stack([np.asarray(img.convert("RGB")) for img in images])
+        x = torch.from_numpy(x).permute(0, 3, 1, 2).float() / 127.5 - 1.0
+        x = x.to(device=pipe.vae.device, dtype=pipe.vae.dtype)
+        return pipe.vae.encode(x).latent_dist.mean * pipe.vae.config.scaling_factor
+
+    def _img2img_latents(
+        self,
+        latents,
+        prompt_embeds,
+        negative_prompt_embeds,
+        callback,
+        num_inference_steps,
+        guidance_scale,
+        strength,
+        generator=None,
+    ):
+        """
+        img2img from latents: same steps as StableDiffusionImg2ImgPipeline
+        after its VAE encode, and returns latents
+        """
+        pipe = self.img2img
+        device = latents.device
+        scheduler = pipe.scheduler
+        scheduler.set_timesteps(num_inference_steps, device=device)
+        timesteps, _ = pipe.get_timesteps(num_inference_steps, strength, device)
+        if len(timesteps) == 0:
+            return latents
+        # Add noise of the first timestep
+        latent_timestep = timesteps[:1].repeat(latents.shape[0])
+        noise = randn_tensor(
+            latents.shape, generator=generator, device=device, dtype=latents.dtype
+        )
+        latents = scheduler.add_noise(latents, noise, latent_timestep)
+
+        do_cfg = guidance_scale > 1.0
+        if do_cfg:
+            embeds = torch.cat([negative_prompt_embeds, prompt_embeds])
+        else:
+            embeds = prompt_embeds
+        # Ancestral samplers draw noise in each step
+        extra_step_kwargs = pipe.prepare_extra_step_kwargs(generator, 0.0)
+        for i, t in enumerate(timesteps):
+            model_input = torch.cat([latents] * 2) if do_cfg else latents
+            model_input = scheduler.scale_model_input(model_input, t)
+            noise_pred = pipe.unet(model_input, t, encoder_hidden_states=embeds).sample
+            if do_cfg:
+                noise_uncond, noise_text = noise_pred.chunk(2)
+                noise_pred = noise_uncond + guidance_scale * (noise_text - noise_uncond)
+            latents = scheduler.step(noise_pred, t, latents, **extra_step_kwargs).prev_sample
+            callback(i, t, latents)
+        return latents
 
     def text_to_image(self, state):
+        "Run a job. Return list of (image, info) for each item of the batch"
         with torch.inference_mode():
             values = state.values
             params = values["params"]
@@ -483,9 +932,13 @@ class SDPipes:
             if (
                 self.model_path != f"{state.models_root}/{values['model']['path']}"
                 or self.clip_skip != values["model"]["clip_skip"]
-                or self.lora_path != lora_path
-                or self.lora_alpha != values['model']['lora_alpha']
             ):
                 return self._txt2img_load_model(state)
+            # If LoRA changed, update weights in place
+            if (
+                self.lora_path != lora_path
+                or self.lora_alpha != values['model']['lora_alpha']
+            ):
+                return self._txt2img_update_lora(state)
             # Otherwise, run from update_prompt
             return self._txt2img_update_prompt(state)
@@ -0,0 +1,130 @@
+import threading
+import time
+from io import BytesIO
+
+import PIL.Image
+import torch
+
+from .container import encode_container, write_bytes
+
+"""
+Latent previews and thumbnails
+
+While the UNet denoises, every `every` steps the latents of the first item
+are projected to RGB with a fixed linear map (no VAE), at latent
+resolution (1/8 of the image). The projection is queued on the device in
+the step callback; moving it to the host, encoding and writing happen on
+the preview thread. The channel keeps only the latest preview and writes at
+most one per `interval` seconds, so a slow disk never stalls denoising.
+The preview is state/preview.ab (a masked container, see container.py).
+
+Each output also gets a small thumbnail, outputs/thumbs/<name>.ab, with the
+same metadata as the output, so the gallery does not load full images.
+"""
+
+# Latent channels -> RGB of SD 1.x/2.x latents (approximation of the VAE)
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+THUMBS_DIR = "thumbs"
+
+
+def latents_to_rgb(latents):
+    "Project latents (N, 4, h, w) to RGB uint8 (N, h, w, 3) on the same device"
+    factors = torch.tensor(LATENT_RGB_FACTORS, device=latents.device)
+    rgb = torch.einsum("nchw,cr->nhwr", latents.float(), factors)
+    return ((rgb + 1.0) * 127.5).clamp(0, 255).to(torch.uint8)
+
+
+def encode_image(img, image_format, quality):
+    buffered = BytesIO()
+    img.save(buffered, format=image_format, quality=quality)
+    return buffered.getvalue()
+
+
+def make_thumbnail(img, size):
+    "Copy of img which fits in size x size"
+    thumb = img.copy()
+    thumb.thumbnail((size, size), PIL.Image.BILINEAR)
+    return thumb
+
+
+class PreviewChannel:
+    def __init__(self, path, mask, every=5, interval=0.5, image_format="webp", quality=80):
+        self.path = path
+        self.mask = mask
+        self.every = max(1, int(every))
+        self.interval = float(interval)
+        self.image_format = image_format
+        self.quality = int(quality)
+        self.last_submit = 0.0
+        # Latest preview not written yet: (rgb, meta)
+        self.pending = None
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(
+            target=self._run, name="aroma-preview", daemon=True
+        )
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, job_root, mask, d):
+        "Return a PreviewChannel, or None if it is disabled"
+        if not d.get("enabled", True):
+            return None
+        return cls(
+            f"{job_root}/preview.ab",
+            mask,
+            every=d.get("every", 5),
+            interval=d.get("interval", 0.5),
+            image_format=d.get("image_format", "webp"),
+            quality=d.get("quality", 80),
+        )
+
+    def wants(self, step):
+        "Check if a preview of the step should be made"
+        return (
+            step % self.every == 0
+            and time.monotonic() - self.last_submit >= self.interval
+        )
+
+    def submit(self, latents, meta):
+        "Queue preview of the first item of latents. Replace a pending one"
+        self.last_submit = time.monotonic()
+        rgb = latents_to_rgb(latents[:1])
+        with self.cond:
+            self.pending = (rgb, meta)
+            self.cond.notify()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while self.pending is None and not self.closed:
+                    self.cond.wait()
+                if self.pending is None:
+                    return
+                rgb, meta = self.pending
+                self.pending = None
+            try:
+                # Waits for the projection on the device, not for the UNet
+                img = PIL.Image.fromarray(rgb[0].cpu().numpy())
+                data = encode_image(img, self.image_format, self.quality)
+                meta = {
+                    **meta,
+                    "image_format": self.image_format,
+                    "width": img.width,
+                    "height": img.height,
+                }
+                write_bytes(self.path, encode_container(self.mask, meta, data))
+            except Exception as e:
+                print(f"[WARN] Cannot write preview: {e}")
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
@@ -0,0 +1,183 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+
+"""
+Progress channel
+
+The daemon publishes its current state into a memory-mapped, fixed-size
+record (state/progress.bin). A record is:
+
+    offset  size  field
+    0       4     magic b"ARPG"
+    4       4     version (1)
+    8       8     sequence (odd while the record is being written)
+    16      4     payload length
+    20      -     payload (utf-8 json: {"name", "values", "stats"})
+
+Readers retry when the sequence is odd or changes while reading.
+state.json is kept for the UI as a throttled snapshot, replaced atomically.
+Updates inside the throttle intervals are kept as pending, and a timer
+thread writes the latest one when its interval ends, so a state reported
+right before a long blocking call (e.g. load_model) is not left stale.
+"""
+
+MAGIC = b"ARPG"
+VERSION = 1
+HEADER = struct.Struct("<4sIQI")
+RECORD_SIZE = 8192
+
+# States which are always written to state.json immediately
+FLUSH_NAMES = ["done", "error"]
+
+
+def atomic_write(path, data):
+    # Temporary name is unique per process and thread, as writers may race
+    tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+class ProgressChannel:
+    def __init__(self, state_root, rate_hz=10, state_json_interval=0.5):
+        self.path = f"{state_root}/progress.bin"
+        self.json_path = f"{state_root}/state.json"
+        self.min_interval = 1.0 / rate_hz if rate_hz > 0 else 0.0
+        self.json_interval = float(state_json_interval)
+        self.seq = 0
+        self.name = None
+        self.last_publish = 0.0
+        self.last_json = 0.0
+        # Latest snapshot not written to progress.bin / state.json yet
+        self.pending = None
+        self.json_pending = None
+        self.closed = False
+        # Create fixed size record file and map it
+        with open(self.path, "wb") as f:
+            f.write(b"\x00" * RECORD_SIZE)
+        self.f = open(self.path, "r+b")
+        self.m = mmap.mmap(self.f.fileno(), RECORD_SIZE)
+        self._publish(b"{}")
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(
+            target=self._run, name="aroma-progress", daemon=True
+        )
+        self.thread.start()
+
+    @classmethod
+    def from_config(cls, state_root, d):
+        return cls(
+            state_root,
+            rate_hz=float(d.get("rate_hz", 10)),
+            state_json_interval=float(d.get("state_json_interval", 0.5)),
+        )
+
+    def _publish(self, payload):
+        limit = RECORD_SIZE - HEADER.size
+        if len(payload) > limit:
+            payload = json.dumps({"name": "truncated", "values": {}}).encode("utf-8")
+        # Odd sequence: writing
+        self.seq += 1
+        HEADER.pack_into(self.m, 0, MAGIC, VERSION, self.seq, 0)
+        self.m[HEADER.size : HEADER.size + len(payload)] = payload
+        self.seq += 1
+        HEADER.pack_into(self.m, 0, MAGIC, VERSION, self.seq, len(payload))
+
+    def update(self, name, values, stats=None):
+        """
+        Report state. Updates of the same state are coalesced to rate_hz,
+        and state.json is written at most every state_json_interval.
+        """
+        data = json.dumps(
+            {
+                "name": name,
+                "values": values,
+                "stats": stats if stats is not None else {},
+            }
+        )
+        with self.cond:
+            changed = name != self.name
+            self.name = name
+            self.pending = data
+            self.json_pending = data
+            now = time.monotonic()
+            if changed or now - self.last_publish >= self.min_interval:
+                self._publish_pending(now)
+            if name in FLUSH_NAMES or now - self.last_json >= self.json_interval:
+                self._flush_json(now)
+            # Timer writes what is left when the intervals end
+            self.cond.notify()
+
+    def _publish_pending(self, now):
+        if self.pending is None:
+            return
+        self._publish(self.pending.encode("utf-8"))
+        self.pending = None
+        self.last_publish = now
+
+    def _flush_json(self, now):
+        if self.json_pending is None:
+            return
+        atomic_write(self.json_path, self.json_pending)
+        self.json_pending = None
+        self.last_json = now
+
+    def _run(self):
+        with self.cond:
+            while not self.closed:
+                deadlines = []
+                if self.pending is not None:
+                    deadlines.append(self.last_publish + self.min_interval)
+                if self.json_pending is not None:
+                    deadlines.append(self.last_json + self.json_interval)
+                if len(deadlines) == 0:
+                    self.cond.wait()
+                    continue
+                now = time.monotonic()
+                if min(deadlines) > now:
+                    self.cond.wait(min(deadlines) - now)
+                    continue
+                if now - self.last_publish >= self.min_interval:
+                    self._publish_pending(now)
+                if now - self.last_json >= self.json_interval:
+                    try:
+                        self._flush_json(now)
+                    except Exception as e:
+                        print(f"[WARN] Cannot write state.json: {e}")
+                        self.json_pending = None
+
+    def flush(self):
+        "Write pending snapshot to progress.bin and state.json"
+        with self.cond:
+            now = time.monotonic()
+            self._publish_pending(now)
+            self._flush_json(now)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify()
+        self.thread.join()
+        self.flush()
+        self.m.close()
+        self.f.close()
+
+
+def read_progress(path, retries=100):
+    "Read the latest record of progress.bin. Return dict, or None"
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for _ in range(retries):
+                magic, version, seq, length = HEADER.unpack_from(m, 0)
+                if magic != MAGIC:
+                    return None
+                if seq % 2 == 1:
+                    continue
+                payload = m[HEADER.size : HEADER.size + length]
+                if HEADER.unpack_from(m, 0)[2] == seq:
+                    return json.loads(payload)
+    return None
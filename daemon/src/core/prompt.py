@@ -1,8 +1,14 @@
+import bisect
+import functools
+import random
+import re
+import time
+from collections import OrderedDict
+
 from diffusers.loaders import TextualInversionLoaderMixin
-import numpy as np
 import torch
 
-from .util import torch_device, is_torch_2_0
+from .util import torch_device
 
 """
 Prompt Grammer
@@ -11,142 +17,407 @@ Prompt Grammer
 (<prompts>) -> weighted by 1.1
 [<prompts>] -> weighted by 0.9
 {<p1>; <p2>; ...} -> One of paramas
+{<p1>: <weight>; <p2>; ...} -> One of params, with weights
+
+Templates are compiled once into a tree of texts and choices (cached by
+template), and each expansion samples the tree with a random.Random, so an
+expansion can be reproduced from its seed.
 """
 
 
-def process_random_prompts(text):
-    "Convert prompts containing random choose to fixed prompts"
+_TEMPLATE_SPECIAL = re.compile(r"[{};:()\[\]]")
+_WEIGHT_SPECIAL = re.compile(r"[()\[\]:]")
+
+
+def _parse_number(text, i):
+    """
+    Read a number after ':' at text[i - 1], skipping spaces.
+    Return the number string and the index of the next character.
+    """
+    num = []
+    j = i
+    while j < len(text):
+        c = text[j]
+        if c == "." or c.isdigit():
+            num.append(c)
+        elif c > " ":
+            break
+        j += 1
+    return "".join(num), j
+
+
+class Choice:
+    "Random choice node. options are sequences of str and Choice"
+
+    __slots__ = ["options", "cum_weights", "total"]
+
+    def __init__(self, options, weights):
+        self.options = options
+        self.cum_weights = []
+        total = 0.0
+        for w in weights:
+            total += max(0.0, w)
+            self.cum_weights.append(total)
+        self.total = total
+
+    def choose(self, rng):
+        if len(self.options) == 1:
+            return self.options[0]
+        if self.total <= 0:
+            return self.options[int(rng.random() * len(self.options))]
+        idx = bisect.bisect_right(self.cum_weights, rng.random() * self.total)
+        return self.options[min(idx, len(self.options) - 1)]
+
+
+def _sequence(parts):
+    "Merge adjacent texts of parts into a sequence of str and Choice"
+    seq = []
+    text = []
+    for part in parts:
+        if isinstance(part, str):
+            text.append(part)
+        else:
+            if len(text) > 0:
+                seq.append("".join(text))
+                text = []
+            seq.append(part)
+    if len(text) > 0:
+        seq.append("".join(text))
+    return seq
+
+
+@functools.lru_cache(maxsize=256)
+def compile_template(text):
+    """
+    Parse random choices of the prompt template into a tree, a sequence of
+    str and Choice. Emphasis brackets are kept as text, but ';' and ':' in
+    them are not separators. Unclosed groups are closed at the end.
+    """
     if not isinstance(text, str):
         raise Exception("Invalid text (expect str)")
-    p_stack = [""]
-    stack = [[("", 1)]]
+    # Each group: [closer stack, options, weights, parts and weight of
+    # the current option]
+    stack = [[[""], [], [], [], 1.0]]
     i = 0
     while i < len(text):
         c = text[i]
-        is_choice = p_stack[-1] == "}"
+        group = stack[-1]
+        brackets, options, weights, parts, _ = group
+        is_choice = brackets[-1] == "}"
         if c == "{":
-            # Insert new stack
-            p_stack.append("}")
-            stack.append([("", 1)])
+            stack.append([["}"], [], [], [], 1.0])
         elif is_choice and c == ";":
-            # Add to next choice
-            stack[-1].append(("", 1))
+            options.append(_sequence(parts))
+            weights.append(group[4])
+            group[3] = []
+            group[4] = 1.0
         elif is_choice and c == ":":
-            # Calculate weight
-            j = i + 1
-            num = ""
-            c = text[j]
-            while j < len(text):
-                if c == "." or c.isdigit():
-                    num += c
-                elif c > " ":
-                    break
-                j += 1
-                c = text[j]
+            num, j = _parse_number(text, i + 1)
             i = j - 1
             try:
-                weight = float(num)
-                stack[-1][-1] = (stack[-1][-1][0], weight)
-            except:
+                group[4] = float(num)
+            except ValueError:
                 print(f"[WARN] Failed to parse weight: {num}, ignore it")
-        elif is_choice and c == "}" and len(stack) > 1:
-            # Choose and merge
-            p_stack.pop()
-            last = stack.pop()
-            p = [max(0.0, e[1]) for e in last]
-            p = np.array(p) / np.sum(p)
-            idx = np.random.choice(len(last), p=p)
-            stack[-1][-1] = (stack[-1][-1][0] + last[idx][0], stack[-1][-1][1])
+        elif is_choice and c == "}":
+            stack.pop()
+            options.append(_sequence(parts))
+            weights.append(group[4])
+            stack[-1][3].append(Choice(options, weights))
         else:
-            last = stack[-1][-1]
-            stack[-1][-1] = (last[0] + c, last[1])
+            # Find the run of plain text at once
+            m = _TEMPLATE_SPECIAL.search(text, i + 1)
+            j = len(text) if m is None else m.start()
+            parts.append(text[i:j])
+            i = j - 1
             if c == "(":
-                p_stack.append(")")
+                brackets.append(")")
             elif c == "[":
-                p_stack.append("]")
-            elif p_stack[-1] == c:
-                p_stack.pop()
+                brackets.append("]")
+            elif brackets[-1] == c:
+                brackets.pop()
         i += 1
-    # Merge all
+    # Close unclosed groups
+    while len(stack) > 1:
+        _, options, weights, parts, weight = stack.pop()
+        options.append(_sequence(parts))
+        weights.append(weight)
+        stack[-1][3].append(Choice(options, weights))
+    return _sequence(stack[0][3])
+
+
+def sample_template(tree, rng):
+    "Expand a compiled template, choosing options with rng (random.Random)"
+    out = []
+    # Iterative, so deep nesting does not hit the recursion limit
+    stack = [iter(tree)]
     while len(stack) > 0:
-        last = stack.pop()
-        p = [max(0.0, e[1]) for e in last]
-        p = np.array(p) / np.sum(p)
-        idx = np.random.choice(len(last), p=p)
-        if len(stack) == 0:
-            return last[idx][0]
-        stack[-1][-1] = (stack[-1][-1][0] + last[idx][0], stack[-1][-1][1])
-    # Unreachable
-    return None
+        for node in stack[-1]:
+            if isinstance(node, str):
+                out.append(node)
+            else:
+                stack.append(iter(node.choose(rng)))
+                break
+        else:
+            stack.pop()
+    return "".join(out)
 
 
-def text_to_weighted_list(text):
+def has_choices(text):
+    "Check if the template has random choices"
+    return any(isinstance(node, Choice) for node in compile_template(text))
+
+
+def process_random_prompts(text, rng=None):
+    "Convert prompts containing random choose to fixed prompts"
+    if rng is None:
+        rng = random.Random()
+    return sample_template(compile_template(text), rng)
+
+
+@functools.lru_cache(maxsize=256)
+def weighted_chunks(text):
+    "Split text into chunks of (text, emphasis weight)"
     weight_factor = 1.0
-    if not isinstance(text, str):
-        raise Exception("Invalid text (expect str)")
-    chunks = [("", 1.0)]
+    # Texts and weights of chunks
+    texts = [[]]
+    chunk_weights = [1.0]
     stack = []
     i = 0
     while i < len(text):
         c = text[i]
         if c == "(":
-            stack.append((len(chunks), 1 + 0.1 * weight_factor))
-            chunks.append(("", 1.0))
+            stack.append((len(texts), 1 + 0.1 * weight_factor))
+            texts.append([])
+            chunk_weights.append(1.0)
         elif c == "[":
-            stack.append((len(chunks), 1 - 0.1 * weight_factor))
-            chunks.append(("", 1.0))
+            stack.append((len(texts), 1 - 0.1 * weight_factor))
+            texts.append([])
+            chunk_weights.append(1.0)
         elif c == ")" or c == "]":
             if len(stack) > 0:
                 idx, weight = stack.pop()
-                for j in range(idx, len(chunks)):
-                    chunks[j] = (chunks[j][0], chunks[j][1] * weight)
-            chunks.append(("", 1.0))
+                for j in range(idx, len(texts)):
+                    chunk_weights[j] *= weight
+            texts.append([])
+            chunk_weights.append(1.0)
         elif c == ":":
             # Parse weight (float)
-            j = i + 1
-            num = ""
-            c = text[j]
-            while j < len(text):
-                if c == "." or c.isdigit():
-                    num += c
-                elif c > " ":
-                    break
-                j += 1
-                c = text[j]
+            num, j = _parse_number(text, i + 1)
             i = j - 1
             try:
                 weight = 1 + (float(num) - 1) * weight_factor
                 if len(stack) > 0:
                     stack[-1] = (stack[-1][0], weight)
-            except:
+            except ValueError:
                 print(f"[WARN] Failed to parse weight: {num}, ignore it")
         else:
-            chunks[-1] = (chunks[-1][0] + c, chunks[-1][1])
+            m = _WEIGHT_SPECIAL.search(text, i + 1)
+            j = len(text) if m is None else m.start()
+            texts[-1].append(text[i:j])
+            i = j - 1
         i += 1
-    # Filter empyties
-    chunks = [chunk for chunk in chunks if len(chunk[0]) > 0]
-    # Make weights at least 0.01
-    for i in range(len(chunks)):
-        chunks[i] = (chunks[i][0], max(chunks[i][1], 0.01))
+    # Filter empties, and make weights at least 0.01
+    chunks = []
+    for t, w in zip(texts, chunk_weights):
+        t = "".join(t)
+        if len(t) > 0:
+            chunks.append((t, max(w, 0.01)))
+    return tuple(chunks)
+
+
+@functools.lru_cache(maxsize=256)
+def _weighted_list(text):
+    chunks = weighted_chunks(text)
     # Generate sentences list
     sentences = []
     weights = []
     while len(chunks) > 0:
-        # Find minimum weight
-        min_weight = float("inf")
-        for i in range(len(chunks)):
-            min_weight = min(min_weight, chunks[i][1])
-        # Create sentence with the weight
-        sentence = ""
-        for i in range(len(chunks)):
-            sentence += chunks[i][0] + " "
-            chunks[i] = (chunks[i][0], chunks[i][1] - min_weight)
-        # Append to list
-        sentences.append(sentence)
+        # Create sentence with the minimum weight
+        min_weight = min(w for _, w in chunks)
+        sentences.append("".join(t + " " for t, _ in chunks))
         weights.append(min_weight)
         # Remove about zero weight chunks
-        chunks = [chunk for chunk in chunks if chunk[1] >= 0.001]
-    return sentences, weights
+        chunks = [(t, w - min_weight) for t, w in chunks if w - min_weight >= 0.001]
+    return tuple(sentences), tuple(weights)
+
+
+def text_to_weighted_list(text):
+    if not isinstance(text, str):
+        raise Exception("Invalid text (expect str)")
+    sentences, weights = _weighted_list(text)
+    return list(sentences), list(weights)
+
+
+class EmbeddingCache:
+    """
+    Bounded LRU cache of prompt embeddings, shared by Prompt objects.
+    Keys must identify the text encoder state (model, clip_skip, LoRA,
+    textual inversions) as well as the expanded prompt text.
+    """
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max(1, int(max_entries))
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
+
+    def drop(self, serial):
+        "Drop embeddings of the pipeline with the serial (see pipecache.py)"
+        for key in [k for k in self.entries if k[0] is not None and k[0][0] == serial]:
+            del self.entries[key]
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "entries": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total > 0 else 0.0,
+        }
+
+
+# Prompt encoding modes, see Prompt.update_embed
+ENCODING_MODES = ["token", "blend"]
+
+
+def _empty_ids(tokenizer, length):
+    return [tokenizer.bos_token_id, tokenizer.eos_token_id] + [tokenizer.pad_token_id] * (
+        length - 2
+    )
+
+
+def _empty_mask(length):
+    return [1, 1] + [0] * (length - 2)
+
+
+def _encode(txt2img, ids, attention_mask=None):
+    device = torch_device()
+    if not (
+        hasattr(txt2img.text_encoder.config, "use_attention_mask")
+        and txt2img.text_encoder.config.use_attention_mask
+    ):
+        attention_mask = None
+    elif attention_mask is not None:
+        attention_mask = attention_mask.to(device)
+    return txt2img.text_encoder(ids.to(device), attention_mask=attention_mask)[0]
+
+
+def encode_blend(txt2img, text):
+    """
+    Encode each cumulative sentence of text_to_weighted_list (truncated to
+    the tokenizer length), and blend them from the empty prompt by weights.
+    Return embeddings and the empty prompt embedding.
+    """
+    tokenizer = txt2img.tokenizer
+    sentences, weights = text_to_weighted_list(text)
+    text_inputs = tokenizer(
+        sentences,
+        padding="max_length",
+        max_length=tokenizer.model_max_length,
+        truncation=True,
+        return_tensors="pt",
+    )
+    text_input_ids = text_inputs.input_ids
+
+    # Put empty tokens to result
+    empty_token_ids = torch.tensor(
+        _empty_ids(tokenizer, text_input_ids.shape[1]), dtype=text_input_ids.dtype
+    ).unsqueeze(0)
+    token_tensors = torch.cat([empty_token_ids, text_input_ids], dim=0)
+    attention_mask = torch.cat(
+        [
+            torch.tensor(_empty_mask(text_input_ids.shape[1])).unsqueeze(0),
+            text_inputs.attention_mask,
+        ]
+    )
+    embeds = _encode(txt2img, token_tensors, attention_mask)
+
+    empty_e = embeds[:1]
+    text_e = embeds[1:]
+
+    # Accumulate weightes
+    embeds = empty_e.clone()
+    for i in range(len(sentences)):
+        embeds += (text_e[i : i + 1] - embeds) * weights[i]
+    return embeds, empty_e
+
+
+def encode_tokens(txt2img, text, max_chunks=3):
+    """
+    Tokenize text once, and split tokens into chunks of the tokenizer length
+    (with BOS and EOS). All chunks and the empty prompt are encoded in one
+    batch, then each token is weighted by its emphasis, from the empty prompt
+    embedding. Chunk embeddings are concatenated, so prompts longer than the
+    tokenizer length are not truncated (up to max_chunks).
+    Return embeddings and the empty prompt embedding.
+    """
+    tokenizer = txt2img.tokenizer
+    length = tokenizer.model_max_length
+    size = length - 2
+    chunks = weighted_chunks(text)
+    tokens = []
+    token_weights = []
+    if len(chunks) > 0:
+        ids = tokenizer(
+            [t for t, _ in chunks], add_special_tokens=False, truncation=False, verbose=False
+        ).input_ids
+        for chunk_ids, (_, w) in zip(ids, chunks):
+            tokens.extend(chunk_ids)
+            token_weights.extend([w] * len(chunk_ids))
+    n = max(1, (len(tokens) + size - 1) // size)
+    if n > max_chunks:
+        print(
+            f"[WARN] Prompt has {len(tokens)} tokens, "
+            f"use first {max_chunks * size} of them"
+        )
+        n = max_chunks
+
+    rows = [_empty_ids(tokenizer, length)]
+    weights = []
+    masks = [_empty_mask(length)]
+    for k in range(n):
+        chunk = tokens[k * size : (k + 1) * size]
+        pad = size - len(chunk)
+        rows.append(
+            [tokenizer.bos_token_id]
+            + chunk
+            + [tokenizer.eos_token_id]
+            + [tokenizer.pad_token_id] * pad
+        )
+        weights.append([1.0] + token_weights[k * size : (k + 1) * size] + [1.0] * (pad + 1))
+        masks.append([1] * (len(chunk) + 2) + [0] * pad)
+    hidden = _encode(txt2img, torch.tensor(rows), torch.tensor(masks))
+
+    empty_e = hidden[:1]
+    weights = torch.tensor(weights, dtype=hidden.dtype, device=hidden.device).unsqueeze(-1)
+    embeds = empty_e + (hidden[1:] - empty_e) * weights
+    return embeds.reshape(1, n * length, -1), empty_e
+
+
+def pad_embeds(embeds, empty_embeds, length):
+    "Append empty prompt chunks to embeds, up to length tokens"
+    n = (length - embeds.shape[1]) // empty_embeds.shape[1]
+    if n <= 0:
+        return embeds
+    return torch.cat([embeds] + [empty_embeds] * n, dim=1)
 
 
 class Prompt:
@@ -154,68 +425,67 @@ class Prompt:
         self.text = text
         self.pp_text = text
         self.embeds = None
+        self.empty_embeds = None
+        self.key = None
 
-    def update_embed(self, text, txt2img):
-        device = torch_device()
-
+    def update_embed(
+        self,
+        text,
+        txt2img,
+        cache=None,
+        model_key=None,
+        rng=None,
+        mode="blend",
+        max_chunks=3,
+        times=None,
+    ):
+        """
+        Expand text and encode it.
+        mode "token": weights per token, long prompts in chunks (encode_tokens).
+        mode "blend": blend of weighted sentences (encode_blend).
+        times: StageTimes for prompt_expand and prompt_encode stages
+        """
         # Check text type
         if not isinstance(text, str):
             raise Exception("Invalid text (expect str)")
 
         # Run random choice
-        text = process_random_prompts(text)
+        start = time.monotonic()
+        text = process_random_prompts(text, rng)
         pp_text = text
+        if times is not None:
+            times.add("prompt_expand", time.monotonic() - start)
 
-        # Check if text is the same. If so, use cached one
-        if self.pp_text == pp_text:
+        # Check if text and model are the same. If so, use current one
+        key = (model_key, mode, max_chunks, pp_text)
+        if self.key == key:
             return
 
+        # Try shared cache
+        if cache is not None:
+            cached = cache.get(key)
+            if cached is not None:
+                self.text, self.embeds, self.empty_embeds = cached
+                self.pp_text = pp_text
+                self.key = key
+                return
+
+        start = time.monotonic()
         # Try to convert prompt
         if isinstance(txt2img, TextualInversionLoaderMixin):
             text = txt2img.maybe_convert_prompt(text, txt2img.tokenizer)
 
-        # Convert to weighted list
-        sentences, weights = text_to_weighted_list(text)
-        text_inputs = txt2img.tokenizer(
-            sentences,
-            padding="max_length",
-            max_length=txt2img.tokenizer.model_max_length,
-            truncation=True,
-            return_tensors="pt",
-        )
-        text_input_ids = text_inputs.input_ids
-
-        # Put empty tokens to result
-        empty_token_ids = torch.tensor(
-            [txt2img.tokenizer.bos_token_id]
-            + [txt2img.tokenizer.eos_token_id]
-            + [txt2img.tokenizer.pad_token_id] * (text_input_ids.shape[1] - 2),
-            dtype=torch.int,
-            device=device,
-        ).unsqueeze(0)
-        token_tensors = torch.cat([empty_token_ids, text_input_ids.to(device)], dim=0)
-
-        if (
-            hasattr(txt2img.text_encoder.config, "use_attention_mask")
-            and txt2img.text_encoder.config.use_attention_mask
-        ):
-            attention_mask = text_inputs.attention_mask.to(device)
+        if mode == "blend":
+            embeds, empty_embeds = encode_blend(txt2img, text)
         else:
-            attention_mask = None
-
-        embeds = txt2img.text_encoder(
-            token_tensors,
-            attention_mask=attention_mask,
-        )[0]
-
-        empty_e = embeds[:1]
-        text_e = embeds[1:]
-
-        # Accumulate weightes
-        embeds = empty_e
-        for i in range(len(sentences)):
-            embeds += (text_e[i : i + 1] - embeds) * weights[i]
+            embeds, empty_embeds = encode_tokens(txt2img, text, max_chunks)
+        if times is not None:
+            times.add("prompt_encode", time.monotonic() - start)
 
         self.text = text
         self.pp_text = pp_text
         self.embeds = embeds
+        self.empty_embeds = empty_embeds
+        self.key = key
+        if cache is not None:
+            cache.put(key, (text, embeds, empty_embeds))
@@ -0,0 +1,276 @@
+import datetime
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from .container import BINARY_EXT, LEGACY_EXT, read_image
+
+"""
+Result cache (state/result_cache)
+
+A seeded job is deterministic: the same model, LoRA, expanded prompts,
+size, sampler, steps, CFG scale, seed and highres chain give the same
+image. Each item gets a canonical hash of them (see pipes.py), and the
+output file written for it is indexed under the hash. A later job with
+the same hash reads the image from that output instead of running the
+UNet. Images are not copied: a removed output is a miss.
+
+Latents before highres fix are kept under the hash without the highres
+chain, so changing only the highres settings reuses the first pass. They
+are stored in state/result_cache/<2 hex>/<hash><ext>.
+
+The index (index.db) records outputs, stored files with their size, and
+their last use. Entries are evicted in LRU order when the total exceeds
+max_mb or max_entries; evicting an output only forgets it. Workers share
+it.
+"""
+
+# Bump when the generation changes so old results are not reused
+RESULT_CACHE_VERSION = 1
+
+MB = 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS results (
+    key TEXT PRIMARY KEY,
+    file TEXT NOT NULL,
+    nbytes INTEGER NOT NULL,
+    created_at TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS results_lru ON results (last_used);
+CREATE TABLE IF NOT EXISTS outputs (
+    key TEXT PRIMARY KEY,
+    path TEXT NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS outputs_lru ON outputs (last_used);
+"""
+
+
+def result_key(fields):
+    "Canonical hash of json-able fields"
+    text = json.dumps(fields, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_stamp(path):
+    "Size and mtime of path, to notice replaced model files. None if missing"
+    if path is None or path == "":
+        return None
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_size, st.st_mtime_ns]
+
+
+class CachedOutput:
+    "Encoded image bytes of a cache hit, written as is"
+
+    def __init__(self, data, path=None):
+        self.data = data
+        self.path = path
+
+
+class ResultCache:
+    def __init__(self, root, mask=None, max_mb=2048, max_entries=10000):
+        self.root = root
+        # Unmasks images of indexed outputs
+        self.mask = mask
+        self.max_bytes = int(float(max_mb) * MB)
+        self.max_entries = max(1, int(max_entries))
+        os.makedirs(root, exist_ok=True)
+        # Used by the generation loop and output writer threads
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(
+            f"{root}/index.db",
+            timeout=30,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+        self.hits = 0
+        self.misses = 0
+
+    @classmethod
+    def from_config(cls, state_root, d, mask=None):
+        "Return a ResultCache, or None if it is disabled"
+        if not d.get("enabled", True):
+            return None
+        return cls(
+            f"{state_root}/result_cache",
+            mask=mask,
+            max_mb=d.get("max_mb", 2048),
+            max_entries=d.get("max_entries", 10000),
+        )
+
+    def _path(self, key, ext):
+        return f"{self.root}/{key[:2]}/{key}{ext}"
+
+    def get(self, key):
+        """
+        Return (bytes, path) of key and mark it used, or None.
+        path is a plain file which can be linked, or None
+        """
+        if key is None:
+            return None
+        with self.lock:
+            hit = self._get_stored(key)
+            if hit is None:
+                hit = self._get_output(key)
+            if hit is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return hit
+
+    def _get_stored(self, key):
+        row = self.db.execute("SELECT file FROM results WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        path = f"{self.root}/{row[0]}"
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError:
+            # Removed under the index: forget it
+            self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+            return None
+        self.db.execute(
+            "UPDATE results SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        return data, path
+
+    def _get_output(self, key):
+        row = self.db.execute("SELECT path FROM outputs WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        path = row[0]
+        try:
+            if path.endswith((f".{BINARY_EXT}", f".{LEGACY_EXT}")):
+                data = read_image(path, self.mask)
+                path = None
+            else:
+                # Raw image
+                with open(path, "rb") as f:
+                    data = f.read()
+        except Exception:
+            data = None
+        if data is None:
+            # Output is removed or archived: forget it
+            self.db.execute("DELETE FROM outputs WHERE key = ?", (key,))
+            return None
+        self.db.execute(
+            "UPDATE outputs SET last_used = ? WHERE key = ?", (time.time(), key)
+        )
+        return data, path
+
+    def put_output(self, key, path):
+        "Index the output file written for key, instead of storing its image"
+        with self.lock:
+            row = self.db.execute(
+                "SELECT file FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.execute(
+                    "INSERT OR REPLACE INTO outputs (key, path, last_used) VALUES (?, ?, ?)",
+                    (key, os.path.abspath(path), time.time()),
+                )
+                self.db.execute("DELETE FROM results WHERE key = ?", (key,))
+                self.db.execute("COMMIT")
+            except Exception:
+                self.db.execute("ROLLBACK")
+                raise
+            if row is not None:
+                # Stored copy of an older version
+                self._remove_file(row[0])
+            self._evict()
+
+    def put(self, key, data, ext):
+        "Store data under key, and evict old entries over the budget"
+        path = self._path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO results (key, file, nbytes, created_at, last_used) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (
+                    key,
+                    os.path.relpath(path, self.root),
+                    len(data),
+                    datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                    time.time(),
+                ),
+            )
+            self._evict()
+
+    def _counts(self):
+        outputs = self.db.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+        count, total = self.db.execute(
+            "SELECT COUNT(*), COALESCE(SUM(nbytes), 0) FROM results"
+        ).fetchone()
+        return outputs, count, total
+
+    def _evict(self):
+        outputs, count, total = self._counts()
+        if outputs + count <= self.max_entries and total <= self.max_bytes:
+            return
+        # Stored files and outputs (0 bytes) in one LRU order
+        victims = []
+        for table, key, file, nbytes, _ in self.db.execute(
+            "SELECT 'results', key, file, nbytes, last_used FROM results "
+            "UNION ALL SELECT 'outputs', key, NULL, 0, last_used FROM outputs "
+            "ORDER BY last_used"
+        ).fetchall():
+            if outputs + count <= self.max_entries and total <= self.max_bytes:
+                break
+            victims.append((table, key, file))
+            if table == "outputs":
+                outputs -= 1
+            else:
+                count -= 1
+            total -= nbytes
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            for table, key, _ in victims:
+                self.db.execute(f"DELETE FROM {table} WHERE key = ?", (key,))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        # Outputs are only forgotten, never removed
+        for _, _, file in victims:
+            if file is not None:
+                self._remove_file(file)
+
+    def _remove_file(self, file):
+        try:
+            os.remove(f"{self.root}/{file}")
+        except OSError:
+            # Already removed by another worker
+            pass
+
+    def stats(self):
+        with self.lock:
+            outputs, count, total = self._counts()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "entries": outputs + count,
+            "outputs": outputs,
+            "bytes": total,
+        }
+
+    def close(self):
+        with self.lock:
+            self.db.close()
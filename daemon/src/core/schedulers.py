@@ -0,0 +1,81 @@
+import copy
+import json
+
+from diffusers import *
+
+"""
+Sampler registry
+
+Each sampler name maps to a scheduler class and config overrides, which
+are passed to from_config. "Default" keeps the scheduler of the model.
+"""
+
+DEFAULT_SAMPLER = "Default"
+
+SAMPLERS = {
+    "Euler": (EulerDiscreteScheduler, {}),
+    "Euler A": (EulerAncestralDiscreteScheduler, {}),
+    "LMS": (LMSDiscreteScheduler, {}),
+    "Heun": (HeunDiscreteScheduler, {}),
+    "DDIM": (DDIMScheduler, {}),
+    "DDIM Inverse": (DDIMInverseScheduler, {}),
+    "DDPM": (DDPMScheduler, {}),
+    "DPM++ 2S": (
+        DPMSolverSinglestepScheduler,
+        {"solver_order": 2, "algorithm_type": "dpmsolver++"},
+    ),
+    "DPM++ 2M": (
+        DPMSolverMultistepScheduler,
+        {"solver_order": 2, "algorithm_type": "dpmsolver++", "use_karras_sigmas": False},
+    ),
+    "DPM++ 2M Karras": (
+        DPMSolverMultistepScheduler,
+        {"solver_order": 2, "algorithm_type": "dpmsolver++", "use_karras_sigmas": True},
+    ),
+    "DPM++ 3S": (
+        DPMSolverSinglestepScheduler,
+        {"solver_order": 3, "algorithm_type": "dpmsolver++"},
+    ),
+    "DPM++ 3M": (
+        DPMSolverMultistepScheduler,
+        {"solver_order": 3, "algorithm_type": "dpmsolver++", "use_karras_sigmas": False},
+    ),
+    "DPM++ 3M Karras": (
+        DPMSolverMultistepScheduler,
+        {"solver_order": 3, "algorithm_type": "dpmsolver++", "use_karras_sigmas": True},
+    ),
+    "PNDM": (PNDMScheduler, {}),
+    "IPNDM": (IPNDMScheduler, {}),
+}
+
+
+def sampler_names():
+    "All valid sampler names, for UI"
+    return [DEFAULT_SAMPLER] + list(SAMPLERS.keys())
+
+
+class SchedulerCache:
+    """
+    Scheduler prototypes per (model scheduler config, sampler name).
+    Each pipeline gets its own clone, because schedulers keep step state.
+    """
+
+    def __init__(self):
+        self.prototypes = {}
+
+    def get(self, default_scheduler, name):
+        "Return a new scheduler for the sampler name"
+        config_key = json.dumps(dict(default_scheduler.config), sort_keys=True, default=str)
+        key = (config_key, name)
+        proto = self.prototypes.get(key)
+        if proto is None:
+            if name == DEFAULT_SAMPLER:
+                proto = default_scheduler
+            elif name in SAMPLERS:
+                cls, overrides = SAMPLERS[name]
+                proto = cls.from_config(default_scheduler.config, **overrides)
+            else:
+                print(f"[ERROR] Unknown sampling method: {name}")
+                proto = default_scheduler
+            self.prototypes[key] = proto
+        return copy.deepcopy(proto)
@@ -1,10 +1,26 @@
+import copy
 import datetime
 import json
 import base64
-import gzip
 import os
+import threading
+import time
 from io import BytesIO
 
+import PIL.Image
+
+from .codec import aroma_encode, aroma_decode
+from .container import encode_container, write_bytes, BINARY_EXT, LEGACY_EXT
+from .writer import OutputWriter
+from .progress import ProgressChannel, atomic_write
+from .jobqueue import JobQueue
+from .timing import StageTimes
+from .metrics import Metrics
+from .inbox import ValuesInbox
+from .resultcache import ResultCache, CachedOutput
+from .outputindex import OutputIndex, output_row
+from .preview import THUMBS_DIR, encode_image, make_thumbnail
+
 
 def read_and_truncate_as(path, w=""):
     with open(path, "r") as f:
@@ -16,6 +32,25 @@ def read_and_truncate_as(path, w=""):
     return r
 
 
+def _has_contents(path, empty):
+    "Check with stat only, if path exists and is not just empty contents"
+    try:
+        return os.stat(path).st_size > len(empty)
+    except OSError:
+        return False
+
+
+def _try_link(src, dst):
+    "Hard link src to dst. Return False if it is not possible"
+    if src is None:
+        return False
+    try:
+        os.link(src, dst)
+        return True
+    except OSError:
+        return False
+
+
 def merge_dict(dst, src):
     for k in src:
         if k in dst and isinstance(dst[k], dict):
@@ -24,6 +59,15 @@ def merge_dict(dst, src):
             dst[k] = src[k]
 
 
+def read_config_files(paths):
+    "Merge config files in order"
+    d = {}
+    for path in paths:
+        with open(path, "r") as f:
+            merge_dict(d, json.load(f))
+    return d
+
+
 def generate_mask(pw):
     # Add salt
     pw = "-<f!-" + pw + "<8z."
@@ -33,49 +77,6 @@ def generate_mask(pw):
     return hashlib.sha512(pw.encode("utf-8")).digest()
 
 
-def aroma_encode(mask, s):
-    # If mask is not provided, use 0x00
-    if mask is None:
-        mask = b"\x00"
-    # Convert string to bytes
-    b = bytearray(s, "utf-8")
-    # Compress
-    b = bytearray(gzip.compress(b))
-    # Remove magic number 1f 8b
-    b = b[2:]
-    # XOR with mask
-    l = len(mask)
-    last = 0
-    for i in range(len(b)):
-        b[i] ^= mask[i % l]
-        b[i] ^= last
-        last = b[i]
-    # Encode to base64
-    return base64.b64encode(b).decode("utf-8")
-
-
-def aroma_decode(mask, s):
-    # If mask is not provided, use 0x00
-    if mask is None:
-        mask = b"\x00"
-    # Decode base64
-    s = bytearray(base64.b64decode(s))
-    # XOR with mask
-    last = 0
-    l = len(mask)
-    for i in range(len(s)):
-        t = s[i]
-        s[i] ^= last
-        s[i] ^= mask[i % l]
-        last = t
-    # Add Magic number 1f 8b
-    s = bytearray([0x1F, 0x8B]) + s
-    # Decompress
-    s = gzip.decompress(s)
-    # Convert bytes to string
-    return s.decode("utf-8")
-
-
 class State:
     """
     Global configuration set for daemon
@@ -94,16 +95,88 @@ class State:
             self.image_quality = int(d["image_quality"])
         except:
             self.image_quality = 90
+        # Output file format: "binary" (.ab container) or "legacy" (.a)
+        self.output_container = d.get("output_container", "binary")
+
+        # Background writer for outputs. If workers is 0, write synchronously
+        writer_conf = d.get("output_writer", {})
+        self.writer = None
+        if int(writer_conf.get("workers", 0)) > 0:
+            self.writer = OutputWriter(
+                workers=writer_conf["workers"],
+                max_pending=writer_conf.get("max_pending", 4),
+            )
+        self.last_job_lock = threading.Lock()
+
+        # Multi-worker mode: devices and torch threads per worker
+        self.workers_conf = d.get("workers", {})
+
+        # Pipeline cache budgets
+        self.pipeline_cache = d.get("pipeline_cache", {})
+        # Prompt embedding cache size
+        self.embedding_cache = d.get("embedding_cache", {})
+        # Prompt encoding mode (token / blend), see prompt.py
+        self.prompt_encoding = d.get("prompt_encoding", {})
+        # Load weights directly on the device (see fastload.py)
+        self.fast_load = d.get("fast_load", True)
+        # Textual inversion manifest options
+        self.textual_inversion = d.get("textual_inversion", {})
+        # Run prefetch and decode stages while the UNet denoises
+        self.overlap_conf = d.get("overlap", {})
+        # Metrics file and trace options (see metrics.py)
+        self.metrics_conf = d.get("metrics", {})
+        self.metrics = None
+        # Wall time of each stage, reported in state.json and metrics
+        self.stage_times = StageTimes(window=self.metrics_conf.get("window", 512))
+
+        # Outputs of seeded jobs, reused by identical jobs (see resultcache.py)
+        self.result_cache_conf = d.get("result_cache", {})
+        self.result_cache = None
+        # Latent previews while denoising, and thumbnails of outputs
+        self.previews_conf = d.get("previews", {})
+        self.thumbnails_conf = d.get("thumbnails", {})
+        # Index of outputs for queries (see outputindex.py)
+        self.output_index_conf = d.get("output_index", {})
+        self.output_index = None
+        # Lazy databases are first used by output writer threads at once
+        self.open_lock = threading.Lock()
+        # Archives of outputs (see archive.py)
+        self.archives_root = d.get("archives_root", "./archives")
+        self.archive_conf = d.get("archive", {})
 
         self.values = d["init_values"]
+        # Inbox of values files, created by the first merge_values
+        self.values_inbox_conf = d.get("values_inbox", {})
+        self.inbox = None
+        # Statistics reported in state.json
+        self.stats = {}
+        # Progress channel, created by the first write_state
+        self.progress_conf = d.get("progress", {})
+        self.progress = None
+        # Current job, and its start in monotonic time
+        self.job = {}
+        self.previous_job = {}
+        self.job_started = None
+        # Job queue, opened by the first use
+        self.queue = None
+        self.queued = None
+        self.base_values = self.values
+        # Worker id in multi-worker mode. Files of the running job
+        # (current_job.json, state.json, progress.bin) go to job_root
+        self.worker_id = None
+        self.job_root = self.state_root
+        self.last_prefix = None
+        self.prefix_seq = 0
 
     @classmethod
     def init_from_config_files(cls, paths):
-        d = {}
-        for path in paths:
-            with open(path, "r") as f:
-                merge_dict(d, json.load(f))
-        return cls(d)
+        return cls(read_config_files(paths))
+
+    def set_worker(self, worker_id):
+        "Run as worker worker_id, with its own job files in state/workers/<id>"
+        self.worker_id = worker_id
+        self.job_root = f"{self.state_root}/workers/{worker_id}"
+        os.makedirs(self.job_root, exist_ok=True)
 
     def merge_current_job(self):
         # Check if current job exists
@@ -114,35 +187,26 @@ class State:
         try:
             with open(p, "r") as f:
                 job = json.load(f)
-                merge_dict(self.values, job["values"])
+                # Values of queued job are not the daemon values
+                if "queue_id" not in job:
+                    merge_dict(self.values, job["values"])
         except Exception as e:
             print("[WARN] Failed to load current job, do nothing")
             print(e)
             return
 
-    def merge_from_file(self, path):
-        # Read file
-        try:
-            contents = read_and_truncate_as(path, "{}")
-        except Exception as e:
-            print(f"[WARN] Failed to read {path}, do nothing: {e}")
-            return
-        # Merge
+    def merge_json(self, contents):
         try:
             merge_dict(self.values, json.loads(contents))
         except Exception as e:
             print("[WARN] Failed to merge dict, do nothing")
             print(e)
 
-    def merge_from_encoded_file(self, path):
-        # Read file
-        try:
-            contents = read_and_truncate_as(path, "")
-        except Exception as e:
-            print(f"[WARN] Failed to read {path}, do nothing: {e}")
-            return
+    def merge_encoded(self, contents):
         # Loop by line
         for line in contents.split("\n"):
+            if len(line.strip()) == 0:
+                continue
             # Decode line and merge
             try:
                 line = aroma_decode(self.mask, line)
@@ -152,65 +216,360 @@ class State:
                 print(f"[WARN] Failed to decode line, skip: {e}")
                 continue
 
+    def merge_from_file(self, path):
+        "Merge legacy values.json, if it has contents"
+        if not _has_contents(path, "{}"):
+            return False
+        # Read file
+        try:
+            contents = read_and_truncate_as(path, "{}")
+        except Exception as e:
+            print(f"[WARN] Failed to read {path}, do nothing: {e}")
+            return False
+        self.merge_json(contents)
+        return True
+
+    def merge_from_encoded_file(self, path):
+        "Merge legacy values.as, if it has contents"
+        if not _has_contents(path, ""):
+            return False
+        # Read file
+        try:
+            contents = read_and_truncate_as(path, "")
+        except Exception as e:
+            print(f"[WARN] Failed to read {path}, do nothing: {e}")
+            return False
+        self.merge_encoded(contents)
+        return True
+
     def merge_values(self):
-        self.merge_from_file(f"{self.state_root}/values.json")
-        self.merge_from_encoded_file(f"{self.state_root}/values.as")
+        """
+        Merge values files arrived in the inbox (state/values.d), and
+        legacy values.json / values.as. Return True if anything is merged
+        """
+        if self.inbox is None:
+            self.inbox = ValuesInbox.from_config(self.state_root, self.values_inbox_conf)
+        merged = False
+        for ext, contents in self.inbox.take():
+            if ext == ".json":
+                self.merge_json(contents)
+            else:
+                self.merge_encoded(contents)
+            merged = True
+        merged |= self.merge_from_file(f"{self.state_root}/values.json")
+        merged |= self.merge_from_encoded_file(f"{self.state_root}/values.as")
+        return merged
 
     def save_values(self, path):
         with open(path, "w") as f:
             f.write(json.dumps(self.values))
 
-    def start_job(self):
+    def get_queue(self):
+        if self.queue is None:
+            self.queue = JobQueue(f"{self.state_root}/jobs.db")
+        return self.queue
+
+    def next_queued_job(self):
+        "Return the next job in the queue, or None"
+        try:
+            return self.get_queue().next()
+        except Exception as e:
+            print(f"[WARN] Failed to read job queue, ignore it: {e}")
+            return None
+
+    def start_job(self, queued=None):
+        # Queued job runs with its values merged over the daemon values
+        self.queued = queued
+        self.previous_job = self.job
+        self.base_values = self.values
+        if queued is not None:
+            run = queued["done"] + queued.get("running", 0) + 1
+            print(f"[INFO] Run queued job {queued['id']} ({run}/{queued['repeat']})")
+            self.values = copy.deepcopy(self.values)
+            merge_dict(self.values, queued["values"])
         # Set start time
         self.job = {
             "start_time": datetime.datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
             "values": self.values,
         }
+        if queued is not None:
+            self.job["queue_id"] = queued["id"]
+        self.job_started = time.monotonic()
+        # Events before the job are not traced
+        self.get_metrics()
+        self.stage_times.take_trace()
         # Write to file
-        with open(f"{self.state_root}/current_job.json", "w") as f:
+        with open(f"{self.job_root}/current_job.json", "w") as f:
             f.write(json.dumps(self.job))
 
-    def end_job(self, img=None):
+    def get_result_cache(self):
+        "Return the result cache, or None if it is disabled"
+        with self.open_lock:
+            if self.result_cache is None:
+                self.result_cache = ResultCache.from_config(
+                    self.state_root, self.result_cache_conf, self.mask
+                )
+        return self.result_cache
+
+    def get_metrics(self):
+        if self.metrics is None:
+            self.metrics = Metrics.from_config(
+                self.state_root, self.worker_id, self.metrics_conf
+            )
+            if self.metrics.trace_path is not None:
+                self.stage_times.start_trace()
+        return self.metrics
+
+    def finish_job(self):
+        """
+        Write the trace of the job and metrics. Count the run of the queued
+        job, and restore the daemon values
+        """
+        metrics = self.get_metrics()
+        metrics.write_trace(self.job, self.stage_times.take_trace())
+        metrics.maybe_write(self.stage_times, self.stats)
+        if self.queued is None:
+            return
+        try:
+            self.get_queue().complete(self.queued["id"])
+        except Exception as e:
+            print(f"[WARN] Failed to update job queue: {e}")
+        self.values = self.base_values
+        self.queued = None
+
+    def skip_job(self):
+        """
+        Drop the current job, which generated nothing (a repeat of the
+        previous seeded job): no trace or metrics, and current_job.json is
+        the previous job again
+        """
+        self.stage_times.take_trace()
+        self.job = self.previous_job
+        if len(self.job) > 0:
+            atomic_write(f"{self.job_root}/current_job.json", json.dumps(self.job))
+
+    def end_job(self, img=None, info=None):
+        "Write an output of the current job. info is merged into values of the output"
         # Set end time
         now = datetime.datetime.utcnow()
         self.job["end_time"] = now.strftime("%Y-%m-%dT%H:%M:%SZ")
-        file_prefix = now.strftime("%y%m%d-%H%M%S-%f")
+        if self.job_started is not None:
+            self.job["elapsed"] = round(time.monotonic() - self.job_started, 3)
+        file_prefix = self.new_file_prefix(now)
         self.job["filename"] = f"{file_prefix}"
         self.job["image_format"] = f"{self.image_format}"
         self.job["image_quality"] = self.image_quality
-        # Write to file
-        with open(f"{self.state_root}/last_job.json", "w") as f:
-            f.write(json.dumps(self.job))
+        # Snapshot job and values, because self.values is modified in-place
+        # by the next merge_values while the output is still being written
+        job = copy.deepcopy(self.job)
+        values = copy.deepcopy(self.values)
+        if info is not None:
+            merge_dict(job["values"], copy.deepcopy(info))
+            merge_dict(values, copy.deepcopy(info))
+        if img is not None:
+            self.get_metrics().image_done()
+        # Encode and write outputs
+        if self.writer is not None:
+            self.writer.submit(self.write_output, job, values, img, file_prefix)
+        else:
+            self.write_output(job, values, img, file_prefix)
+        # Return file prefix
+        return file_prefix
+
+    def new_file_prefix(self, now):
+        """
+        Output file name prefix: timestamp, worker id (if any), and a sequence
+        number if the timestamp is the same as the previous one.
+        Prefixes sort by time, and never collide between workers.
+        """
+        prefix = now.strftime("%y%m%d-%H%M%S-%f")
+        if self.worker_id is not None:
+            prefix = f"{prefix}-w{self.worker_id}"
+        if prefix == self.last_prefix:
+            self.prefix_seq += 1
+            unique = f"{prefix}-{self.prefix_seq}"
+        else:
+            self.prefix_seq = 0
+            unique = prefix
+        self.last_prefix = prefix
+        return unique
+
+    def write_output(self, job, values, img, file_prefix):
+        # Image may be still being decoded (see overlap.py)
+        if img is not None and callable(getattr(img, "result", None)):
+            img = img.result()
+        with self.stage_times.measure("save"):
+            self._write_output(job, values, img, file_prefix)
+
+    def _write_output(self, job, values, img, file_prefix):
+        # Encode image only once, and reuse bytes for raw and encoded outputs
+        times = self.stage_times
+        image_bytes = None
+        if isinstance(img, CachedOutput):
+            # Cache hit: bytes are already encoded
+            image_bytes = img.data
+        elif img is not None:
+            with times.measure("image_encode"):
+                buffered = BytesIO()
+                img.save(buffered, format=self.image_format, quality=self.image_quality)
+                image_bytes = buffered.getvalue()
+        output_path = None
         # If save_raw is enabled, save files to disk
         if self.save_raw:
-            img.save(
-                f"{self.outputs_root}/{file_prefix}.{self.image_format}",
-                quality=self.image_quality,
-            )
-            self.save_values(f"{self.outputs_root}/{file_prefix}.json")
+            with times.measure("disk_write"):
+                raw_path = f"{self.outputs_root}/{file_prefix}.{self.image_format}"
+                # Link raw image of a cache hit instead of copying it
+                linked = isinstance(img, CachedOutput) and _try_link(img.path, raw_path)
+                if image_bytes is not None and not linked:
+                    with open(raw_path, "wb") as f:
+                        f.write(image_bytes)
+                if image_bytes is not None:
+                    # Plain image is read faster by the result cache
+                    output_path = raw_path
+                with open(f"{self.outputs_root}/{file_prefix}.json", "w") as f:
+                    f.write(json.dumps(values))
         # Write encoded output
-        if img is not None:
+        if image_bytes is not None and self.output_container == "legacy":
             # Convert Image into base64 and set to image field
-            buffered = BytesIO()
-            img.save(buffered, format=self.image_format, quality=self.image_quality)
-            self.job["image"] = base64.b64encode(buffered.getvalue()).decode("utf-8")
-            # Encode
-            encoded = aroma_encode(self.mask, json.dumps(self.job))
+            job["container"] = LEGACY_EXT
+            with times.measure("aroma_encode"):
+                job["image"] = base64.b64encode(image_bytes).decode("utf-8")
+                encoded = aroma_encode(self.mask, json.dumps(job))
             # Write
-            with open(f"{self.outputs_root}/{file_prefix}.a", "w") as f:
-                f.write(encoded)
-        # Reset
-        self.job = None
-        # Return file prefix
-        return file_prefix
+            with times.measure("disk_write"):
+                with open(f"{self.outputs_root}/{file_prefix}.{LEGACY_EXT}", "w") as f:
+                    f.write(encoded)
+            del job["image"]
+            self._index_output(job, file_prefix, LEGACY_EXT)
+            output_path = output_path or f"{self.outputs_root}/{file_prefix}.{LEGACY_EXT}"
+        elif image_bytes is not None:
+            job["container"] = BINARY_EXT
+            with times.measure("aroma_encode"):
+                data = encode_container(self.mask, job, image_bytes)
+            with times.measure("disk_write"):
+                write_bytes(f"{self.outputs_root}/{file_prefix}.{BINARY_EXT}", data)
+            self._index_output(job, file_prefix, BINARY_EXT)
+            output_path = output_path or f"{self.outputs_root}/{file_prefix}.{BINARY_EXT}"
+        if output_path is not None:
+            self._cache_result(values.get("result_key"), output_path)
+        if image_bytes is not None:
+            self._write_thumbnail(job, img, image_bytes, file_prefix)
+        # Write last job after the output exists, because UI loads it directly
+        self._write_last_job(job, file_prefix)
 
-    def write_state(self, name, values):
-        with open(f"{self.state_root}/state.json", "w") as f:
-            f.write(
-                json.dumps(
-                    {
-                        "name": name,
-                        "values": values,
-                    }
+    def _write_last_job(self, job, file_prefix):
+        """
+        Write last_job.json, unless a newer output is already there.
+        Writer threads and workers finish outputs out of order, and
+        prefixes sort by time
+        """
+        path = f"{self.state_root}/last_job.json"
+        with self.last_job_lock:
+            try:
+                with open(path, "r") as f:
+                    newest = json.loads(f.read()).get("filename")
+            except (OSError, ValueError, AttributeError):
+                newest = None
+            if isinstance(newest, str) and file_prefix < newest:
+                return
+            # It is shared by workers, so replace it atomically
+            atomic_write(path, json.dumps(job))
+
+    def _write_thumbnail(self, job, img, image_bytes, file_prefix):
+        "Write a small thumbnail of the output with its metadata, for the gallery"
+        conf = self.thumbnails_conf
+        if not conf.get("enabled", True):
+            return
+        image_format = conf.get("image_format", "webp")
+        try:
+            with self.stage_times.measure("thumbnail"):
+                if isinstance(img, CachedOutput):
+                    img = PIL.Image.open(BytesIO(image_bytes))
+                thumb = make_thumbnail(img, int(conf.get("size", 256)))
+                data = encode_image(thumb, image_format, int(conf.get("quality", 80)))
+                meta = {
+                    **job,
+                    "image_format": image_format,
+                    "thumbnail": {"width": thumb.width, "height": thumb.height},
+                }
+                os.makedirs(f"{self.outputs_root}/{THUMBS_DIR}", exist_ok=True)
+                write_bytes(
+                    f"{self.outputs_root}/{THUMBS_DIR}/{file_prefix}.{BINARY_EXT}",
+                    encode_container(self.mask, meta, data),
                 )
+        except Exception as e:
+            print(f"[WARN] Cannot write thumbnail of {file_prefix}: {e}")
+
+    def get_output_index(self):
+        "Return the outputs index, or None if it is disabled"
+        with self.open_lock:
+            if self.output_index is None:
+                self.output_index = OutputIndex.from_config(
+                    self.state_root, self.output_index_conf
+                )
+        return self.output_index
+
+    def sync_output_index(self):
+        """
+        Index outputs written or removed while the daemon was not running,
+        and write the paged listing of the gallery
+        """
+        if self.get_output_index() is None:
+            return
+        start = time.perf_counter()
+        added, removed, failed = self.output_index.sync(self.outputs_root, self.mask)
+        print(
+            f"[INFO] Output index: added {added}, removed {removed}, failed {failed} "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+
+    def _index_output(self, job, file_prefix, ext):
+        "Add a row of the written output to the outputs index"
+        try:
+            if self.get_output_index() is None:
+                return
+            st = os.stat(f"{self.outputs_root}/{file_prefix}.{ext}")
+            self.output_index.add(
+                output_row(file_prefix, ext, job, st.st_size, st.st_mtime_ns)
+            )
+        except Exception as e:
+            print(f"[WARN] Cannot index output {file_prefix}: {e}")
+
+    def _cache_result(self, key, path):
+        "Index the output of a seeded job in the result cache"
+        if key is None or self.get_result_cache() is None:
+            return
+        try:
+            with self.stage_times.measure("result_cache"):
+                self.result_cache.put_output(key, path)
+        except Exception as e:
+            print(f"[WARN] Cannot put result into cache: {e}")
+
+    def close(self):
+        # Flush pending outputs
+        if self.writer is not None:
+            self.writer.close()
+        if self.result_cache is not None:
+            self.result_cache.close()
+        if self.output_index is not None:
+            self.output_index.close()
+        if self.metrics is not None:
+            self.metrics.maybe_write(self.stage_times, self.stats, force=True)
+        if self.progress is not None:
+            self.progress.close()
+        if self.queue is not None:
+            self.queue.close()
+        if self.inbox is not None:
+            self.inbox.close()
+
+    def write_samplers(self, names):
+        # Valid sampling method names, for UI
+        with open(f"{self.state_root}/samplers.json", "w") as f:
+            f.write(json.dumps(names))
+
+    def write_state(self, name, values):
+        if self.progress is None:
+            self.progress = ProgressChannel.from_config(
+                self.job_root, self.progress_conf
             )
+        self.progress.update(name, values, self.stats)
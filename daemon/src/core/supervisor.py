@@ -0,0 +1,199 @@
+import json
+import multiprocessing
+import os
+import queue
+import shutil
+import time
+
+from .progress import read_progress, atomic_write
+
+"""
+Multi-worker supervisor
+
+With several devices, the daemon runs one worker process per device.
+Each worker has its own pipelines and writes its job files into
+state/workers/<id>, while all workers share the job queue (jobs.db) and
+outputs directory. The supervisor:
+
+- merges values files (values.d, see inbox.py) and sends values to workers,
+- merges progress of workers into state/state.json (as "workers"),
+- copies the newest current_job.json and preview.ab of workers to
+  state/current_job.json and state/preview.ab, which UI loads,
+- restarts workers which died, and stops all of them on exit.
+"""
+
+# States of an idle worker
+IDLE_NAMES = ["done", "error"]
+
+
+class WorkerHandle:
+    def __init__(self, worker_id, device):
+        self.worker_id = worker_id
+        self.device = device
+        self.values_queue = None
+        self.process = None
+        self.started_at = 0.0
+        self.restarts = 0
+
+
+class Supervisor:
+    def __init__(self, state, devices, target, interval=0.2, restart_delay=5.0):
+        """
+        target(worker_id, device, values, values_queue) is the worker entry,
+        run in a spawned process.
+        """
+        self.state = state
+        self.target = target
+        self.interval = float(interval)
+        self.restart_delay = float(restart_delay)
+        self.ctx = multiprocessing.get_context("spawn")
+        self.workers = [WorkerHandle(i, device) for i, device in enumerate(devices)]
+        self.sent_values = None
+        self.last_state = None
+        self.current_job_mtime = 0.0
+        self.preview_mtime = 0.0
+
+    def worker_root(self, worker):
+        return f"{self.state.state_root}/workers/{worker.worker_id}"
+
+    def start(self, worker):
+        print(f"[INFO] Supervisor: start worker {worker.worker_id} on {worker.device}")
+        worker.values_queue = self.ctx.Queue()
+        worker.process = self.ctx.Process(
+            target=self.target,
+            args=(worker.worker_id, worker.device, self.state.values, worker.values_queue),
+            name=f"aroma-worker-{worker.worker_id}",
+        )
+        worker.process.start()
+        worker.started_at = time.monotonic()
+
+    def run(self):
+        for worker in self.workers:
+            os.makedirs(self.worker_root(worker), exist_ok=True)
+        self.sent_values = json.dumps(self.state.values, sort_keys=True)
+        for worker in self.workers:
+            self.start(worker)
+        while True:
+            self.send_values()
+            self.merge_progress()
+            self.copy_current_job()
+            self.copy_preview()
+            self.check_workers()
+            time.sleep(self.interval)
+
+    def send_values(self):
+        "Merge values files, and send values to workers if changed"
+        if not self.state.merge_values():
+            return
+        encoded = json.dumps(self.state.values, sort_keys=True)
+        if encoded == self.sent_values:
+            return
+        self.sent_values = encoded
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.values_queue.put(self.state.values)
+
+    def merge_progress(self):
+        "Write state.json from progress records of workers"
+        records = {}
+        for worker in self.workers:
+            record = None
+            try:
+                record = read_progress(f"{self.worker_root(worker)}/progress.bin")
+            except (OSError, ValueError):
+                # Not created yet, or being written
+                pass
+            if record is None:
+                record = {"name": "starting", "values": {}, "stats": {}}
+            record["device"] = worker.device
+            records[str(worker.worker_id)] = record
+        # Show the first busy worker at the top level, for UI
+        primary = records[str(self.workers[0].worker_id)]
+        for record in records.values():
+            if record.get("name") not in IDLE_NAMES:
+                primary = record
+                break
+        data = json.dumps(
+            {
+                "name": primary.get("name"),
+                "values": primary.get("values", {}),
+                "stats": primary.get("stats", {}),
+                "workers": records,
+            }
+        )
+        if data != self.last_state:
+            atomic_write(f"{self.state.state_root}/state.json", data)
+            self.last_state = data
+
+    def copy_newest(self, name, last_mtime):
+        """
+        Copy the newest file of workers named name to state_root, if it is
+        newer than last_mtime. Return mtime of the published file
+        """
+        newest, newest_mtime = None, last_mtime
+        for worker in self.workers:
+            path = f"{self.worker_root(worker)}/{name}"
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                continue
+            if mtime > newest_mtime:
+                newest, newest_mtime = path, mtime
+        if newest is None:
+            return last_mtime
+        tmp = f"{self.state.state_root}/{name}.{os.getpid()}.tmp"
+        try:
+            shutil.copyfile(newest, tmp)
+        except OSError:
+            # Replaced by the worker while copying: next time
+            return last_mtime
+        os.replace(tmp, f"{self.state.state_root}/{name}")
+        return newest_mtime
+
+    def copy_current_job(self):
+        "Publish the most recently started job as current_job.json"
+        self.current_job_mtime = self.copy_newest("current_job.json", self.current_job_mtime)
+
+    def copy_preview(self):
+        "Publish the latest preview of workers as preview.ab"
+        self.preview_mtime = self.copy_newest("preview.ab", self.preview_mtime)
+
+    def check_workers(self):
+        "Restart dead workers, at most once per restart_delay"
+        for worker in self.workers:
+            if worker.process.is_alive():
+                continue
+            if time.monotonic() - worker.started_at < self.restart_delay:
+                continue
+            print(
+                f"[WARN] Supervisor: worker {worker.worker_id} exited "
+                f"with {worker.process.exitcode}, restart"
+            )
+            worker.restarts += 1
+            self.start(worker)
+
+    def stop(self, timeout=30.0):
+        "Stop workers. They flush pending outputs before exit"
+        for worker in self.workers:
+            if worker.process is not None and worker.process.is_alive():
+                worker.process.terminate()
+        deadline = time.monotonic() + timeout
+        for worker in self.workers:
+            if worker.process is None:
+                continue
+            worker.process.join(max(0.0, deadline - time.monotonic()))
+            if worker.process.is_alive():
+                print(f"[WARN] Supervisor: kill worker {worker.worker_id}")
+                worker.process.kill()
+                worker.process.join()
+        print("[INFO] Supervisor: all workers stopped")
+
+
+def take_latest(values_queue):
+    "Return the latest values sent by the supervisor, or None"
+    values = None
+    while True:
+        try:
+            values = values_queue.get_nowait()
+        except queue.Empty:
+            return values
@@ -0,0 +1,223 @@
+import json
+import os
+import pathlib
+import re
+import time
+
+import safetensors
+import torch
+
+from .progress import atomic_write
+
+"""
+Textual inversions
+
+Embeddings are files (.pt, .safetensors) in `textual_inversion(s)`
+directories under models_root. The token of an embedding is its file stem.
+
+TIManifest keeps the list of embeddings in state/ti_manifest.json, keyed
+by path, mtime and size, with the shape of each embedding. A refresh only
+stats files, and inspects new or changed files, so it does not grow with
+the size of files. Directories of diffusers models are not walked.
+
+Embeddings are loaded into a pipeline lazily: only when their token is
+used by a prompt, and are kept afterwards.
+"""
+
+MANIFEST_VERSION = 1
+EXTENSIONS = [".pt", ".safetensors"]
+
+
+def is_ti_dir(path):
+    base = os.path.basename(path).lower()
+    base = re.sub("[^a-z0-9]+", "", base)
+    return base == "textualinversion" or base == "textualinversions"
+
+
+def inspect_embedding(path):
+    "Return (number of vectors, dim) of the embedding file"
+    if path.endswith(".safetensors"):
+        # Read shapes from the header only
+        with safetensors.safe_open(path, framework="pt") as f:
+            keys = list(f.keys())
+            if len(keys) != 1:
+                raise Exception(f"Expected one tensor, found {len(keys)}")
+            shape = f.get_slice(keys[0]).get_shape()
+    else:
+        state_dict = torch.load(path, map_location="cpu")
+        if isinstance(state_dict, torch.Tensor):
+            shape = state_dict.shape
+        elif "string_to_param" in state_dict:
+            shape = state_dict["string_to_param"]["*"].shape
+        elif len(state_dict) == 1:
+            shape = next(iter(state_dict.values())).shape
+        else:
+            raise Exception("Unknown textual inversion format")
+    shape = list(shape)
+    if len(shape) == 1:
+        return 1, shape[0]
+    return shape[0], shape[-1]
+
+
+class TIManifest:
+    def __init__(self, models_root, path, refresh_interval=30.0):
+        self.models_root = models_root
+        self.path = path
+        self.refresh_interval = float(refresh_interval)
+        self.last_refresh = None
+        # path -> {"token", "mtime", "size", "vectors", "dim", "error"}
+        self.files = {}
+        # token -> path
+        self.tokens = {}
+        self.pattern = None
+        self._read()
+
+    @classmethod
+    def from_config(cls, models_root, state_root, d):
+        return cls(
+            models_root,
+            f"{state_root}/ti_manifest.json",
+            refresh_interval=d.get("refresh_interval", 30.0),
+        )
+
+    def _read(self):
+        try:
+            with open(self.path, "r") as f:
+                d = json.load(f)
+            if d.get("version") == MANIFEST_VERSION:
+                self.files = d["files"]
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"[WARN] Cannot read textual inversion manifest, rebuild: {e}")
+        self._index()
+
+    def _write(self):
+        data = json.dumps({"version": MANIFEST_VERSION, "files": self.files})
+        try:
+            atomic_write(self.path, data)
+        except Exception as e:
+            print(f"[WARN] Cannot write textual inversion manifest: {e}")
+
+    def _index(self):
+        self.tokens = {}
+        for path in sorted(self.files):
+            entry = self.files[path]
+            if entry.get("error") is not None:
+                continue
+            if entry["token"] in self.tokens:
+                print(
+                    f"[WARN] Textual inversion token {entry['token']} is duplicated, "
+                    f"use {path}"
+                )
+            self.tokens[entry["token"]] = path
+        # Longest first, so a token does not shadow a longer one
+        names = sorted(self.tokens, key=len, reverse=True)
+        self.pattern = None
+        if len(names) > 0:
+            self.pattern = re.compile(
+                r"(?<![\w])(" + "|".join(re.escape(name) for name in names) + r")(?![\w])"
+            )
+
+    def _walk(self):
+        "Return paths of embedding files"
+        paths = []
+        for root, dirs, files in os.walk(self.models_root):
+            # Diffusers models never contain textual inversions
+            if "model_index.json" in files:
+                dirs[:] = []
+                continue
+            dirs[:] = [d for d in dirs if not d.startswith(".")]
+            if not is_ti_dir(root):
+                continue
+            for f in files:
+                if os.path.splitext(f)[1] in EXTENSIONS:
+                    paths.append(os.path.join(root, f))
+        return paths
+
+    def refresh(self, force=False):
+        "Update entries of new, changed and removed files"
+        now = time.monotonic()
+        if (
+            not force
+            and self.last_refresh is not None
+            and now - self.last_refresh < self.refresh_interval
+        ):
+            return
+        self.last_refresh = now
+        changed = False
+        files = {}
+        for path in self._walk():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry = self.files.get(path)
+            if (
+                entry is not None
+                and entry["mtime"] == st.st_mtime
+                and entry["size"] == st.st_size
+            ):
+                files[path] = entry
+                continue
+            # New or changed file
+            entry = {
+                "token": pathlib.Path(path).stem,
+                "mtime": st.st_mtime,
+                "size": st.st_size,
+                "vectors": None,
+                "dim": None,
+                "error": None,
+            }
+            try:
+                entry["vectors"], entry["dim"] = inspect_embedding(path)
+            except Exception as e:
+                print(f"[WARNING] Cannot read textual inversion {path}: {e}")
+                entry["error"] = str(e)
+            files[path] = entry
+            changed = True
+        if changed or len(files) != len(self.files):
+            self.files = files
+            self._index()
+            self._write()
+            print(f"[INFO] Textual inversion manifest: {len(self.tokens)} embeddings")
+
+    def find_tokens(self, texts):
+        "Return tokens of embeddings used by texts"
+        if self.pattern is None:
+            return []
+        found = set()
+        for text in texts:
+            found.update(self.pattern.findall(text))
+        return sorted(found)
+
+    def load_for(self, pipeline, loaded, texts):
+        """
+        Load embeddings used by texts into the pipeline.
+        loaded: dict of token -> path, embeddings already in the pipeline.
+        Return True if any embedding is loaded.
+        """
+        self.refresh()
+        hidden_size = pipeline.text_encoder.config.hidden_size
+        changed = False
+        for token in self.find_tokens(texts):
+            if token in loaded:
+                continue
+            path = self.tokens[token]
+            entry = self.files[path]
+            # Remember failures too, not to retry them for every prompt
+            loaded[token] = path
+            if entry["dim"] != hidden_size:
+                print(
+                    f"[WARNING] Textual inversion {token} has dim {entry['dim']}, "
+                    f"but model has {hidden_size}. ignore it"
+                )
+                continue
+            print(f"[INFO] Loading textual inversion from {path} as {token}")
+            try:
+                pipeline.load_textual_inversion(path, token=token)
+                changed = True
+            except Exception as e:
+                print(f"[WARNING] Cannot load textual inversion {path}: {e}")
+                print(f"[WARNING] just ignore {token}")
+        return changed
@@ -0,0 +1,124 @@
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+"""
+Stage timings
+
+StageTimes accumulates wall time per stage (prompt, denoise, decode, save,
+...). Stages may run on different threads at the same time, so the sum of
+stages can exceed the wall time. unet_busy is the share of wall time spent
+in the UNet stages.
+
+The last `window` samples of each stage are kept for quantiles (see
+metrics.py). While a trace is started, each sample is also recorded as an
+event (stage, start, seconds, thread).
+"""
+
+# Stages which run the UNet. Highres passes are highres_<index>
+UNET_STAGES = ["denoise"]
+UNET_STAGE_PREFIXES = ["highres"]
+
+
+def is_unet_stage(name):
+    return name in UNET_STAGES or any(name.startswith(p) for p in UNET_STAGE_PREFIXES)
+
+
+class StageTimes:
+    def __init__(self, window=512):
+        self.lock = threading.Lock()
+        self.window = int(window)
+        self.start = time.monotonic()
+        self.totals = {}
+        self.counts = {}
+        self.last = {}
+        self.windows = {}
+        # Events of the current trace, or None
+        self.events = None
+
+    def add(self, name, seconds):
+        with self.lock:
+            self.totals[name] = self.totals.get(name, 0.0) + seconds
+            self.counts[name] = self.counts.get(name, 0) + 1
+            self.last[name] = seconds
+            if name not in self.windows:
+                self.windows[name] = deque(maxlen=self.window)
+            self.windows[name].append(seconds)
+            if self.events is not None:
+                self.events.append(
+                    (name, time.monotonic() - seconds, seconds, threading.current_thread().name)
+                )
+
+    @contextmanager
+    def measure(self, name):
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.add(name, time.monotonic() - start)
+
+    def reset(self):
+        with self.lock:
+            self.start = time.monotonic()
+            self.totals = {}
+            self.counts = {}
+            self.last = {}
+            self.windows = {}
+
+    def quantiles(self, qs):
+        "Return {name: [quantile of recent samples for q in qs]}"
+        with self.lock:
+            windows = {name: sorted(w) for name, w in self.windows.items()}
+        result = {}
+        for name, samples in windows.items():
+            result[name] = [samples[min(len(samples) - 1, int(q * len(samples)))] for q in qs]
+        return result
+
+    def start_trace(self):
+        with self.lock:
+            self.events = []
+
+    def take_trace(self):
+        "Return events since the last take, or [] if no trace is started"
+        with self.lock:
+            if self.events is None:
+                return []
+            events = self.events
+            self.events = []
+            return events
+
+    def stats(self):
+        with self.lock:
+            wall = time.monotonic() - self.start
+            unet = sum(v for name, v in self.totals.items() if is_unet_stage(name))
+            return {
+                "wall": wall,
+                "unet_busy": unet / wall if wall > 0 else 0.0,
+                "stages": {
+                    name: {
+                        "last": self.last[name],
+                        "total": self.totals[name],
+                        "count": self.counts[name],
+                    }
+                    for name in self.totals
+                },
+            }
+
+
+class StepTimer:
+    """
+    Add the time between calls of step() as a stage, e.g. per UNet step.
+    Timing starts at the first call, so setup before it is not counted
+    """
+
+    def __init__(self, times, name):
+        self.times = times
+        self.name = name
+        self.last = None
+
+    def step(self):
+        now = time.monotonic()
+        if self.last is not None:
+            self.times.add(self.name, now - self.last)
+        self.last = now
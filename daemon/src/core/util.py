@@ -1,8 +1,22 @@
 from packaging.version import Version
 import torch
 
+# Device of this process, set by set_torch_device (e.g. "cuda:1" for a worker)
+_device = None
+
+
+def set_torch_device(device):
+    "Pin this process to device. None restores auto detection"
+    global _device
+    _device = device
+    if device is not None and device.startswith("cuda:"):
+        # Make it current, so empty_cache and default streams use it
+        torch.cuda.set_device(torch.device(device))
+
 
 def torch_device():
+    if _device is not None:
+        return _device
     if torch.cuda.is_available():
         return "cuda"
     elif torch.backends.mps.is_available():
@@ -11,6 +25,11 @@ def torch_device():
         return "cpu"
 
 
+def torch_device_type():
+    "Type of the device, without index (cuda, mps or cpu)"
+    return torch_device().split(":")[0]
+
+
 def is_torch_2_0():
     torch_version = Version(torch.__version__)
     criterion = Version("2.0")
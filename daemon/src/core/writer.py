@@ -0,0 +1,74 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class OutputWriter:
+    """
+    Bounded background pool for output encoding and writing.
+
+    Jobs are plain callables. At most `max_pending` jobs may be queued or
+    running at once; `submit` blocks when the pool is full, so a slow disk
+    slows the generation loop down instead of piling images up in memory.
+    Image encoders and zlib release the GIL, so threads are enough here.
+    """
+
+    def __init__(self, workers=2, max_pending=4):
+        self.workers = max(1, int(workers))
+        self.max_pending = max(1, int(max_pending))
+        self.pool = ThreadPoolExecutor(
+            max_workers=self.workers,
+            thread_name_prefix="aroma-writer",
+        )
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.closed = False
+
+    def submit(self, fn, *args, **kwargs):
+        if self.closed:
+            raise Exception("OutputWriter is already closed")
+        # Backpressure: wait for a free slot
+        self.slots.acquire()
+        try:
+            future = self.pool.submit(fn, *args, **kwargs)
+        except Exception:
+            self.slots.release()
+            raise
+        with self.lock:
+            self.pending.add(future)
+        future.add_done_callback(self._on_done)
+        return future
+
+    def _on_done(self, future):
+        with self.lock:
+            self.pending.discard(future)
+        self.slots.release()
+        e = future.exception()
+        if e is not None:
+            print(f"[ERROR] OutputWriter: failed to write output: {e}")
+
+    def num_pending(self):
+        with self.lock:
+            return len(self.pending)
+
+    def flush(self):
+        "Wait until every submitted job is finished"
+        while True:
+            with self.lock:
+                futures = list(self.pending)
+            if len(futures) == 0:
+                return
+            for future in futures:
+                try:
+                    future.result()
+                except Exception:
+                    # Already reported in _on_done
+                    pass
+
+    def close(self):
+        if self.closed:
+            return
+        print(f"[INFO] OutputWriter: flushing {self.num_pending()} pending outputs")
+        self.flush()
+        self.closed = True
+        self.pool.shutdown(wait=True)
@@ -0,0 +1,58 @@
+import argparse
+import json
+import sys
+
+from core.state import State
+from core.jobqueue import JobQueue
+
+"""
+Job queue CLI
+
+    python daemon/src/jobs.py add '{"params": {"prompt": "cat"}}' --priority 1 --repeat 4
+    python daemon/src/jobs.py add values.json
+    python daemon/src/jobs.py list [--all]
+    python daemon/src/jobs.py cancel <id>
+
+Run from the directory which has default_config.json and config.json.
+"""
+
+
+def load_values(arg):
+    if arg == "-":
+        return json.load(sys.stdin)
+    if arg.lstrip().startswith("{"):
+        return json.loads(arg)
+    with open(arg, "r") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage aroma daemon job queue")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("add", help="Enqueue a job")
+    p.add_argument("values", help="values json, json file path, or - for stdin")
+    p.add_argument("--priority", type=int, default=0)
+    p.add_argument("--repeat", type=int, default=1)
+    p = sub.add_parser("list", help="List jobs")
+    p.add_argument("--all", action="store_true", help="Include finished jobs")
+    p = sub.add_parser("cancel", help="Cancel a job")
+    p.add_argument("id", type=int)
+    args = parser.parse_args()
+
+    state = State.init_from_config_files(["default_config.json", "config.json"])
+    queue = JobQueue(f"{state.state_root}/jobs.db")
+    if args.command == "add":
+        job_id = queue.enqueue(load_values(args.values), args.priority, args.repeat)
+        print(job_id)
+    elif args.command == "list":
+        for job in queue.list(pending_only=not args.all):
+            print(json.dumps(job))
+    elif args.command == "cancel":
+        if not queue.cancel(args.id):
+            print(f"[WARN] Job {args.id} is not pending")
+            sys.exit(1)
+    queue.close()
+
+
+if __name__ == "__main__":
+    main()
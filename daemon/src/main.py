@@ -1,35 +1,73 @@
+import argparse
+import signal
 import time
 import traceback
 import sys
 
-from core.state import State
+import torch
+
+from core.state import State, read_config_files
 from core.pipes import SDPipes
+from core.schedulers import sampler_names
+from core.supervisor import Supervisor, take_latest
+from core.util import set_torch_device
 
-state = State.init_from_config_files(
-    [
-        "default_config.json",
-        "config.json",
-    ]
-)
-state.merge_current_job()
+CONFIG_FILES = [
+    "default_config.json",
+    "config.json",
+]
 
 
-pipes = SDPipes()
+def load_state():
+    state = State.init_from_config_files(CONFIG_FILES)
+    return state
 
 
-if __name__ == "__main__":
-    # Main Loop
+def prepare_state(state):
+    "Startup tasks of the daemon (single process or supervisor)"
+    state.merge_current_job()
+    state.write_samplers(sampler_names())
+    # Runs claimed by the previous daemon will never finish
+    try:
+        state.get_queue().reset_running()
+    except Exception as e:
+        print(f"[WARN] Failed to reset job queue: {e}")
+    try:
+        state.sync_output_index()
+    except Exception as e:
+        print(f"[WARN] Failed to sync output index: {e}")
+
+
+def on_exit_signal(signum, frame):
+    print(f"[INFO] Caught signal {signum}, exit")
+    sys.exit(0)
+
+
+def main_loop(state, pipes, update_values):
     i = 0
     while True:
         try:
-            print(f"[NOTE] --- Iter {i}")
             start = time.time()
             # Merge values
-            state.merge_values()
-            state.start_job()
-            # Run text to image
-            img = pipes.text_to_image(state)
-            file_prefix = state.end_job(img)
+            update_values()
+            # Run queued job first. If queue is empty, repeat current values
+            queued = state.next_queued_job()
+            if queued is None and pipes.is_repeat(state.values):
+                # Nothing new would be generated, wait for new values
+                time.sleep(1)
+                continue
+            print(f"[NOTE] --- Iter {i}")
+            state.start_job(queued)
+            # Run text to image, and write each output of the batch
+            results = pipes.text_to_image(state)
+            for img, info in results:
+                state.end_job(img, info)
+            if len(results) == 0:
+                # Same seeded job as the previous one, wait for new values
+                state.skip_job()
+                time.sleep(1)
+            else:
+                state.finish_job()
             # Prepare for next iteration
             end = time.time()
             print(f"[INFO] --- Iter {i}: elapsed: {end - start} sec")
@@ -39,4 +77,82 @@ if __name__ == "__main__":
             print(traceback.format_exc())
             print("[ERROR] Sleep a second and retry")
             state.write_state("error", str(e))
+            # A failed run is counted, so broken jobs do not block the queue
+            state.finish_job()
             time.sleep(1)
+
+
+def run_single(device=None):
+    if device is not None:
+        set_torch_device(device)
+    state = load_state()
+    prepare_state(state)
+    pipes = SDPipes()
+    try:
+        main_loop(state, pipes, state.merge_values)
+    finally:
+        # Finish images being decoded, and flush outputs being written
+        pipes.close()
+        state.close()
+
+
+def run_worker(worker_id, device, values, values_queue):
+    "Entry of a worker process, spawned by the supervisor"
+    # Supervisor stops workers with SIGTERM
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, on_exit_signal)
+    signal.signal(signal.SIGTERM, on_exit_signal)
+    set_torch_device(device)
+    state = load_state()
+    state.set_worker(worker_id)
+    state.values = values
+    threads = int(state.workers_conf.get("threads", 0))
+    if threads > 0:
+        torch.set_num_threads(threads)
+    print(f"[INFO] Worker {worker_id}: device {device}")
+
+    def update_values():
+        values = take_latest(values_queue)
+        if values is not None:
+            state.values = values
+
+    pipes = SDPipes()
+    try:
+        main_loop(state, pipes, update_values)
+    finally:
+        pipes.close()
+        state.close()
+
+
+def run_supervisor(devices):
+    state = load_state()
+    prepare_state(state)
+    supervisor = Supervisor(state, devices, run_worker)
+    try:
+        supervisor.run()
+    finally:
+        supervisor.stop()
+        state.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Aroma daemon")
+    parser.add_argument(
+        "--devices",
+        help="Comma separated devices, one worker per device (e.g. cuda:0,cuda:1)",
+    )
+    args = parser.parse_args()
+
+    # run.sh forwards SIGINT/SIGTERM as SIGHUP
+    signal.signal(signal.SIGHUP, on_exit_signal)
+    signal.signal(signal.SIGTERM, on_exit_signal)
+
+    if args.devices:
+        devices = [d.strip() for d in args.devices.split(",") if d.strip() != ""]
+    else:
+        config = read_config_files(CONFIG_FILES)
+        devices = config.get("workers", {}).get("devices", [])
+    if len(devices) > 1:
+        run_supervisor(devices)
+    else:
+        run_single(devices[0] if len(devices) == 1 else None)
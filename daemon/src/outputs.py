@@ -0,0 +1,79 @@
+import argparse
+import json
+import sys
+import time
+
+from core.state import State
+from core.outputindex import OutputIndex, FILTERS, PAGES_DIR
+
+"""
+Outputs index CLI
+
+    python daemon/src/outputs.py list [--prompt cat] [--model sd15] [--seed 1] [--limit 20]
+    python daemon/src/outputs.py list --before <last name of the previous page>
+    python daemon/src/outputs.py count [--prompt cat]
+    python daemon/src/outputs.py rebuild [--full] [--workers 8]
+    python daemon/src/outputs.py remove <name> [<name> ...]
+
+list prints a json line per output, newest first. rebuild reads output
+files which are new or changed since they were indexed (all with --full),
+drops rows of deleted files, and writes the paged listing of the gallery.
+remove drops rows of outputs deleted by UI.
+
+Run from the directory which has default_config.json and config.json.
+"""
+
+INT_FILTERS = ["seed", "width", "height", "queue_id"]
+
+
+def add_filters(p):
+    for key in FILTERS:
+        p.add_argument(f"--{key.replace('_', '-')}", type=int if key in INT_FILTERS else str)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query aroma outputs index")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p = sub.add_parser("list", help="List outputs, newest first")
+    add_filters(p)
+    p.add_argument("--limit", type=int, default=100)
+    p.add_argument("--offset", type=int, default=0)
+    p.add_argument("--oldest-first", action="store_true")
+    p = sub.add_parser("count", help="Count outputs")
+    add_filters(p)
+    p = sub.add_parser("rebuild", help="Index output files on disk")
+    p.add_argument("--full", action="store_true", help="Read every file again")
+    p.add_argument("--workers", type=int, default=None)
+    p = sub.add_parser("remove", help="Remove outputs from the index")
+    p.add_argument("names", nargs="+")
+    args = parser.parse_args()
+
+    state = State.init_from_config_files(["default_config.json", "config.json"])
+    index = OutputIndex(
+        f"{state.state_root}/outputs.db", f"{state.state_root}/{PAGES_DIR}"
+    )
+    filters = {key: getattr(args, key, None) for key in FILTERS}
+    if args.command == "list":
+        for row in index.query(args.limit, args.offset, args.oldest_first, **filters):
+            print(json.dumps(row))
+    elif args.command == "count":
+        print(index.count(**filters))
+    elif args.command == "rebuild":
+        start = time.perf_counter()
+        added, removed, failed = index.sync(
+            state.outputs_root, state.mask, args.workers, args.full
+        )
+        print(
+            f"[INFO] Indexed {added} outputs, removed {removed}, failed {failed} "
+            f"in {time.perf_counter() - start:.1f}s"
+        )
+        if failed > 0:
+            index.close()
+            sys.exit(1)
+    elif args.command == "remove":
+        index.remove(args.names)
+    index.close()
+
+
+if __name__ == "__main__":
+    main()
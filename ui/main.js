@@ -27,6 +27,21 @@ const mergeObject = (dst, src) => {
   return dst;
 };
 
+let valuesCounter = 0;
+
+const dropValues = async (data, ext) => {
+  // Write data into state/values.d atomically, with a unique name sorted
+  // by time of creation
+  const inbox = statePath + "/values.d";
+  await fs.promises.mkdir(inbox, { recursive: true });
+  valuesCounter = (valuesCounter + 1) % 1000000;
+  const name = String(Date.now()).padStart(15, "0") + "-" + process.pid + "-"
+    + String(valuesCounter).padStart(6, "0") + ext;
+  const tmp = inbox + "/." + name + ".tmp";
+  await fs.promises.writeFile(tmp, data);
+  await fs.promises.rename(tmp, inbox + "/" + name);
+};
+
 const currentDateInFormat = () => {
   // Return now as a format yymmdd-hhmmss
   let now = new Date();
@@ -102,6 +117,12 @@ app.get('/aroma-static/state/:filename', async (req, res) => {
     return;
   }
   let data = await fs.promises.readFile(fullpath);
+  // Containers (e.g. preview.ab) are already masked
+  if(path.extname(filename) === ".ab") {
+    res.set('Cache-Control', 'no-store');
+    res.send(data);
+    return;
+  }
   // Encode
   let encoded = enc.aromaEncode(mask, data);
   res.send(encoded);
@@ -122,22 +143,107 @@ app.get('/index.html', indexHandler);
 app.get('/api/archives', (req, res) => {
   res.set('Cache-Control', 'no-store');
   fs.readdir(archivesPath, (err, files) => {
+    // Hide unfinished archives
+    files = (files || []).filter((file) =>
+      !file.endsWith(".part") && !file.endsWith(".manifest"));
     res.send(files);
   });
 });
 
-// Get output list
-app.get('/api/outputs', (req, res) => {
+// Get output list. With ?limit=n, only the newest n names (before the
+// name ?before=, for older pages). Names sort by time
+const outputPagesPath = statePath + "/output_pages";
+
+const removeFromOutputPage = (name) => {
+  // Drop the name from its page of the listing right away. The daemon
+  // may rewrite the page until the index row is removed as well
+  let page = outputPagesPath + "/" + name.substring(0, 9) + ".json";
+  if(!fs.existsSync(page)) {
+    return;
+  }
+  let names = JSON.parse(fs.readFileSync(page, "utf8")).filter((n) => n !== name);
+  if(names.length === 0) {
+    fs.unlinkSync(page);
+    return;
+  }
+  let tmp = page + "." + process.pid + ".tmp";
+  fs.writeFileSync(tmp, JSON.stringify(names));
+  fs.renameSync(tmp, page);
+};
+
+const removeFromOutputIndex = (name) => {
+  // Remove the row of the deleted output from the outputs index, which
+  // also rewrites its page
+  let ps = child_process.spawn("bash", ["daemon/outputs.sh", "remove", name]);
+  let out = "";
+  ps.stdout.on('data', (data) => {
+    out += data.toString();
+  });
+  ps.stderr.on('data', (data) => {
+    out += data.toString();
+  });
+  ps.on('close', (code) => {
+    if(code != 0) {
+      console.log("[ERROR] Cannot remove output from index: " + out.slice(-1000));
+    }
+  });
+};
+
+const listOutputPages = async (limit, before) => {
+  // Read names from the paged listing of the outputs index (an array of
+  // names per hour, written by the daemon) from the newest page, until
+  // limit names are found. Return them oldest first
+  let pages = (await fs.promises.readdir(outputPagesPath))
+    .filter((file) => path.extname(file) === ".json")
+    .map((file) => file.substring(0, file.length - 5))
+    .sort();
+  let names = [];
+  const full = () => limit > 0 && names.length >= limit;
+  for(let i = pages.length - 1; i >= 0 && !full(); i--) {
+    // Every name of the page is after its key
+    if(typeof before === "string" && pages[i] >= before) {
+      continue;
+    }
+    let page = JSON.parse(
+      await fs.promises.readFile(outputPagesPath + "/" + pages[i] + ".json"));
+    for(let j = page.length - 1; j >= 0 && !full(); j--) {
+      if(typeof before === "string" && page[j] >= before) {
+        continue;
+      }
+      names.push(page[j]);
+    }
+  }
+  return names.reverse();
+};
+
+app.get('/api/outputs', async (req, res) => {
   res.set('Cache-Control', 'no-store');
+  let limit = parseInt(req.query.limit);
+  let before = req.query.before;
+  if(fs.existsSync(outputPagesPath)) {
+    try {
+      res.send(await listOutputPages(limit, before));
+      return;
+    } catch(e) {
+      console.log("[WARN] Cannot read output pages, list outputs", e);
+    }
+  }
   fs.readdir(outputsPath, (err, files) => {
-    let a = [];
+    let a = new Set();
     for(let file of files) {
       let ext = path.extname(file);
-      if(ext === ".a") {
-        a.push(file.substring(0, file.lastIndexOf(".")));
+      if(ext === ".a" || ext === ".ab") {
+        a.add(file.substring(0, file.lastIndexOf(".")));
       }
     }
-    res.send(a);
+    let names = Array.from(a).sort();
+    if(typeof before === "string") {
+      names = names.filter((name) => name < before);
+    }
+    if(limit > 0) {
+      names = names.slice(-limit);
+    }
+    res.send(names);
   });
 });
 
@@ -217,17 +323,37 @@ app.delete('/api/outputs/:filename', (req, res) => {
     res.status(400).send("Invalid filename");
     return;
   }
-  // Delete file
-  let name = filename + ".a";
-  console.log("[INFO] Deleting file: " + outputsPath + "/" + name);
-
-  fs.unlink(outputsPath + "/" + name, (err) => {
-    if(err) {
+  // Thumbnail is not an output, ignore it in the count
+  fs.unlink(outputsPath + "/thumbs/" + filename + ".ab", (err) => {});
+  // Delete file (binary container or legacy)
+  let deleted = 0;
+  for(let ext of [".ab", ".a"]) {
+    let name = filename + ext;
+    if(!fs.existsSync(outputsPath + "/" + name)) {
+      continue;
+    }
+    console.log("[INFO] Deleting file: " + outputsPath + "/" + name);
+    try {
+      fs.unlinkSync(outputsPath + "/" + name);
+      deleted++;
+    } catch(e) {
       res.status(500).send("Cannot delete file");
       return;
     }
-    res.send("OK");
-  });
+  }
+  if(deleted === 0) {
+    res.status(500).send("Cannot delete file");
+    return;
+  }
+  if(fs.existsSync(outputPagesPath)) {
+    try {
+      removeFromOutputPage(filename);
+    } catch(e) {
+      console.log("[WARN] Cannot remove output from page: " + filename, e);
+    }
+    removeFromOutputIndex(filename);
+  }
+  res.send("OK");
 });
 
 app.put('/api/values', (req, res) => {
@@ -247,31 +373,24 @@ app.put('/api/values', (req, res) => {
     } catch(e) {
       console.log("Failed to parse JSON: " + body);
     }
+    // Drop a uniquely named file into the values inbox of the daemon.
+    // It is written under a temporary name and renamed, so the daemon
+    // never reads a partial file (see daemon/src/core/inbox.py)
+    let data, ext;
     if(isJson) {
-      // Read current values
-      let values = "{}";
-      try {
-        await fs.promises.readFile(statePath + "/values.json", 'utf8');
-      } catch(e) {
-        console.log("Failed to read values.json. Use empty one");
-      }
-      // Try to parse
-      try {
-        let parsed = JSON.parse(values);
-        mergeObject(parsed, json);
-        values = JSON.stringify(parsed);
-      } catch(e) {
-        // If cannot parse, just write
-        values = JSON.stringify(json);
-      }
-      // Write to file
-      await fs.promises.writeFile(statePath + "/values.json", values);
-      res.send("OK");
+      data = JSON.stringify(json);
+      ext = ".json";
     } else {
-      // Otherwise, just append to values after strip
-      body = body.trim();
-      await fs.promises.appendFile(statePath + "/values.as", body + "\n");
+      // Otherwise, it is aroma encoded lines
+      data = body.trim() + "\n";
+      ext = ".as";
+    }
+    try {
+      await dropValues(data, ext);
       res.send("OK");
+    } catch(e) {
+      console.log("[ERROR] Failed to write values: " + e);
+      res.status(500).send("Cannot write values");
     }
   });
 });
@@ -280,29 +399,26 @@ app.put('/api/values', (req, res) => {
 
 app.post('/api/outputs/archive', (req, res) => {
   console.log("[INFO] Archive and clean...");
-  // Run tar gz
-  let filename = "out-" + currentDateInFormat() + ".tar.gz";
-  let ps = child_process.spawn("tar",
-    [ "-czf",
-      archivesPath + "/" + filename,
-      "-C", outputsPath,
-      "."]);
+  // Archive outputs listed now (resuming an interrupted archive), and
+  // remove only archived ones
+  let ps = child_process.spawn("bash", ["daemon/archive.sh", "create", "--remove"]);
+  let out = "";
+  ps.stdout.on('data', (data) => {
+    out += data.toString();
+  });
+  ps.stderr.on('data', (data) => {
+    out += data.toString();
+  });
   ps.on('close', (code) => {
     if(code != 0) {
+      console.log("[ERROR] Archive failed: " + out.slice(-1000));
       res.status(500).send("Cannot create archive");
       return;
     }
-    fs.readdir(outputsPath, (err, files) => {
-      for(let file of files) {
-        let p = path.join(outputsPath, file);
-        console.log("[INFO] Deleting file: " + p)
-        fs.unlink(p, (err) => {});
-      }
-      let p = path.join(statePath, "last_job.json");
-      console.log("[INFO] Deleting file: " + p)
-      fs.unlink(p, (err) => {});
-      res.send("OK");
-    });
+    let p = path.join(statePath, "last_job.json");
+    console.log("[INFO] Deleting file: " + p)
+    fs.unlink(p, (err) => {});
+    res.send("OK");
   });
 });
 
@@ -26,7 +26,7 @@ const loadArchives = () => {
 
 const archiveOutputs = () => {
   // Make confirm
-  if(!confirm("Warning: It will archive all outputs as .tar.gz and DELETE ALL FILES IN OUTPUTS directory.")) {
+  if(!confirm("Warning: It will archive all outputs (as .tar.gz, by default) and DELETE ARCHIVED FILES IN OUTPUTS directory.")) {
     return;
   }
   // Send request
@@ -54,10 +54,22 @@ const getImageSource = (name) => {
 };
 
 const openImageInNewTab = (name) => {
-  let src = getImageSource(name);
   let s = window.open("imgview.html", "_blank");
-  s.addEventListener("load", () => {
-    s.document.getElementById("image").src = src;
+  const show = (src) => {
+    s.addEventListener("load", () => {
+      s.document.getElementById("image").src = src;
+    });
+  };
+  if(getImageData(name).thumbnail === undefined) {
+    show(getImageSource(name));
+    return;
+  }
+  // Gallery has a thumbnail, load the full image
+  fetchOutput(name).then((data) => {
+    let a = data instanceof ArrayBuffer
+      ? aromaReadContainer(mask, data)
+      : JSON.parse(aromaDecode(mask, data));
+    show(`data:image/${a.image_format};base64,${a.image}`);
   });
 };
 
@@ -85,21 +97,32 @@ const setupImageData = (name) => {
     msg.text("Data not loaded. It may not exist");
     return;
   }
-  // Try to decode file
-  let decoded = aromaDecode(mask, img.data);
-  if(typeof decoded !== "string") {
-    msg.text("Failed to decode data. Check password");
-    console.error("Cannot decode image: " + name);
-    return;
-  }
-  // The data is json, unmarshal
-  let parsed = JSON.parse(decoded);
-  if(typeof parsed !== "object") {
-    msg.text("Failed to parse json. Check password");
-    console.error("Cannot parse image: " + name);
-    return;
+  // Binary container is already parsed into object
+  if(img.data instanceof ArrayBuffer) {
+    try {
+      img.a = aromaReadContainer(mask, img.data);
+    } catch(e) {
+      msg.text("Failed to decode data. Check password");
+      console.error("Cannot decode image: " + name);
+      return;
+    }
+  } else {
+    // Try to decode file
+    let decoded = aromaDecode(mask, img.data);
+    if(typeof decoded !== "string") {
+      msg.text("Failed to decode data. Check password");
+      console.error("Cannot decode image: " + name);
+      return;
+    }
+    // The data is json, unmarshal
+    let parsed = JSON.parse(decoded);
+    if(typeof parsed !== "object") {
+      msg.text("Failed to parse json. Check password");
+      console.error("Cannot parse image: " + name);
+      return;
+    }
+    img.a = parsed;
   }
-  img.a = JSON.parse(decoded);
   // Update card
   imgV.attr("src", `data:image/${img.a.image_format};base64,${img.a.image}`);
   desc.html(jsonToHtml(img.a.values).html());
@@ -119,19 +142,42 @@ const loadImageDataByName = (name) => {
     return;
   }
   let desc = $("#" + img.descID);
-  let url = `/aroma-static/outputs/${name}.a`;
-  $.ajax({
-    url: url,
-    type: "GET",
-    dataType: "text",
-    async: true,
-    success: (data) => {
+  const loadOutput = () => {
+    fetchOutput(name).then((data) => {
       img.data = data;
       setupImageData(name);
-    },
-    error: (xhr, status, error) => {
-      desc.text("Error: " + error);
+    }).catch((e) => {
+      desc.text("Error: " + e);
+    });
+  };
+  // Thumbnail with the output metadata if the daemon wrote it, so the
+  // gallery does not download full images
+  fetch(`/aroma-static/outputs/thumbs/${name}.ab`).then((res) => {
+    if(!res.ok) {
+      loadOutput();
+      return;
     }
+    return res.arrayBuffer().then((data) => {
+      img.data = data;
+      setupImageData(name);
+    });
+  }).catch((e) => {
+    loadOutput();
+  });
+};
+
+const fetchOutput = (name) => {
+  // Try binary container (.ab) first, then legacy (.a, text)
+  return fetch(`/aroma-static/outputs/${name}.ab`).then((res) => {
+    if(res.ok) {
+      return res.arrayBuffer();
+    }
+    return fetch(`/aroma-static/outputs/${name}.a`).then((res) => {
+      if(!res.ok) {
+        throw new Error(res.statusText);
+      }
+      return res.text();
+    });
   });
 };
 
@@ -215,7 +261,7 @@ const resetColumn = (index) => {
 };
 
 const imageNameRegExp = new RegExp("^[a-zA-Z0-9_\\-\\.]+$");
-const pushImage = (name) => {
+const pushImage = (name, append) => {
   // Check if image is already in gallery
   if(imageMap[name] !== undefined) {
     return false;
@@ -237,7 +283,11 @@ const pushImage = (name) => {
   // Push card to column
   let html = newImageAndCard(name);
   let column = galleryColumn(minCol);
-  column.prepend(html);
+  if(append) {
+    column.append(html);
+  } else {
+    column.prepend(html);
+  }
   return true;
 };
 
@@ -255,6 +305,21 @@ const updatePWIndicator = (passed) => {
   }
 };
 
+const loadPreview = () => {
+  // Latent preview of the running job (low resolution, see preview.py)
+  fetch("/aroma-static/state/preview.ab").then((res) => {
+    if(!res.ok) {
+      return;
+    }
+    return res.arrayBuffer().then((data) => {
+      let a = aromaReadContainer(mask, data);
+      $('#state-preview')
+        .attr("src", `data:image/${a.image_format};base64,${a.image}`)
+        .removeClass("d-none");
+    });
+  }).catch((e) => {});
+};
+
 const reload = () => {
   if(!document.hidden) {
     // Load current state
@@ -286,6 +351,9 @@ const reload = () => {
       }
       status.addClass("bg-" + color);
       $('#state-details').text(JSON.stringify(data.values));
+      if(data.name === "txt2img" || data.name === "highres_fix") {
+        loadPreview();
+      }
       // Check it is progress
       let progress = $('#state-progress');
       if(typeof data.values.step === "number"
@@ -375,15 +443,23 @@ const reload = () => {
   }
 };
 
+// Gallery loads the newest page, and older pages on demand
+const galleryPageSize = 300;
+let galleryOldest = undefined;
+
 const loadAllGallery = (clear) => {
   if(clear) {
     for(var i = 0; i < 3; i++) {
       resetColumn(i);
     }
     imageMap = {};
+    galleryOldest = undefined;
   }
 
-  $.get("/api/outputs", (data) => {
+  $.get("/api/outputs", {limit: galleryPageSize}, (data) => {
+    if(data.length > 0 && (galleryOldest === undefined || data[0] < galleryOldest)) {
+      galleryOldest = data[0];
+    }
     data.forEach((name) => {
       pushImage(name);
       loadImageDataByName(name);
@@ -391,6 +467,23 @@ const loadAllGallery = (clear) => {
   });
 };
 
+const loadOlderGallery = () => {
+  if(galleryOldest === undefined) {
+    return;
+  }
+  $.get("/api/outputs", {limit: galleryPageSize, before: galleryOldest}, (data) => {
+    if(data.length > 0) {
+      galleryOldest = data[0];
+    }
+    // Older images go below, newest first
+    data.reverse().forEach((name) => {
+      if(pushImage(name, true)) {
+        loadImageDataByName(name);
+      }
+    });
+  });
+};
+
 const setModelValue = (model) => {
   $('#config-model-path').val(model);
 };
@@ -406,6 +499,26 @@ const loadAllModels = () => {
   });
 };
 
+const loadSamplers = () => {
+  // Sampling methods registered in daemon. Keep static list on failure
+  $.get("/aroma-static/state/samplers.json", (data) => {
+    let names;
+    try {
+      names = JSON.parse(aromaDecode(mask, data));
+    } catch(e) {
+      return;
+    }
+    let select = $('#config-sampling-method');
+    select.children().not('#config-sampling-method-current').remove();
+    names.forEach((name) => {
+      if(name === "Default") {
+        return;
+      }
+      select.append($('<option>').val(name).text(name));
+    });
+  });
+};
+
 const setLoraValue = (model) => {
   if(model === undefined) {
     $('#config-lora-path').val('-');
@@ -676,6 +789,7 @@ $(() => {
   // Load models
   loadAllModels();
   loadAllLoras();
+  loadSamplers();
   // Load gallery
   loadAllGallery();
   // Create interval to reload gallery
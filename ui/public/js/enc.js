@@ -140,6 +140,44 @@ const aromaDecode = (mask, str) => {
   return new TextDecoder().decode(s);
 };
 
+// Unmask bytes masked by aroma XOR scan (without gzip / base64)
+const aromaUnscan = (mask, b) => {
+  let out = new Uint8Array(b.length);
+  let last = 0;
+  let l = mask.length;
+  for (let i = 0; i < b.length; i++) {
+    out[i] = b[i] ^ last ^ mask[i % l];
+    last = b[i];
+  }
+  return out;
+};
+
+// Read binary output container (.ab). See daemon/src/core/container.py
+// Return metadata object, with base64 image in the `image` field
+const aromaReadContainer = (mask, buffer) => {
+  if(mask === undefined) {
+    mask = new Uint8Array([0x00]);
+  }
+  let view = new DataView(buffer);
+  let magic = String.fromCharCode(
+    view.getUint8(0), view.getUint8(1), view.getUint8(2), view.getUint8(3));
+  if(magic !== "ARMB") {
+    throw new Error("Invalid aroma container");
+  }
+  let flags = view.getUint8(5);
+  let metaLen = view.getUint32(8, true);
+  let imageLen = Number(view.getBigUint64(12, true));
+  let metaBytes = new Uint8Array(buffer, 20, metaLen);
+  let imageBytes = new Uint8Array(buffer, 20 + metaLen, imageLen);
+  if(flags & 0x01) {
+    metaBytes = aromaUnscan(mask, metaBytes);
+    imageBytes = aromaUnscan(mask, imageBytes);
+  }
+  let meta = JSON.parse(new TextDecoder().decode(metaBytes));
+  meta.image = base64EncArr(imageBytes);
+  return meta;
+};
+
 const makeMask = (pw) => {
   pw = "-<f!-" + pw + "<8z.";
   // SHA-512 encode
@@ -155,6 +193,7 @@ if(typeof module !== 'undefined') {
   module.exports = {
     aromaEncode: aromaEncode,
     aromaDecode: aromaDecode,
+    aromaReadContainer: aromaReadContainer,
     makeMask: makeMask,
   }
 }